@@ -0,0 +1,701 @@
+import asyncio
+import html
+import uuid
+from datetime import datetime
+
+import aiohttp
+from telebot import asyncio_helper, util
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_handler_backends import BaseMiddleware, CancelUpdate
+
+import bot as core
+import metrics
+from bot import (
+    main_markup, admin_markup, topup_markup, profile_text, new_user, ton_invoice_text,
+    invoice_markup, buy_markup, back_markup, categories_delete_text, products_delete_text,
+    invoice_payload, invoice_result, CRYPTOBOT_HEADERS, DEPOSIT_LIMIT_TEXT
+)
+from config import (
+    TOKEN, ADMIN_ID, CRYPTOBOT_API_URL, DB_CHANNEL_ID, TON_API_URL, TON_WALLET, TON_CHECK_TIMEOUT,
+    METRICS_HOST, METRICS_PORT, PROFILER_ENABLED
+)
+from fsm import StateMachine
+from ledger import InsufficientFunds
+from stock import OutOfStock
+from router import CallbackRouter
+from storage import AsyncStorage
+from ton import TonPoller
+
+# Те же сценарии, что и в bot.py, но на одном event loop: Telegram через
+# AsyncTeleBot, Crypto Pay и tonapi через общие keep-alive сессии aiohttp,
+# хранилище через пул потоков.
+bot = AsyncTeleBot(TOKEN)
+metrics.instrument_telegram(asyncio_helper, async_helper=True)
+db = AsyncStorage(core.db)
+users = db.table('users')
+products = db.table('products')
+categories = db.table('categories')
+ton_payments = db.table('ton_payments')
+meta = db.table('meta')
+invoices = db.table('invoices')
+broadcasts = db.table('broadcasts')
+router = CallbackRouter(core.callbacks)
+router.on_timing(metrics.route_hook)
+
+cryptopay_session = None
+ton_session = None
+
+# шаги диалогов в общем с bot.py StateStore, обработчики — async-версии с теми же именами
+fsm = StateMachine(core.states)
+
+async def next_step(chat_id, handler, **data):
+    await db.run(fsm.set, chat_id, handler, **data)
+
+def new_session(headers=None):
+    connector = aiohttp.TCPConnector(limit=100, keepalive_timeout=60)
+    return aiohttp.ClientSession(headers=headers, connector=connector, timeout=aiohttp.ClientTimeout(total=10))
+
+# ---------- Crypto Pay ----------
+async def create_cryptobot_invoice(amount, user_id):
+    try:
+        with metrics.http_timer('cryptopay', 'createInvoice'):
+            async with cryptopay_session.post(f'{CRYPTOBOT_API_URL}createInvoice', json=invoice_payload(amount, user_id)) as response:
+                response.raise_for_status()
+                invoice = invoice_result(await response.json())
+    except aiohttp.ClientError as e:
+        raise Exception(f"Ошибка соединения с Crypto Bot: {str(e)}")
+    except ValueError as e:
+        raise Exception(f"Ошибка обработки ответа от Crypto Bot: {str(e)}")
+    await db.run(core.track_invoice, invoice, amount, user_id)
+    return invoice
+
+async def notify(chat_id, message_id, text):
+    # статус в базе уже записан — ошибка Telegram не должна вернуть счёт или платёж в ожидание
+    try:
+        await bot.edit_message_text(text, chat_id, message_id)
+    except Exception as e:
+        print("Ошибка уведомления об оплате:", e)
+
+async def invoice_paid(invoice, item):
+    await db.run(core.credit_deposit, invoice['user_id'], float(item['amount']), f"cryptobot:{invoice['invoice_id']}")
+    await invoices.update({'status': 'paid'}, invoice_id=invoice['invoice_id'])
+    if invoice.get('message_id'):
+        await notify(invoice['chat_id'], invoice['message_id'], "✅ Оплата успешно завершена!")
+
+async def invoice_expired(invoice, item):
+    await invoices.update({'status': 'expired'}, invoice_id=invoice['invoice_id'])
+    if invoice.get('message_id'):
+        await notify(invoice['chat_id'], invoice['message_id'], "❌ Счёт просрочен. Создайте новый.")
+
+async def check_invoice(invoice_id, user_id):
+    invoice = await invoices.get(invoice_id=invoice_id)
+    if invoice is not None:
+        return invoice['status']
+    # счёт выставлен до появления таблицы invoices — сверяем один раз
+    items = await reconciler.afetch(cryptopay_session, [str(invoice_id)])
+    if not items:
+        return None
+    await db.run(core.track_invoice, items[0], float(items[0]['amount']), user_id)
+    await reconciler.ahandle(items)
+    return items[0]['status']
+
+async def reconcile_loop():
+    while True:
+        try:
+            for ids in reconciler.batches():
+                await reconciler.ahandle(await reconciler.afetch(cryptopay_session, ids))
+            await reconciler.aexpire()
+        except Exception as e:
+            print("Crypto Pay reconcile err:", e)
+        await asyncio.sleep(reconciler.interval)
+
+# ---------- TON ----------
+async def ton_credit(payment, value, rate):
+    usd = core.ton_usd(payment['amount'], rate)
+    await db.run(core.credit_deposit, payment['user_id'], usd, f"ton:{payment['comment']}", ton=payment['amount'], rate=rate)
+    await ton_payments.update({'status': 'paid', 'rate': rate, 'usd': usd}, comment=payment['comment'])
+    if payment.get('message_id'):
+        await notify(payment['chat_id'], payment['message_id'], f"✅ TON платёж найден! Зачислено {usd}$ (курс {rate}$ за TON).")
+
+async def ton_expire(payment):
+    await ton_payments.update({'status': 'expired'}, comment=payment['comment'])
+    if payment.get('message_id'):
+        await notify(payment['chat_id'], payment['message_id'], "❌ Платёж не поступил. Заявка отменена.")
+
+async def ton_save_cursor(lt):
+    await meta.upsert({'key': 'ton_after_lt', 'value': lt}, key='ton_after_lt')
+
+# колбэки — корутины: их ждут ahandle/aexpire внутри loop
+ton_poller = TonPoller(TON_API_URL, TON_WALLET, TON_CHECK_TIMEOUT, ton_credit, ton_expire,
+                       on_cursor=ton_save_cursor, rate=core.ton_rates.get)
+metrics.REGISTRY.gauge('shopa_ton_pending', "Ожидающие TON-платежи", lambda: len(ton_poller.pending))
+
+# track_invoice в bot.py отдаёт счета через шину в core.reconciler, здесь им управляет loop
+reconciler = core.reconciler
+reconciler.on_paid = invoice_paid
+reconciler.on_expired = invoice_expired
+core.bus.on('invoice', reconciler.add)
+core.bus.on('invoice_message', reconciler.update)
+
+async def ton_poll_loop():
+    while True:
+        try:
+            await ton_poller.ahandle(await ton_poller.afetch(ton_session))
+        except Exception as e:
+            print("TON poller err:", e)
+        await asyncio.sleep(ton_poller.interval)
+
+@fsm.step
+@metrics.handler('ton_get_amount')
+async def ton_get_amount(message):
+    try:
+        amount = float(message.text)
+        if amount < 0.1:
+            raise ValueError("Минимум 0.1 TON")
+        if await db.run(core.deposit_limited, message.from_user.id, 'ton'):
+            raise ValueError(DEPOSIT_LIMIT_TEXT)
+        comment = str(uuid.uuid4())[:8]
+        # сначала заявка в базе и у поллера, потом комментарий пользователю
+        payment = {
+            'user_id': message.from_user.id,
+            'amount': amount,
+            'comment': comment,
+            'status': 'pending',
+            'chat_id': message.chat.id,
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+        await ton_payments.insert(payment)
+        ton_poller.add(payment)
+        sent = await bot.send_message(message.chat.id, ton_invoice_text(amount, comment), parse_mode='HTML')
+        await ton_payments.update({'message_id': sent.message_id}, comment=comment)
+        ton_poller.update(comment, message_id=sent.message_id)
+    except ValueError as e:
+        await bot.send_message(message.chat.id, str(e))
+
+# ---------- ограничение частоты ----------
+async def answer_quietly(call, text=None):
+    try:
+        await bot.answer_callback_query(call.id, text)
+    except Exception as e:
+        print("Ошибка ответа на callback:", e)
+
+# то же, что ThrottleMiddleware в bot.py, ведра общие (core.throttle)
+class ThrottleMiddleware(BaseMiddleware):
+    def __init__(self, throttle):
+        self.throttle = throttle
+        self.update_sensitive = True
+        self.update_types = ['message', 'callback_query']
+
+    async def pre_process_message(self, message, data):
+        allowed, notify = self.throttle.allow(message.from_user.id)
+        if allowed:
+            return None
+        metrics.throttled.inc(kind='message', action='dropped')
+        if notify:
+            try:
+                await bot.send_message(message.chat.id, "⏳ Слишком много сообщений, подождите немного")
+            except Exception as e:
+                print("Ошибка предупреждения о лимите:", e)
+        return CancelUpdate()
+
+    async def post_process_message(self, message, data, exception):
+        pass
+
+    async def pre_process_callback_query(self, call, data):
+        key = (call.from_user.id, call.data)
+        if not self.throttle.begin(key):
+            metrics.throttled.inc(kind='callback', action='coalesced')
+            await answer_quietly(call, "⏳ Уже выполняется")
+            return CancelUpdate()
+        allowed, notify = self.throttle.allow(call.from_user.id)
+        if not allowed:
+            self.throttle.done(key)
+            metrics.throttled.inc(kind='callback', action='dropped')
+            await answer_quietly(call, "⏳ Слишком часто, подождите" if notify else None)
+            return CancelUpdate()
+        data['throttle_key'] = key
+        return None
+
+    async def post_process_callback_query(self, call, data, exception):
+        self.throttle.done(data['throttle_key'])
+
+bot.setup_middleware(ThrottleMiddleware(core.throttle))
+
+# ---------- обработчики ----------
+async def step_active(message):
+    # async-фильтр: AsyncTeleBot ждёт его, лямбда с корутиной была бы всегда истинной
+    return await fsm.aactive(message.chat.id)
+
+@bot.message_handler(func=step_active, content_types=util.content_type_media)
+@metrics.handler('step')
+async def handle_step(message):
+    await fsm.adispatch(message)
+
+@bot.message_handler(commands=['start'])
+@metrics.handler('start')
+async def start(message):
+    user_id = message.from_user.id
+    user = await users.get(user_id=user_id)
+    if not user:
+        await users.insert(new_user(user_id))
+        await db.run(core.daily_stats.record, 'new_user')
+    elif user.get('blocked'):
+        await users.update({'blocked': False}, user_id=user_id)
+    await bot.send_message(message.chat.id, "<b>Привет! Добро пожаловать в наш магазин!</b>", reply_markup=main_markup(), parse_mode='HTML')
+    payload = message.text.split(maxsplit=1)[1] if len(message.text.split()) > 1 else ""
+    if payload.startswith("item_") and payload[5:].isdigit():
+        item = core.catalog.product(int(payload[5:]))
+        if item:
+            text, markup = await db.run(core.item_view, item)
+            await bot.send_message(message.chat.id, text, reply_markup=markup, parse_mode='HTML')
+
+@bot.message_handler(commands=['search'])
+@metrics.handler('search')
+async def search_command(message):
+    query = message.text.split(maxsplit=1)[1] if len(message.text.split()) > 1 else ""
+    if query:
+        await send_search_results(message.chat.id, query)
+    else:
+        await bot.send_message(message.chat.id, "🔍 Введите название или часть описания товара")
+        await next_step(message.chat.id, search_query)
+
+@bot.inline_handler(func=lambda query: True)
+@metrics.handler('inline')
+async def inline_search(query):
+    if not query.query.strip():
+        await bot.answer_inline_query(query.id, [], cache_time=30)
+        return
+    if 'username' not in core.username_cache:
+        core.username_cache['username'] = (await bot.get_me()).username
+    items, next_offset = core.inline_page(query.query, query.offset)
+    # карточки показывают остаток — при промахе кеша это units.count
+    results = await db.run(core.inline_results, items)
+    await bot.answer_inline_query(query.id, results, cache_time=30, next_offset=next_offset)
+
+@bot.message_handler(commands=['admin'])
+@metrics.handler('admin')
+async def admin_panel(message):
+    if message.from_user.id != ADMIN_ID:
+        await bot.send_message(message.chat.id, "У вас нет доступа к админ-панели")
+        return
+    await bot.send_message(message.chat.id, "Админ меню", reply_markup=admin_markup())
+
+@bot.message_handler(commands=['import'])
+@metrics.handler('import')
+async def import_command(message):
+    if message.from_user.id != ADMIN_ID:
+        await bot.send_message(message.chat.id, "У вас нет доступа к админ-панели")
+        return
+    await bot.send_message(message.chat.id, core.IMPORT_HELP, parse_mode='HTML')
+    await next_step(message.chat.id, import_archive)
+
+@fsm.step
+async def import_archive(message):
+    if message.content_type != 'document' or not (message.document.file_name or '').lower().endswith('.zip'):
+        await bot.send_message(message.chat.id, "Пожалуйста, отправьте zip-архив!")
+        return
+    if message.document.file_size and message.document.file_size > 20 * 1024 * 1024:
+        await bot.send_message(message.chat.id, "Архив больше 20 МБ, разбейте его на части")
+        return
+    file = await bot.get_file(message.document.file_id)
+    data = await bot.download_file(file.file_path)
+    status = await bot.send_message(message.chat.id, "⏳ Импорт начат")
+    # загрузчик и прогресс — синхронные из bot.py, в отдельном потоке
+    asyncio.get_running_loop().run_in_executor(None, core.run_import, message.chat.id, status.message_id, data)
+
+@bot.message_handler(commands=['stock'])
+@metrics.handler('stock')
+async def stock_command(message):
+    if message.from_user.id != ADMIN_ID:
+        await bot.send_message(message.chat.id, "У вас нет доступа к админ-панели")
+        return
+    args = message.text.split()
+    item = core.catalog.product(int(args[1])) if len(args) > 1 and args[1].isdigit() else None
+    if not item:
+        await bot.send_message(message.chat.id, "Использование: /stock <id товара>")
+        return
+    await bot.send_message(message.chat.id, core.STOCK_HELP.format(name=item['name']))
+    await next_step(message.chat.id, stock_units, product_id=item['id'])
+
+@fsm.step
+async def stock_units(message, product_id):
+    if message.content_type == 'text':
+        contents = [{'text': line.strip()} for line in message.text.splitlines() if line.strip()]
+    elif message.content_type == 'document' and (message.document.file_name or '').lower().endswith('.txt'):
+        file = await bot.get_file(message.document.file_id)
+        data = (await bot.download_file(file.file_path)).decode('utf-8-sig')
+        contents = [{'text': line.strip()} for line in data.splitlines() if line.strip()]
+    elif message.content_type == 'document':
+        file_msg = await bot.send_document(DB_CHANNEL_ID, message.document.file_id)
+        contents = [{'file_id': file_msg.document.file_id}]
+    else:
+        await bot.send_message(message.chat.id, "Пожалуйста, отправьте текст или документ!")
+        return
+    if not contents:
+        await bot.send_message(message.chat.id, "Не найдено ни одной единицы товара")
+        return
+    await db.run(core.add_units, product_id, contents)
+    await bot.send_message(message.chat.id, f"Добавлено: {len(contents)}, в наличии: {await db.run(core.stock.available, product_id)}")
+
+@bot.message_handler(content_types=['text'])
+@metrics.handler('text')
+async def handle_text(message):
+    user_id = message.from_user.id
+    chat_id = message.chat.id
+    if message.text == "👤 Профиль":
+        user = await users.get(user_id=user_id)
+        if user:
+            await bot.send_message(chat_id, profile_text(user_id, user), parse_mode='HTML')
+        else:
+            await bot.send_message(chat_id, "Профиль не найден. Попробуйте перезапустить бота с помощью /start")
+    elif message.text == "💳 Пополнить баланс":
+        await bot.send_message(chat_id, "➖ Пополнение баланса ➖\n\nВыберите способ:", reply_markup=topup_markup())
+    elif message.text == "🏪 Купить":
+        await bot.send_message(chat_id, "Каталог", reply_markup=core.catalog_view())
+    elif message.text == "📋 Товары":
+        await show_products_list(chat_id, 1)
+    elif message.text == "🔍 Поиск":
+        await bot.send_message(chat_id, "🔍 Введите название или часть описания товара")
+        await next_step(chat_id, search_query)
+    elif message.text == "🧾 Мои покупки":
+        text, markup = await db.run(core.purchases_view, user_id)
+        await bot.send_message(chat_id, text, reply_markup=markup)
+
+@fsm.step
+async def search_query(message):
+    if not message.text:
+        await bot.send_message(message.chat.id, "Запрос не может быть пустым!")
+        return
+    await send_search_results(message.chat.id, message.text)
+
+async def send_search_results(chat_id, query):
+    text, markup = core.search_results(query)
+    await bot.send_message(chat_id, text, reply_markup=markup)
+
+@fsm.step
+async def broadcast_message(message):
+    broadcast = await db.run(core.broadcaster.create, message.chat.id, message.message_id)
+    await bot.send_message(message.chat.id, f"Сообщение выше будет разослано. Пользователей в базе: <code>{await users.count()}</code>",
+                           reply_markup=core.broadcast_confirm_markup(broadcast['id']), parse_mode='HTML')
+
+@fsm.step
+@metrics.handler('process_amount')
+async def process_amount(message):
+    try:
+        amount = float(message.text)
+        if not (1 <= amount <= 1500):
+            raise ValueError("Сумма должна быть от 1$ до 1500$")
+        if await db.run(core.deposit_limited, message.from_user.id, 'cryptobot'):
+            raise ValueError(DEPOSIT_LIMIT_TEXT)
+        invoice = await create_cryptobot_invoice(amount, message.from_user.id)
+        sent = await bot.send_message(message.chat.id, f"➖ Пополнение ➖\n\n💰 Сумма: <code>{amount}$</code>", reply_markup=invoice_markup(invoice), parse_mode='HTML')
+        await db.run(core.attach_invoice_message, invoice['invoice_id'], message.chat.id, sent.message_id)
+    except ValueError as e:
+        await bot.send_message(message.chat.id, str(e))
+
+@bot.callback_query_handler(func=lambda call: True)
+async def callback_handler(call):
+    await router.adispatch(call)
+
+@router.route("pay_ton")
+async def on_pay_ton(call):
+    if await db.run(core.deposit_limited, call.from_user.id, 'ton'):
+        await bot.answer_callback_query(call.id, DEPOSIT_LIMIT_TEXT, show_alert=True)
+        return
+    await bot.delete_message(call.message.chat.id, call.message.message_id)
+    await bot.send_message(call.message.chat.id, "➖ Пополнение TON ➖\n\nВведите сумму (мин. 0.1 TON):")
+    await next_step(call.message.chat.id, ton_get_amount)
+
+@router.route("pay_usdt")
+async def on_pay_usdt(call):
+    if await db.run(core.deposit_limited, call.from_user.id, 'cryptobot'):
+        await bot.answer_callback_query(call.id, DEPOSIT_LIMIT_TEXT, show_alert=True)
+        return
+    await bot.delete_message(call.message.chat.id, call.message.message_id)
+    await bot.send_message(call.message.chat.id, "➖ Пополнение баланса ➖\n\nВведите сумму пополнения, от 1$ до 1500$:")
+    await next_step(call.message.chat.id, process_amount)
+
+@router.route("check")
+async def on_check(call, invoice_id):
+    chat_id, message_id = call.message.chat.id, call.message.message_id
+    status = await check_invoice(invoice_id, call.from_user.id)
+    if status == 'paid':
+        await bot.edit_message_text("✅ Оплата успешно завершена!", chat_id, message_id)
+    elif status == 'expired':
+        await bot.edit_message_text("❌ Счёт просрочен. Создайте новый.", chat_id, message_id)
+    else:
+        await bot.answer_callback_query(call.id, "Платеж еще не завершен")
+
+@router.route("category")
+async def on_category(call, category_id):
+    category = core.catalog.category(category_id)
+    if category:
+        await bot.delete_message(call.message.chat.id, call.message.message_id)
+        await bot.send_message(call.message.chat.id, f"Каталог: {category['name']}", reply_markup=await db.run(core.category_view, category_id))
+
+@router.route("item")
+async def on_item(call, item_id):
+    item = core.catalog.product(item_id)
+    if item:
+        await bot.delete_message(call.message.chat.id, call.message.message_id)
+        text, markup = await db.run(core.item_view, item)
+        await bot.send_message(call.message.chat.id, text, reply_markup=markup, parse_mode='HTML')
+
+@router.route("back_to_catalog")
+async def on_back_to_catalog(call):
+    await bot.delete_message(call.message.chat.id, call.message.message_id)
+    await bot.send_message(call.message.chat.id, "Каталог", reply_markup=core.catalog_view())
+
+@router.route("buy")
+async def on_buy(call, item_id):
+    if core.catalog.product(item_id):
+        await bot.delete_message(call.message.chat.id, call.message.message_id)
+        await bot.send_message(call.message.chat.id, "<b>Вы точно хотите купить этот товар?</b>", reply_markup=buy_markup(item_id), parse_mode='HTML')
+
+@router.route("confirm")
+async def on_confirm(call, item_id):
+    chat_id, message_id = call.message.chat.id, call.message.message_id
+    item = core.catalog.product(item_id)
+    user_id = call.from_user.id
+    user = await users.get(user_id=user_id)
+    if item and user:
+        key = f"purchase:{chat_id}:{message_id}"
+        try:
+            if item.get('stocked'):
+                purchase = await db.run(core.stock.purchase, user_id, item, key)
+            else:
+                purchase = await db.run(core.ledger.debit, user_id, item['price'], key, product_id=item_id)
+        except InsufficientFunds:
+            await bot.edit_message_text("❌ Недостаточно средств на балансе!", chat_id, message_id)
+            return
+        except OutOfStock:
+            await bot.edit_message_text("❌ Товар закончился", chat_id, message_id)
+            return
+        if purchase:
+            await bot.delete_message(chat_id, message_id)
+            await bot.send_message(chat_id, "⚡️")
+            await deliver(chat_id, item, purchase if item.get('stocked') else item)
+
+async def deliver(chat_id, item, unit):
+    if unit.get('file_id'):
+        await bot.send_document(chat_id, unit['file_id'], caption=f"Ваш товар: {item['name']}")
+    elif unit.get('text'):
+        await bot.send_message(chat_id, f"Ваш товар: {html.escape(item['name'])}\n\n<code>{html.escape(unit['text'])}</code>", parse_mode='HTML')
+
+@router.route("purchases")
+async def on_purchases(call, before):
+    text, markup = await db.run(core.purchases_view, call.from_user.id, before=before)
+    await bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+
+@router.route("purchases_newer")
+async def on_purchases_newer(call, after):
+    text, markup = await db.run(core.purchases_view, call.from_user.id, after=after)
+    await bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+
+@router.route("redeliver")
+async def on_redeliver(call, purchase_id):
+    purchase = await db.run(core.purchases.get, purchase_id)
+    if not purchase or purchase['user_id'] != call.from_user.id:
+        await bot.answer_callback_query(call.id, "Покупка не найдена")
+        return
+    if not (purchase.get('file_id') or purchase.get('text')):
+        await bot.answer_callback_query(call.id, "Товар больше недоступен")
+        return
+    await bot.answer_callback_query(call.id)
+    await deliver(call.message.chat.id, purchase, purchase)
+
+@router.route("admin_stats")
+async def on_admin_stats(call):
+    await bot.edit_message_text(await db.run(core.get_stats), call.message.chat.id, call.message.message_id, reply_markup=back_markup("admin_back"), parse_mode='HTML')
+
+@router.route("admin_back")
+async def on_admin_back(call):
+    await bot.edit_message_text("Админ меню", call.message.chat.id, call.message.message_id, reply_markup=admin_markup())
+
+@router.route("admin_add")
+async def on_admin_add(call):
+    await bot.send_message(call.message.chat.id, "Выберите раздел для создания товара", reply_markup=core.catalog_view('admin_select_category'))
+
+@router.route("admin_create_category")
+async def on_admin_create_category(call):
+    await bot.delete_message(call.message.chat.id, call.message.message_id)
+    await bot.send_message(call.message.chat.id, "Введите название раздела")
+    await next_step(call.message.chat.id, create_category)
+
+@router.route("admin_delete_category")
+async def on_admin_delete_category(call):
+    await show_categories_to_delete(call.message.chat.id)
+
+@router.route("admin_delete")
+async def on_admin_delete(call):
+    await show_products_to_delete(call.message.chat.id)
+
+@router.route("admin_broadcast")
+async def on_admin_broadcast(call):
+    if call.from_user.id != ADMIN_ID:
+        return
+    await bot.send_message(call.message.chat.id, "Отправьте сообщение для рассылки (текст, фото или файл)")
+    await next_step(call.message.chat.id, broadcast_message)
+
+@router.route("broadcast_start")
+async def on_broadcast_start(call, broadcast_id):
+    if call.from_user.id != ADMIN_ID:
+        return
+    # рассылку ведут потоки Broadcaster из bot.py, здесь только запуск
+    if await db.run(core.broadcaster.start, broadcast_id, chat_id=call.message.chat.id, status_message_id=call.message.message_id):
+        broadcast = await broadcasts.get(id=broadcast_id)
+        await bot.edit_message_text(core.broadcast_text(broadcast), call.message.chat.id, call.message.message_id,
+                                    reply_markup=core.broadcast_markup(broadcast), parse_mode='HTML')
+    else:
+        await bot.answer_callback_query(call.id, "Рассылка уже запущена или отменена")
+
+@router.route("broadcast_stop")
+async def on_broadcast_stop(call, broadcast_id):
+    if call.from_user.id != ADMIN_ID:
+        return
+    if not await db.run(core.broadcaster.stop, broadcast_id):
+        return
+    broadcast = await broadcasts.get(id=broadcast_id)
+    if broadcast.get('status_message_id'):
+        await bot.answer_callback_query(call.id, "Рассылка остановится после текущей пачки")
+    else:
+        await bot.edit_message_text("Рассылка отменена", call.message.chat.id, call.message.message_id)
+
+@router.route("admin_select_category")
+async def on_admin_select_category(call, category_id):
+    await bot.delete_message(call.message.chat.id, call.message.message_id)
+    await bot.send_message(call.message.chat.id, "Введите название товара")
+    await next_step(call.message.chat.id, add_product_name, category_id=category_id)
+
+@router.route("products_page", legacy=core.parse_page_data)
+async def on_products_page(call, page, after=None, before=None):
+    text, markup = core.products_page(page, after, before)
+    await bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id, text=text, reply_markup=markup, parse_mode='HTML')
+
+# ---------- админка ----------
+@fsm.step
+async def create_category(message):
+    if not message.text:
+        await bot.send_message(message.chat.id, "Название раздела не может быть пустым!")
+        return
+    await db.run(core.insert_category, message.text)
+    await bot.send_message(message.chat.id, "Раздел создан")
+
+async def show_categories_to_delete(chat_id):
+    all_categories = await categories.all()
+    if not all_categories:
+        await bot.send_message(chat_id, "Разделов пока нет")
+        return
+    await bot.send_message(chat_id, categories_delete_text(all_categories), parse_mode='HTML')
+    await next_step(chat_id, delete_category)
+
+@fsm.step
+async def delete_category(message):
+    try:
+        num = int(message.text) - 1
+        all_categories = await categories.all()
+        if 0 <= num < len(all_categories):
+            await db.run(core.remove_category, all_categories[num])
+            await bot.send_message(message.chat.id, "Раздел удален!")
+        else:
+            await bot.send_message(message.chat.id, "Неверный номер раздела!")
+    except ValueError:
+        await bot.send_message(message.chat.id, "Введите корректный номер!")
+
+@fsm.step
+async def add_product_name(message, category_id):
+    if not message.text:
+        await bot.send_message(message.chat.id, "Название не может быть пустым!")
+        return
+    await bot.delete_message(message.chat.id, message.message_id - 1)
+    await bot.send_message(message.chat.id, "Введите описание товара")
+    await next_step(message.chat.id, add_product_desc, name=message.text, category_id=category_id)
+
+@fsm.step
+async def add_product_desc(message, name, category_id):
+    if not message.text:
+        await bot.send_message(message.chat.id, "Описание не может быть пустым!")
+        return
+    await bot.delete_message(message.chat.id, message.message_id - 1)
+    await bot.send_message(message.chat.id, "Введите цену товара")
+    await next_step(message.chat.id, add_product_price, name=name, desc=message.text, category_id=category_id)
+
+@fsm.step
+async def add_product_price(message, name, desc, category_id):
+    try:
+        price = float(message.text)
+        if price <= 0:
+            raise ValueError("Цена должна быть положительной")
+        await bot.delete_message(message.chat.id, message.message_id - 1)
+        await bot.send_message(message.chat.id, "Отправьте файл который будет отправляться после покупки")
+        await next_step(message.chat.id, add_product_file, name=name, desc=desc, price=price, category_id=category_id)
+    except ValueError:
+        await bot.send_message(message.chat.id, "Введите корректную положительную цену!")
+
+@fsm.step
+async def add_product_file(message, name, desc, price, category_id):
+    if message.content_type == 'document':
+        file_msg = await bot.send_document(DB_CHANNEL_ID, message.document.file_id)
+        await bot.delete_message(message.chat.id, message.message_id - 1)
+        await db.run(core.insert_product, name, desc, price, file_msg.document.file_id, category_id)
+        await bot.send_message(message.chat.id, "Товар создан")
+    else:
+        await bot.send_message(message.chat.id, "Пожалуйста, отправьте документ!")
+
+async def show_products_list(chat_id, page):
+    text, markup = core.products_page(page)
+    await bot.send_message(chat_id, text, reply_markup=markup, parse_mode='HTML')
+
+async def show_products_to_delete(chat_id):
+    items = await products.all()
+    if not items:
+        await bot.send_message(chat_id, "Товаров пока нет")
+        return
+    await bot.send_message(chat_id, products_delete_text(items), parse_mode='HTML')
+    await next_step(chat_id, delete_product)
+
+@fsm.step
+async def delete_product(message):
+    try:
+        num = int(message.text) - 1
+        items = await products.all()
+        if 0 <= num < len(items):
+            await db.run(core.remove_product, items[num])
+            await bot.send_message(message.chat.id, "Товар удален!")
+        else:
+            await bot.send_message(message.chat.id, "Неверный номер товара!")
+    except ValueError:
+        await bot.send_message(message.chat.id, "Введите корректный номер!")
+
+async def main():
+    global cryptopay_session, ton_session
+    cryptopay_session = new_session(CRYPTOBOT_HEADERS)
+    ton_session = new_session()
+    cursor = await meta.get(key='ton_after_lt')
+    ton_poller.after_lt = cursor['value'] if cursor else None
+    await ton_poller.aload(await ton_payments.search(status='pending'))
+    core.ton_rates.start()
+    reconciler.load(await invoices.search(status='active'))
+    await db.run(core.states.purge)
+    await db.run(core.stock.recover)
+    await db.run(core.broadcaster.resume)
+    if METRICS_PORT:
+        metrics_server = metrics.MetricsServer(METRICS_HOST, METRICS_PORT)
+        metrics_server.start()
+        if PROFILER_ENABLED:
+            metrics_server.profiler.start()
+    tasks = [asyncio.create_task(ton_poll_loop()), asyncio.create_task(reconcile_loop())]
+    try:
+        await bot.infinity_polling()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await cryptopay_session.close()
+        await ton_session.close()
+        await bot.close_session()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except Exception as e:
+        print(f"Ошибка при запуске бота: {str(e)}")
@@ -0,0 +1,281 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Нагрузочный прогон обработчиков bot.py без сети: Telegram подменяется
+# через apihelper.CUSTOM_REQUEST_SENDER, Crypto Pay и tonapi — локальными
+# HTTP-серверами, база — временный файл с синтетическими данными.
+#
+#   python benchmark.py --users 100000 --products 10000 --iterations 2000
+
+
+# ---------- фейковый Telegram ----------
+class FakeTelegram:
+    def __init__(self):
+        self.message_ids = itertools.count(1)
+        self.calls = 0
+
+    def message(self, params):
+        chat_id = int((params or {}).get('chat_id', 1))
+        return {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': (params or {}).get('text', ''),
+            'document': {'file_id': 'file', 'file_unique_id': 'file'},
+        }
+
+    def __call__(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        from telebot import util
+        self.calls += 1
+        name = url.rsplit('/', 1)[-1]
+        if name in ('deleteMessage', 'answerCallbackQuery', 'setWebhook', 'deleteWebhook'):
+            result = True
+        elif name == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench'}
+        else:
+            result = self.message(params)
+        return util.CustomRequestResponse(json.dumps({'ok': True, 'result': result}))
+
+
+# ---------- фейковые Crypto Pay и tonapi ----------
+class FakeApis:
+    def __init__(self):
+        self.invoice_ids = itertools.count(1000000)
+        self.paid = set()
+        self.ton_txs = []
+        self.lock = threading.Lock()
+        apis = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                if url.path.endswith('/getInvoices'):
+                    ids = [int(i) for i in query.get('invoice_ids', '').split(',') if i]
+                    items = [{'invoice_id': i, 'status': 'paid' if i in apis.paid else 'active', 'amount': '5'}
+                             for i in ids]
+                    self.reply({'ok': True, 'result': {'items': items}})
+                elif '/transactions' in url.path:
+                    self.reply({'transactions': apis.transactions(query)})
+                else:
+                    self.reply({'ok': False}, 404)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                invoice_id = next(apis.invoice_ids)
+                self.reply({'ok': True, 'result': {'invoice_id': invoice_id, 'pay_url': f'https://pay/{invoice_id}'}})
+
+            def reply(self, data, code=200):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def add_ton_tx(self, comment, amount):
+        with self.lock:
+            lt = len(self.ton_txs) + 1
+            self.ton_txs.append({'lt': lt, 'in_msg': {'message': comment, 'value': int(amount * 1e9)}})
+
+    def transactions(self, query):
+        limit = int(query.get('limit', 100))
+        with self.lock:
+            if 'after_lt' in query:
+                after = int(query['after_lt'])
+                return [tx for tx in self.ton_txs if tx['lt'] > after][:limit]
+            return list(reversed(self.ton_txs[-limit:]))
+
+
+# ---------- данные ----------
+def generate(path, args, rnd):
+    from storage import SQLiteStorage, TinyStorage
+    db = SQLiteStorage(path) if args.backend == 'sqlite' else TinyStorage(path)
+    today = datetime.now()
+    batch = 10000
+    for start in range(1, args.users + 1, batch):
+        db.table('users').insert_multiple([{
+            'user_id': user_id, 'balance': 1000000, 'purchases': 0, 'total_spent': 0, 'total_deposited': 0,
+            'join_date': (today - timedelta(days=rnd.randrange(365))).strftime('%Y-%m-%d')
+        } for user_id in range(start, min(start + batch, args.users + 1))])
+    db.table('categories').insert_multiple([{'id': i, 'name': f'Раздел {i}'} for i in range(1, args.categories + 1)])
+    for start in range(1, args.products + 1, batch):
+        db.table('products').insert_multiple([{
+            'id': i, 'name': f'Товар {i}', 'description': f'Описание товара {i}', 'price': round(rnd.uniform(1, 50), 2),
+            'file_id': f'file{i}', 'category_id': rnd.randint(1, args.categories)
+        } for i in range(start, min(start + batch, args.products + 1))])
+    rows = []
+    for _ in range(args.users + args.payments):
+        day = (today - timedelta(days=rnd.randrange(365))).strftime('%Y-%m-%d')
+        rows.append({'type': 'payment', 'amount': 5, 'timestamp': day} if len(rows) >= args.users
+                    else {'type': 'new_user', 'timestamp': day})
+    for start in range(0, len(rows), batch):
+        db.table('stats').insert_multiple(rows[start:start + batch])
+    db.close()
+
+
+# ---------- синтетические апдейты ----------
+def make_message(user_id, text):
+    from telebot import types
+    return types.Message.de_json({
+        'message_id': 1, 'date': int(time.time()), 'text': text,
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'u'},
+    })
+
+def make_call(user_id, data):
+    from telebot import types
+    return types.CallbackQuery.de_json({
+        'id': str(user_id), 'data': data, 'chat_instance': '1',
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'u'},
+        'message': {'message_id': random.randrange(1 << 30), 'date': int(time.time()), 'text': '',
+                    'chat': {'id': user_id, 'type': 'private'}},
+    })
+
+
+# ---------- замеры ----------
+def measure(name, iterations, func):
+    latencies = []
+    tracemalloc.start()
+    started = time.perf_counter()
+    for i in range(iterations):
+        t = time.perf_counter()
+        func(i)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    latencies.sort()
+
+    def pct(p):
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+    return {
+        'name': name,
+        'iterations': iterations,
+        'p50_ms': round(pct(0.50), 3),
+        'p95_ms': round(pct(0.95), 3),
+        'p99_ms': round(pct(0.99), 3),
+        'max_ms': round(latencies[-1] * 1000, 3),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 3),
+        'ops_per_sec': round(iterations / elapsed, 1) if elapsed else 0,
+        'peak_alloc_kb': peak // 1024,
+    }
+
+
+def scenarios(bot, args, apis, rnd):
+    users = lambda: rnd.randint(1, args.users)
+    products = lambda: rnd.randint(1, args.products)
+    pages = max((args.products + bot.PRODUCTS_PER_PAGE - 1) // bot.PRODUCTS_PER_PAGE, 1)
+    bot.ton_rates.update(5.0)
+
+    def ton_cycle(i):
+        for n in range(args.ton_pending):
+            comment = f'b{i}-{n}'
+            payment = {'user_id': users(), 'amount': 1.0, 'comment': comment, 'status': 'pending',
+                       'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+            bot.ton_payments.insert(payment)
+            bot.ton_poller.add(payment)
+            if n % 10 == 0:
+                apis.add_ton_tx(comment, 1.0)
+        bot.ton_poller.poll()
+
+    def reconcile_cycle(i):
+        for n in range(args.invoices):
+            invoice = bot.create_cryptobot_invoice(5, users())
+            if n % 5 == 0:
+                apis.paid.add(invoice['invoice_id'])
+        bot.reconciler.poll()
+
+    return [
+        ('handle_text:profile', args.iterations, lambda i: bot.handle_text(make_message(users(), "👤 Профиль"))),
+        ('handle_text:catalog', args.iterations, lambda i: bot.handle_text(make_message(users(), "🏪 Купить"))),
+        ('handle_text:products', args.iterations, lambda i: bot.handle_text(make_message(users(), "📋 Товары"))),
+        ('callback:category', args.iterations,
+         lambda i: bot.callback_handler(make_call(users(), f"category_{rnd.randint(1, args.categories)}"))),
+        ('callback:item', args.iterations, lambda i: bot.callback_handler(make_call(users(), f"item_{products()}"))),
+        ('callback:item_compact', args.iterations,
+         lambda i: bot.callback_handler(make_call(users(), bot.callbacks.encode('item', products())))),
+        ('callback:products_page', args.iterations,
+         lambda i: bot.callback_handler(make_call(users(), f"products_page_{rnd.randint(1, pages)}"))),
+        ('callback:confirm', args.iterations, lambda i: bot.callback_handler(make_call(users(), f"confirm_{products()}"))),
+        ('callback:check', args.iterations, lambda i: bot.callback_handler(make_call(users(), f"check_{rnd.randint(1, 1000)}"))),
+        ('get_stats', args.iterations, lambda i: bot.get_stats()),
+        ('ton_poller:cycle', args.cycles, ton_cycle),
+        ('reconciler:cycle', args.cycles, reconcile_cycle),
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк обработчиков бота")
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--categories', type=int, default=50)
+    parser.add_argument('--payments', type=int, default=50000)
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--cycles', type=int, default=20, help="циклов TON-поллера и сверки счетов")
+    parser.add_argument('--ton-pending', type=int, default=500)
+    parser.add_argument('--invoices', type=int, default=100)
+    parser.add_argument('--backend', choices=['sqlite', 'tinydb'], default='sqlite')
+    parser.add_argument('--only', help="запускать только сценарии с этой подстрокой")
+    parser.add_argument('--json', help="сохранить результаты в файл")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    rnd = random.Random(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix='shopa-bench-')
+    db_path = os.path.join(workdir, 'bench.sqlite3' if args.backend == 'sqlite' else 'bench.json')
+    started = time.perf_counter()
+    generate(db_path, args, rnd)
+    print(f"Данные: {args.users} юзеров, {args.products} товаров за {time.perf_counter() - started:.1f} с ({db_path})")
+
+    apis = FakeApis()
+    telegram = FakeTelegram()
+    import config
+    config.DB_BACKEND = args.backend
+    config.DB_PATH = db_path
+    config.TINYDB_PATH = db_path
+    config.CRYPTOBOT_API_URL = apis.url + '/api/'
+    config.TON_API_URL = apis.url + '/v2/blockchain/accounts/{}/transactions'
+    from telebot import apihelper
+    apihelper.CUSTOM_REQUEST_SENDER = telegram
+    import bot
+    bot.bot.threaded = False
+
+    results = []
+    for name, iterations, func in scenarios(bot, args, apis, rnd):
+        if args.only and args.only not in name:
+            continue
+        results.append(measure(name, iterations, func))
+        r = results[-1]
+        print(f"{name:<24} p50 {r['p50_ms']:>9.3f} ms  p95 {r['p95_ms']:>9.3f} ms  p99 {r['p99_ms']:>9.3f} ms  "
+              f"{r['ops_per_sec']:>9.1f} op/s  peak {r['peak_alloc_kb']:>7} KB")
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+    print(f"Запросов к Telegram: {telegram.calls}, max RSS: {max_rss} MB")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'max_rss_mb': max_rss, 'results': results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,346 +1,1034 @@
 import telebot
-from telebot import types
-from tinydb import TinyDB, Query
+from telebot import apihelper, types, util
+from telebot.handler_backends import BaseMiddleware, CancelUpdate
 import requests
-from datetime import datetime, timedelta
-import uuid
+from datetime import datetime
+import html
+import io
 import threading
-import time
+import uuid
+import zipfile
 
 from config import (
     TOKEN, ADMIN_ID, CRYPTOBOT_TOKEN, CRYPTOBOT_API_URL, DB_CHANNEL_ID,
-    TON_WALLET, TON_CHECK_TIMEOUT, TON_API_URL
+    TON_WALLET, TON_CHECK_TIMEOUT, TON_API_URL, CRYPTOBOT_INVOICE_TTL, CRYPTOBOT_POLL_INTERVAL, DB_BACKEND, DB_PATH, TINYDB_PATH,
+    WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE,
+    METRICS_HOST, METRICS_PORT, PROFILER_ENABLED, IMPORT_UPLOAD_RATE, IMPORT_WORKERS, BROADCAST_RATE, BROADCAST_WORKERS,
+    STATE_TTL, STATE_CACHE_SIZE, WORKERS, WORKER_THREADS, WORKER_QUEUE_SIZE, BUS_INTERVAL,
+    TON_RATE_URL, TON_RATE_TTL, TON_RATE_MAX_AGE, THROTTLE_RATE, THROTTLE_BURST, THROTTLE_USERS, MAX_PENDING_DEPOSITS,
+    TINYDB_FLUSH_INTERVAL, TINYDB_JOURNAL_SIZE
 )
+import metrics
+from broadcast import Broadcaster, SendQueue
+from bulk_import import BulkImport
+from bus import EventBus
+from catalog import CatalogCache
+from daily_stats import DailyStats
+from fsm import StateMachine, StateStore
+from invoices import InvoiceReconciler
+from ledger import InsufficientFunds, Ledger
+from purchases import Purchases
+from rates import RateService
+from router import CallbackCodec, CallbackRouter
+from search import SearchIndex
+from stock import OutOfStock, Stock
+from storage import open_storage
+from throttle import Throttle
+from ton import TonPoller
 
-bot = telebot.TeleBot(TOKEN)
-db = TinyDB('database.json')
+bot = telebot.TeleBot(TOKEN, use_class_middlewares=True)
+metrics.instrument_telegram(apihelper)
+db = metrics.instrument_storage(open_storage(DB_BACKEND, DB_PATH, TINYDB_PATH, flush_interval=TINYDB_FLUSH_INTERVAL,
+                                                journal_size=TINYDB_JOURNAL_SIZE))
 users = db.table('users')
 products = db.table('products')
 stats = db.table('stats')
 categories = db.table('categories')
 ton_payments = db.table('ton_payments')
+meta = db.table('meta')
+invoices = db.table('invoices')
+broadcasts = db.table('broadcasts')
+# изменения каталога, склада и новые платежи между процессами (WORKERS > 1)
+bus = EventBus(db, BUS_INTERVAL)
+ledger = Ledger(db)
+catalog = CatalogCache(categories, products)
+search_index = SearchIndex(catalog.products())
+
+def stock_changed(product_id):
+    # остатки видны в карточке и в клавиатуре раздела — сбрасываем только их
+    item = catalog.product(product_id)
+    catalog.forget(('item', product_id))
+    if item:
+        catalog.forget(('category', item['category_id']))
+
+stock = Stock(db, ledger, on_change=lambda product_id: bus.publish('stock', product_id=product_id))
+bus.on('stock', stock_changed)
+bus.on('stock', stock.forget, local=False)
+daily_stats = DailyStats(db)
+# история покупок пишется в транзакции списания
+purchases = Purchases(db, catalog.product)
+purchases.backfill(db.table('transactions'))
+ledger.on_apply(purchases.record)
+# коды компактных callback_data; однажды выданный код не меняется
+callbacks = CallbackCodec({
+    'check': 1, 'category': 2, 'item': 3, 'buy': 4, 'confirm': 5,
+    'admin_select_category': 6, 'products_page': 7, 'broadcast_start': 8, 'broadcast_stop': 9,
+    'purchases': 10, 'purchases_newer': 11, 'redeliver': 12,
+})
+router = CallbackRouter(callbacks)
+router.on_timing(metrics.route_hook)
+# шаги диалогов (ввод суммы, мастер товара) — в базе, переживают перезапуск
+states = StateStore(db, STATE_TTL, STATE_CACHE_SIZE)
+fsm = StateMachine(states)
+metrics.REGISTRY.gauge('shopa_states_cached', "Шаги диалогов в кэше", lambda: len(states))
+
+# ---------- разметка ----------
+def main_markup():
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    markup.row(types.KeyboardButton("🏪 Купить"), types.KeyboardButton("📋 Товары"))
+    markup.row(types.KeyboardButton("👤 Профиль"), types.KeyboardButton("💳 Пополнить баланс"))
+    markup.row(types.KeyboardButton("🔍 Поиск"), types.KeyboardButton("🧾 Мои покупки"))
+    return markup
+
+def admin_markup():
+    markup = types.InlineKeyboardMarkup()
+    markup.add(
+        types.InlineKeyboardButton("Добавить товар", callback_data="admin_add"),
+        types.InlineKeyboardButton("Удалить товар", callback_data="admin_delete")
+    )
+    markup.add(
+        types.InlineKeyboardButton("Создать раздел", callback_data="admin_create_category"),
+        types.InlineKeyboardButton("Удалить раздел", callback_data="admin_delete_category")
+    )
+    markup.add(types.InlineKeyboardButton("Статистика", callback_data="admin_stats"),
+               types.InlineKeyboardButton("Рассылка", callback_data="admin_broadcast"))
+    return markup
+
+def topup_markup():
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🤖 USDT (CryptoBot)", callback_data="pay_usdt"))
+    markup.add(types.InlineKeyboardButton("💎 TON (на кошелёк)", callback_data="pay_ton"))
+    return markup
+
+def profile_text(user_id, user):
+    return (
+        "Ваш профиль:\n"
+        f" Ваш ID: <code>{user_id}</code>\n\n"
+        "Информация:\n"
+        f"├ Сумма покупок: <code>{user['total_spent']}$</code>\n"
+        f"└ Сумма пополнений: <code>{user['total_deposited']}$</code>\n\n"
+        f"🏦 Ваш баланс: <code>{user['balance']}$</code>"
+    )
+
+def new_user(user_id):
+    return {
+        'user_id': user_id,
+        'balance': 0,
+        'purchases': 0,
+        'total_spent': 0,
+        'total_deposited': 0,
+        'join_date': datetime.now().strftime('%Y-%m-%d')
+    }
+
+def ton_invoice_text(amount, comment):
+    return (
+        f"➕ Пополнение TON ➕\n\n"
+        f"💰 Сумма: <b>{amount}</b> TON\n"
+        f"📨 Комментарий: <code>{comment}</code>\n"
+        f"💎 Кошелёк: <code>{TON_WALLET}</code>\n\n"
+        f"Отправьте точную сумму на кошелёк с указанным комментарием.\n"
+        f"⚠️ Без комментария платёж не зачтётся.\n"
+        f"⏳ Время на оплату: 30 минут"
+    )
+
+def invoice_markup(invoice):
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🌍 Перейти к оплате", url=invoice['pay_url']))
+    markup.add(types.InlineKeyboardButton("🔄 Проверить оплату", callback_data=callbacks.encode('check', invoice['invoice_id'])))
+    return markup
+
+def catalog_markup(all_categories, route='category'):
+    markup = types.InlineKeyboardMarkup()
+    for i in range(0, len(all_categories), 2):
+        row = []
+        row.append(types.InlineKeyboardButton(all_categories[i]['name'], callback_data=callbacks.encode(route, all_categories[i]['id'])))
+        if i + 1 < len(all_categories):
+            row.append(types.InlineKeyboardButton(all_categories[i+1]['name'], callback_data=callbacks.encode(route, all_categories[i+1]['id'])))
+        markup.add(*row)
+    return markup
+
+def category_markup(items):
+    markup = types.InlineKeyboardMarkup()
+    for i in range(0, len(items), 2):
+        row = []
+        row.append(types.InlineKeyboardButton(item_label(items[i]), callback_data=callbacks.encode('item', items[i]['id'])))
+        if i + 1 < len(items):
+            row.append(types.InlineKeyboardButton(item_label(items[i+1]), callback_data=callbacks.encode('item', items[i+1]['id'])))
+        markup.add(*row)
+    markup.add(types.InlineKeyboardButton("Назад", callback_data="back_to_catalog"))
+    return markup
+
+def item_label(item):
+    if item.get('stocked'):
+        return f"{item['name']} ({stock.available(item['id'])})"
+    return item['name']
+
+def item_text(item):
+    in_stock = f"🗃 В наличии: {stock.available(item['id'])} шт.\n" if item.get('stocked') else ""
+    return (
+        "➖ Покупка ➖\n\n"
+        f"📦 Товар: {item['name']}\n"
+        f"💰 Цена: {item['price']}$\n"
+        f"{in_stock}\n"
+        "Описание:\n"
+        f"{item['description']}"
+    )
+
+def item_markup(item):
+    markup = types.InlineKeyboardMarkup()
+    markup.add(
+        types.InlineKeyboardButton("🛍 Купить", callback_data=callbacks.encode('buy', item['id'])),
+        types.InlineKeyboardButton("Назад", callback_data=callbacks.encode('category', item['category_id'])))
+    return markup
+
+def buy_markup(item_id):
+    markup = types.InlineKeyboardMarkup()
+    markup.add(
+        types.InlineKeyboardButton("Да", callback_data=callbacks.encode('confirm', item_id)),
+        types.InlineKeyboardButton("Отмена", callback_data=callbacks.encode('item', item_id))
+    )
+    return markup
+
+def back_markup(callback_data):
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("Назад", callback_data=callback_data))
+    return markup
+
+def categories_delete_text(all_categories):
+    text = "<b>Список разделов</b>\n\n"
+    for i, category in enumerate(all_categories, 1):
+        text += f"{i}. <b>{category['name']}</b>\n"
+    text += "\n<b>Введите номер раздела, который хотите удалить</b>"
+    return text
+
+def import_report_text(report, limit=20):
+    text = (
+        "<b>📦 Импорт завершён</b>\n\n"
+        f"Строк в манифесте: <code>{report['total']}</code>\n"
+        f"Добавлено товаров: <code>{report['imported']}</code>\n"
+        f"Ошибок: <code>{len(report['failed'])}</code>"
+    )
+    if report['failed']:
+        text += "\n\n" + "\n".join(f"Строка {number}: {html.escape(error)}" for number, error in report['failed'][:limit])
+        if len(report['failed']) > limit:
+            text += "\n…полный список в файле"
+    return text
+
+def search_results(query, limit=10):
+    found = [catalog.product(i) for i in search_index.search(query, limit)]
+    found = [item for item in found if item]
+    if not found:
+        return "🔍 Ничего не найдено. Попробуйте другой запрос", None
+    markup = types.InlineKeyboardMarkup()
+    for item in found:
+        markup.add(types.InlineKeyboardButton(f"{item['name']} | {item['price']}$", callback_data=callbacks.encode('item', item['id'])))
+    return f"🔍 Результаты по запросу «{query}»:", markup
+
+def inline_results(items):
+    username = bot_username()
+    results = []
+    for item in items:
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("🛍 Открыть в боте", url=f"https://t.me/{username}?start=item_{item['id']}"))
+        results.append(types.InlineQueryResultArticle(
+            id=str(item['id']),
+            title=item['name'],
+            description=f"{item['price']}$ · {item['description'][:100]}",
+            input_message_content=types.InputTextMessageContent(item_text(item)),
+            reply_markup=markup))
+    return results
+
+PURCHASES_PAGE = 5
+
+def purchases_view(user_id, before=None, after=None):
+    # новые сначала; курсоры — doc_id крайних покупок на странице
+    if after is not None:
+        rows = purchases.newer(user_id, after, PURCHASES_PAGE + 1)
+        has_newer, has_older = len(rows) > PURCHASES_PAGE, True
+        rows = rows[-PURCHASES_PAGE:]
+    else:
+        rows = purchases.page(user_id, before, PURCHASES_PAGE + 1)
+        has_newer, has_older = before is not None, len(rows) > PURCHASES_PAGE
+        rows = rows[:PURCHASES_PAGE]
+    if not rows:
+        return "🧾 У вас пока нет покупок", None
+    markup = types.InlineKeyboardMarkup()
+    for purchase in rows:
+        markup.add(types.InlineKeyboardButton(f"{purchase['name']} | {purchase['price']}$ | {purchase['day']}",
+                                              callback_data=callbacks.encode('redeliver', purchase['id'])))
+    nav = []
+    if has_newer:
+        nav.append(types.InlineKeyboardButton("⬅️ Новее", callback_data=callbacks.encode('purchases_newer', rows[0].doc_id)))
+    if has_older:
+        nav.append(types.InlineKeyboardButton("Раньше ➡️", callback_data=callbacks.encode('purchases', rows[-1].doc_id)))
+    if nav:
+        markup.row(*nav)
+    return f"🧾 Ваши покупки: {purchases.count(user_id)}\n\nНажмите на покупку, чтобы получить товар ещё раз.", markup
+
+def broadcast_confirm_markup(broadcast_id):
+    markup = types.InlineKeyboardMarkup()
+    markup.add(
+        types.InlineKeyboardButton("🚀 Запустить", callback_data=callbacks.encode('broadcast_start', broadcast_id)),
+        types.InlineKeyboardButton("Отмена", callback_data=callbacks.encode('broadcast_stop', broadcast_id))
+    )
+    return markup
+
+def broadcast_text(broadcast):
+    status = {'running': "⏳ идёт", 'done': "✅ завершена", 'cancelled': "⛔️ остановлена"}.get(broadcast['status'], broadcast['status'])
+    return (
+        f"<b>📣 Рассылка #{broadcast['id']}</b> — {status}\n\n"
+        f"Получателей: <code>{broadcast.get('total', 0)}</code>\n"
+        f"Доставлено: <code>{broadcast['sent']}</code>\n"
+        f"Заблокировали бота: <code>{broadcast['blocked']}</code>\n"
+        f"Ошибок: <code>{broadcast['failed']}</code>"
+    )
+
+def broadcast_markup(broadcast):
+    if broadcast['status'] != 'running':
+        return None
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("⛔️ Остановить", callback_data=callbacks.encode('broadcast_stop', broadcast['id'])))
+    return markup
+
+def products_delete_text(items):
+    text = "<b>Список товаров</b>\n\n"
+    for i, item in enumerate(items, 1):
+        text += f"{i}. <b>{item['name']}</b> | <code>{item['price']}$</code>\n"
+    text += "\n<b>Введите номер товара который хотите удалить</b>"
+    return text
+
+def catalog_view(route='category'):
+    return catalog.memo(('catalog', route), lambda: catalog_markup(catalog.categories(), route))
+
+def category_view(category_id):
+    return catalog.memo(('category', category_id), lambda: category_markup(catalog.category_products(category_id)))
+
+def item_view(item):
+    return catalog.memo(('item', item['id']), lambda: (item_text(item), item_markup(item)))
+
+# ---------- баланс ----------
+DEPOSIT_LIMIT_TEXT = f"❗ У вас уже {MAX_PENDING_DEPOSITS} неоплаченных заявки. Оплатите их или дождитесь окончания срока."
+
+def deposit_limited(user_id, method):
+    # неоплаченные TON-заявки и активные счета Crypto Pay вместе
+    pending = ton_payments.count(user_id=user_id, status='pending') + invoices.count(user_id=user_id, status='active')
+    if pending < MAX_PENDING_DEPOSITS:
+        return False
+    metrics.deposits_refused.inc(method=method)
+    return True
+
+def credit_deposit(user_id, amount, key, **extra):
+    if not ledger.credit(user_id, amount, key, **extra):
+        return False
+    daily_stats.record('payment', amount)
+    return True
+
+# ---------- каталог ----------
+def catalog_changed(added=(), removed=()):
+    # вызывается и для изменений из других процессов — через шину
+    catalog.invalidate()
+    for product_id in removed:
+        search_index.remove(product_id)
+        stock.forget(product_id)
+    for product_id in added:
+        item = catalog.product(product_id)
+        if item:
+            search_index.add(item)
+
+bus.on('catalog', catalog_changed)
+
+def insert_category(name):
+    category_id = (categories.max('id') or 0) + 1
+    categories.insert({'id': category_id, 'name': name})
+    bus.publish('catalog')
+    return category_id
+
+def remove_category(category):
+    removed = [item['id'] for item in catalog.category_products(category['id'])]
+    products.remove(category_id=category['id'])
+    categories.remove(doc_ids=[category.doc_id])
+    bus.publish('catalog', removed=removed)
+
+def insert_product(name, desc, price, file_id, category_id):
+    product_id = (products.max('id') or 0) + 1
+    item = {
+        'id': product_id,
+        'name': name,
+        'description': desc,
+        'price': price,
+        'file_id': file_id,
+        'category_id': category_id
+    }
+    products.insert(item)
+    bus.publish('catalog', added=[product_id])
+    return product_id
+
+def remove_product(item):
+    products.remove(doc_ids=[item.doc_id])
+    stock.discard(item['id'])
+    bus.publish('catalog', removed=[item['id']])
+
+def add_units(product_id, contents):
+    added = stock.add(product_id, contents)
+    if not catalog.product(product_id).get('stocked'):
+        products.update({'stocked': True}, id=product_id)
+        bus.publish('catalog')
+    return added
+
+def resolve_category(value):
+    # в манифесте раздел задаётся id или названием; нового раздела по названию — создаём
+    if value.isdigit():
+        if catalog.category(int(value)):
+            return int(value)
+        raise ValueError(f"нет раздела с id {value}")
+    for category in catalog.categories():
+        if category['name'] == value:
+            return category['id']
+    return insert_category(value)
+
+def insert_products(items):
+    with db.transaction():
+        first_id = (products.max('id') or 0) + 1
+        docs = [{
+            'id': first_id + i,
+            'name': item['name'],
+            'description': item['description'],
+            'price': item['price'],
+            'file_id': item['file_id'],
+            'category_id': item['category_id']
+        } for i, item in enumerate(items)]
+        products.insert_multiple(docs)
+    bus.publish('catalog', added=[doc['id'] for doc in docs])
+
+# ---------- массовый импорт ----------
+def upload_file(filename, data):
+    return bot.send_document(DB_CHANNEL_ID, io.BytesIO(data), visible_file_name=filename).document.file_id
+
+importer = BulkImport(upload_file, insert_products, resolve_category, IMPORT_UPLOAD_RATE, IMPORT_WORKERS)
+
+def run_import(chat_id, message_id, data):
+    def progress(done, total, failed):
+        bot.edit_message_text(f"⏳ Импорт: {done}/{total}, ошибок: {failed}", chat_id, message_id)
+    try:
+        report = importer.run(data, progress)
+    except (ValueError, zipfile.BadZipFile) as e:
+        bot.edit_message_text(f"❌ Импорт не выполнен: {e}", chat_id, message_id)
+        return
+    bot.edit_message_text(import_report_text(report), chat_id, message_id, parse_mode='HTML')
+    if len(report['failed']) > 20:
+        errors = "\n".join(f"{number}\t{error}" for number, error in report['failed'])
+        bot.send_document(chat_id, io.BytesIO(errors.encode('utf-8')), visible_file_name="import_errors.txt")
+
+# ---------- поиск ----------
+SEARCH_PAGE = 50
+username_cache = {}
+
+def bot_username():
+    if 'username' not in username_cache:
+        username_cache['username'] = bot.get_me().username
+    return username_cache['username']
+
+def inline_page(query, offset):
+    # Telegram отдаёт до 50 результатов за ответ, дальше — по next_offset
+    start = int(offset) if offset.isdigit() else 0
+    ids = search_index.search(query, start + SEARCH_PAGE + 1)
+    items = [catalog.product(i) for i in ids[start:start + SEARCH_PAGE]]
+    next_offset = str(start + SEARCH_PAGE) if len(ids) > start + SEARCH_PAGE else ""
+    return [item for item in items if item], next_offset
+
+# ---------- рассылка ----------
+def broadcast_send(chat_id, broadcast):
+    # copyMessage переносит любое сообщение админа: текст, фото, документ
+    return bot.copy_message(chat_id, broadcast['from_chat_id'], broadcast['message_id'])
+
+def broadcast_progress(broadcast):
+    bot.edit_message_text(broadcast_text(broadcast), broadcast['chat_id'], broadcast['status_message_id'],
+                          reply_markup=broadcast_markup(broadcast), parse_mode='HTML')
+
+send_queue = SendQueue(BROADCAST_RATE, workers=BROADCAST_WORKERS)
+broadcaster = Broadcaster(db, send_queue, broadcast_send, broadcast_progress)
+metrics.REGISTRY.gauge('shopa_send_queue_depth', "Сообщения в очереди отправки", send_queue.depth)
 
 # ---------- TON helpers ----------
-def get_ton_transactions():
-    url = TON_API_URL.format(TON_WALLET)
+def ton_usd(amount, rate):
+    return round(amount * rate, 2)
+
+def notify(chat_id, message_id, text):
+    # статус в базе уже записан — ошибка Telegram не должна вернуть счёт или платёж в ожидание
     try:
-        r = requests.get(url, timeout=10)
-        if r.status_code == 200:
-            return r.json().get("transactions", [])
+        bot.edit_message_text(text, chat_id, message_id)
     except Exception as e:
-        print("TON API err:", e)
-    return []
+        print("Ошибка уведомления об оплате:", e)
 
-def find_payment_by_comment(comment, amount):
-    for tx in get_ton_transactions():
-        try:
-            msg = tx.get("in_msg", {})
-            if msg.get("message") == comment:
-                value = int(msg.get("value", 0)) / 1e9   # nanoton → ton
-                if value >= amount * 0.999:
-                    return value
-        except Exception:
-            continue
-    return None
-
-def ton_payment_timer(user_id, comment, amount, chat_id, msg_id):
-    start = time.time()
-    while time.time() - start < TON_CHECK_TIMEOUT:
-        if find_payment_by_comment(comment, amount):
-            user = users.get(Query().user_id == user_id)
-            users.update({
-                'balance': user['balance'] + amount,
-                'total_deposited': user['total_deposited'] + amount
-            }, Query().user_id == user_id)
-            stats.insert({'type': 'payment', 'amount': amount,
-                          'timestamp': datetime.now().strftime('%Y-%m-%d')})
-            bot.edit_message_text("✅ TON платёж найден! Баланс пополнен.", chat_id, msg_id)
-            return
-        time.sleep(30)
-    bot.edit_message_text("❌ Платёж не поступил. Заявка отменена.", chat_id, msg_id)
+def ton_credit(payment, value, rate):
+    # баланс в долларах: TON пересчитываем по курсу цикла поллера и запоминаем курс
+    usd = ton_usd(payment['amount'], rate)
+    credit_deposit(payment['user_id'], usd, f"ton:{payment['comment']}", ton=payment['amount'], rate=rate)
+    ton_payments.update({'status': 'paid', 'rate': rate, 'usd': usd}, comment=payment['comment'])
+    if payment.get('message_id'):
+        notify(payment['chat_id'], payment['message_id'], f"✅ TON платёж найден! Зачислено {usd}$ (курс {rate}$ за TON).")
+
+def ton_expire(payment):
+    ton_payments.update({'status': 'expired'}, comment=payment['comment'])
+    if payment.get('message_id'):
+        notify(payment['chat_id'], payment['message_id'], "❌ Платёж не поступил. Заявка отменена.")
+
+def ton_save_cursor(lt):
+    meta.upsert({'key': 'ton_after_lt', 'value': lt}, key='ton_after_lt')
 
+def ton_save_rate(rate, updated):
+    meta.upsert({'key': 'ton_usd', 'value': rate, 'updated': updated}, key='ton_usd')
+
+# последний курс из базы — запасной, пока провайдер не ответил после перезапуска
+ton_rate = meta.get(key='ton_usd') or {}
+ton_rates = RateService(TON_RATE_URL, TON_RATE_TTL, TON_RATE_MAX_AGE, rate=ton_rate.get('value'),
+                        updated=ton_rate.get('updated'), on_rate=ton_save_rate)
+metrics.REGISTRY.gauge('shopa_ton_usd_rate', "Курс TON/USD в памяти", lambda: ton_rates.get() or 0)
+
+ton_cursor = meta.get(key='ton_after_lt')
+ton_poller = TonPoller(TON_API_URL, TON_WALLET, TON_CHECK_TIMEOUT, ton_credit, ton_expire,
+                       cursor=ton_cursor['value'] if ton_cursor else None, on_cursor=ton_save_cursor,
+                       rate=ton_rates.get)
+metrics.REGISTRY.gauge('shopa_ton_pending', "Ожидающие TON-платежи", lambda: len(ton_poller.pending))
+
+@fsm.step
+@metrics.handler('ton_get_amount')
 def ton_get_amount(message):
     try:
         amount = float(message.text)
         if amount < 0.1:
             raise ValueError("Минимум 0.1 TON")
-        comment = str(uuid.uuid4())[:8]
         user_id = message.from_user.id
-        ton_payments.insert({
+        if deposit_limited(user_id, 'ton'):
+            raise ValueError(DEPOSIT_LIMIT_TEXT)
+        comment = str(uuid.uuid4())[:8]
+        # сначала заявка в базе и у поллера, потом комментарий пользователю
+        payment = {
             'user_id': user_id,
             'amount': amount,
             'comment': comment,
             'status': 'pending',
+            'chat_id': message.chat.id,
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        })
-        text = (
-            f"➕ Пополнение TON ➕\n\n"
-            f"💰 Сумма: <b>{amount}</b> TON\n"
-            f"📨 Комментарий: <code>{comment}</code>\n"
-            f"💎 Кошелёк: <code>{TON_WALLET}</code>\n\n"
-            f"Отправьте точную сумму на кошелёк с указанным комментарием.\n"
-            f"⚠️ Без комментария платёж не зачтётся.\n"
-            f"⏳ Время на оплату: 30 минут"
-        )
-        sent = bot.send_message(message.chat.id, text, parse_mode='HTML')
-        threading.Thread(target=ton_payment_timer,
-                         args=(user_id, comment, amount, message.chat.id, sent.message_id),
-                         daemon=True).start()
+        }
+        ton_payments.insert(payment)
+        bus.publish('ton_payment', payment=payment)
+        sent = bot.send_message(message.chat.id, ton_invoice_text(amount, comment), parse_mode='HTML')
+        attach_ton_message(comment, sent.message_id)
     except ValueError as e:
         bot.send_message(message.chat.id, str(e))
 
+def attach_ton_message(comment, message_id):
+    ton_payments.update({'message_id': message_id}, comment=comment)
+    bus.publish('ton_payment_message', comment=comment, message_id=message_id)
+
+# ---------- Crypto Pay ----------
+CRYPTOBOT_HEADERS = {
+    'Crypto-Pay-API-Token': CRYPTOBOT_TOKEN,
+    'Content-Type': 'application/json'
+}
+
+def invoice_payload(amount, user_id):
+    return {
+        'amount': str(amount),
+        'asset': 'USDT',
+        'description': f'Пополнение баланса пользователя {user_id}',
+        'expires_in': CRYPTOBOT_INVOICE_TTL
+    }
+
+def invoice_result(data):
+    if 'ok' in data and data['ok'] and 'result' in data:
+        return data['result']
+    else:
+        error_msg = data.get('error', 'Неизвестная ошибка')
+        raise Exception(f"Ошибка API Crypto Bot: {error_msg}")
+
+def track_invoice(invoice, amount, user_id):
+    record = {
+        'invoice_id': invoice['invoice_id'],
+        'user_id': user_id,
+        'amount': amount,
+        'status': 'active',
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }
+    invoices.insert(record)
+    bus.publish('invoice', invoice=record)
+    return record
+
+def attach_invoice_message(invoice_id, chat_id, message_id):
+    invoices.update({'chat_id': chat_id, 'message_id': message_id}, invoice_id=invoice_id)
+    bus.publish('invoice_message', invoice_id=invoice_id, chat_id=chat_id, message_id=message_id)
+
+def invoice_paid(invoice, item):
+    credit_deposit(invoice['user_id'], float(item['amount']), f"cryptobot:{invoice['invoice_id']}")
+    invoices.update({'status': 'paid'}, invoice_id=invoice['invoice_id'])
+    if invoice.get('message_id'):
+        notify(invoice['chat_id'], invoice['message_id'], "✅ Оплата успешно завершена!")
+
+def invoice_expired(invoice, item):
+    invoices.update({'status': 'expired'}, invoice_id=invoice['invoice_id'])
+    if invoice.get('message_id'):
+        notify(invoice['chat_id'], invoice['message_id'], "❌ Счёт просрочен. Создайте новый.")
+
+reconciler = InvoiceReconciler(CRYPTOBOT_API_URL, CRYPTOBOT_HEADERS, invoice_paid, invoice_expired,
+                               CRYPTOBOT_INVOICE_TTL, CRYPTOBOT_POLL_INTERVAL)
+metrics.REGISTRY.gauge('shopa_invoices_pending', "Активные счета Crypto Pay", lambda: len(reconciler.pending))
+
+def create_cryptobot_invoice(amount, user_id):
+    try:
+        with metrics.http_timer('cryptopay', 'createInvoice'):
+            response = requests.post(f'{CRYPTOBOT_API_URL}createInvoice', headers=CRYPTOBOT_HEADERS,
+                                     json=invoice_payload(amount, user_id))
+        response.raise_for_status()
+        invoice = invoice_result(response.json())
+    except requests.exceptions.RequestException as e:
+        raise Exception(f"Ошибка соединения с Crypto Bot: {str(e)}")
+    except ValueError as e:
+        raise Exception(f"Ошибка обработки ответа от Crypto Bot: {str(e)}")
+    track_invoice(invoice, amount, user_id)
+    return invoice
+
+def check_invoice(invoice_id, user_id):
+    invoice = invoices.get(invoice_id=invoice_id)
+    if invoice is None:
+        # счёт выставлен до появления таблицы invoices — сверяем один раз
+        items = reconciler.fetch([str(invoice_id)])
+        if not items:
+            return None
+        reconciler.add(track_invoice(items[0], float(items[0]['amount']), user_id))
+        reconciler.handle(items)
+        invoice = invoices.get(invoice_id=invoice_id)
+    return invoice['status']
+
+# ---------- ограничение частоты ----------
+throttle = Throttle(THROTTLE_RATE, THROTTLE_BURST, THROTTLE_USERS)
+metrics.REGISTRY.gauge('shopa_throttle_buckets', "Пользователи в LRU ограничителя", lambda: len(throttle))
+
+def answer_quietly(call, text=None):
+    try:
+        bot.answer_callback_query(call.id, text)
+    except Exception as e:
+        print("Ошибка ответа на callback:", e)
+
+# перед всеми обработчиками сообщений и кнопок: лишнее отбрасывается сразу,
+# повторное нажатие кнопки, пока первое не обработано, схлопывается
+class ThrottleMiddleware(BaseMiddleware):
+    def __init__(self, throttle):
+        self.throttle = throttle
+        self.update_sensitive = True
+        self.update_types = ['message', 'callback_query']
+
+    def pre_process_message(self, message, data):
+        allowed, notify = self.throttle.allow(message.from_user.id)
+        if allowed:
+            return None
+        metrics.throttled.inc(kind='message', action='dropped')
+        if notify:
+            try:
+                bot.send_message(message.chat.id, "⏳ Слишком много сообщений, подождите немного")
+            except Exception as e:
+                print("Ошибка предупреждения о лимите:", e)
+        return CancelUpdate()
+
+    def post_process_message(self, message, data, exception):
+        pass
+
+    def pre_process_callback_query(self, call, data):
+        key = (call.from_user.id, call.data)
+        if not self.throttle.begin(key):
+            metrics.throttled.inc(kind='callback', action='coalesced')
+            answer_quietly(call, "⏳ Уже выполняется")
+            return CancelUpdate()
+        allowed, notify = self.throttle.allow(call.from_user.id)
+        if not allowed:
+            self.throttle.done(key)
+            metrics.throttled.inc(kind='callback', action='dropped')
+            answer_quietly(call, "⏳ Слишком часто, подождите" if notify else None)
+            return CancelUpdate()
+        data['throttle_key'] = key
+        return None
+
+    def post_process_callback_query(self, call, data, exception):
+        self.throttle.done(data['throttle_key'])
+
+bot.setup_middleware(ThrottleMiddleware(throttle))
+
+# ---------- шаги диалогов ----------
+# незавершённый шаг перехватывает любое следующее сообщение чата, как раньше next_step_handler
+@bot.message_handler(func=lambda message: fsm.active(message.chat.id), content_types=util.content_type_media)
+@metrics.handler('step')
+def handle_step(message):
+    fsm.dispatch(message)
+
 # ---------- старый код без изменений ----------
 @bot.message_handler(commands=['start'])
+@metrics.handler('start')
 def start(message):
     user_id = message.from_user.id
-    if not users.get(Query().user_id == user_id):
-        users.insert({
-            'user_id': user_id,
-            'balance': 0,
-            'purchases': 0,
-            'total_spent': 0,
-            'total_deposited': 0,
-            'join_date': datetime.now().strftime('%Y-%m-%d')
-        })
-        stats.insert({'type': 'new_user', 'timestamp': datetime.now().strftime('%Y-%m-%d')})
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    markup.row(types.KeyboardButton("🏪 Купить"), types.KeyboardButton("📋 Товары"))
-    markup.row(types.KeyboardButton("👤 Профиль"), types.KeyboardButton("💳 Пополнить баланс"))
-    bot.send_message(message.chat.id, "<b>Привет! Добро пожаловать в наш магазин!</b>", reply_markup=markup, parse_mode='HTML')
+    user = users.get(user_id=user_id)
+    if not user:
+        users.insert(new_user(user_id))
+        daily_stats.record('new_user')
+    elif user.get('blocked'):
+        # вернулся после блокировки — снова получает рассылки
+        users.update({'blocked': False}, user_id=user_id)
+    bot.send_message(message.chat.id, "<b>Привет! Добро пожаловать в наш магазин!</b>", reply_markup=main_markup(), parse_mode='HTML')
+    # /start item_<id> — переход из inline-поиска
+    payload = message.text.split(maxsplit=1)[1] if len(message.text.split()) > 1 else ""
+    if payload.startswith("item_") and payload[5:].isdigit():
+        item = catalog.product(int(payload[5:]))
+        if item:
+            text, markup = item_view(item)
+            bot.send_message(message.chat.id, text, reply_markup=markup, parse_mode='HTML')
+
+@bot.message_handler(commands=['search'])
+@metrics.handler('search')
+def search_command(message):
+    query = message.text.split(maxsplit=1)[1] if len(message.text.split()) > 1 else ""
+    if query:
+        send_search_results(message.chat.id, query)
+    else:
+        bot.send_message(message.chat.id, "🔍 Введите название или часть описания товара")
+        fsm.set(message.chat.id, search_query)
+
+@bot.inline_handler(func=lambda query: True)
+@metrics.handler('inline')
+def inline_search(query):
+    if not query.query.strip():
+        bot.answer_inline_query(query.id, [], cache_time=30)
+        return
+    items, next_offset = inline_page(query.query, query.offset)
+    bot.answer_inline_query(query.id, inline_results(items), cache_time=30, next_offset=next_offset)
 
 @bot.message_handler(commands=['admin'])
+@metrics.handler('admin')
 def admin_panel(message):
     user_id = message.from_user.id
     if user_id != ADMIN_ID:
         bot.send_message(message.chat.id, "У вас нет доступа к админ-панели")
         return
-    markup = types.InlineKeyboardMarkup()
-    markup.add(
-        types.InlineKeyboardButton("Добавить товар", callback_data="admin_add"),
-        types.InlineKeyboardButton("Удалить товар", callback_data="admin_delete")
-    )
-    markup.add(
-        types.InlineKeyboardButton("Создать раздел", callback_data="admin_create_category"),
-        types.InlineKeyboardButton("Удалить раздел", callback_data="admin_delete_category")
-    )
-    markup.add(types.InlineKeyboardButton("Статистика", callback_data="admin_stats"))
-    bot.send_message(message.chat.id, "Админ меню", reply_markup=markup)
+    bot.send_message(message.chat.id, "Админ меню", reply_markup=admin_markup())
+
+@bot.message_handler(commands=['import'])
+@metrics.handler('import')
+def import_command(message):
+    if message.from_user.id != ADMIN_ID:
+        bot.send_message(message.chat.id, "У вас нет доступа к админ-панели")
+        return
+    bot.send_message(message.chat.id, IMPORT_HELP, parse_mode='HTML')
+    fsm.set(message.chat.id, import_archive)
+
+@bot.message_handler(commands=['stock'])
+@metrics.handler('stock')
+def stock_command(message):
+    if message.from_user.id != ADMIN_ID:
+        bot.send_message(message.chat.id, "У вас нет доступа к админ-панели")
+        return
+    args = message.text.split()
+    item = catalog.product(int(args[1])) if len(args) > 1 and args[1].isdigit() else None
+    if not item:
+        bot.send_message(message.chat.id, "Использование: /stock <id товара>")
+        return
+    bot.send_message(message.chat.id, STOCK_HELP.format(name=item['name']))
+    fsm.set(message.chat.id, stock_units, product_id=item['id'])
 
 @bot.message_handler(content_types=['text'])
+@metrics.handler('text')
 def handle_text(message):
     user_id = message.from_user.id
     chat_id = message.chat.id
     if message.text == "👤 Профиль":
-        user = users.get(Query().user_id == user_id)
+        user = users.get(user_id=user_id)
         if user:
-            text = (
-                "Ваш профиль:\n"
-                f" Ваш ID: <code>{user_id}</code>\n\n"
-                "Информация:\n"
-                f"├ Сумма покупок: <code>{user['total_spent']}$</code>\n"
-                f"└ Сумма пополнений: <code>{user['total_deposited']}$</code>\n\n"
-                f"🏦 Ваш баланс: <code>{user['balance']}$</code>"
-            )
-            bot.send_message(chat_id, text, parse_mode='HTML')
+            bot.send_message(chat_id, profile_text(user_id, user), parse_mode='HTML')
         else:
             bot.send_message(chat_id, "Профиль не найден. Попробуйте перезапустить бота с помощью /start")
     elif message.text == "💳 Пополнить баланс":
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("🤖 USDT (CryptoBot)", callback_data="pay_usdt"))
-        markup.add(types.InlineKeyboardButton("💎 TON (на кошелёк)", callback_data="pay_ton"))
-        bot.send_message(chat_id, "➖ Пополнение баланса ➖\n\nВыберите способ:", reply_markup=markup)
+        bot.send_message(chat_id, "➖ Пополнение баланса ➖\n\nВыберите способ:", reply_markup=topup_markup())
     elif message.text == "🏪 Купить":
-        markup = types.InlineKeyboardMarkup()
-        all_categories = categories.all()
-        for i in range(0, len(all_categories), 2):
-            row = []
-            row.append(types.InlineKeyboardButton(all_categories[i]['name'], callback_data=f"category_{all_categories[i]['id']}"))
-            if i + 1 < len(all_categories):
-                row.append(types.InlineKeyboardButton(all_categories[i+1]['name'], callback_data=f"category_{all_categories[i+1]['id']}"))
-            markup.add(*row)
-        bot.send_message(chat_id, "Каталог", reply_markup=markup)
+        bot.send_message(chat_id, "Каталог", reply_markup=catalog_view())
     elif message.text == "📋 Товары":
         show_products_list(chat_id, 1)
+    elif message.text == "🔍 Поиск":
+        bot.send_message(chat_id, "🔍 Введите название или часть описания товара")
+        fsm.set(chat_id, search_query)
+    elif message.text == "🧾 Мои покупки":
+        text, markup = purchases_view(user_id)
+        bot.send_message(chat_id, text, reply_markup=markup)
+
+@fsm.step
+def search_query(message):
+    if not message.text:
+        bot.send_message(message.chat.id, "Запрос не может быть пустым!")
+        return
+    send_search_results(message.chat.id, message.text)
+
+def send_search_results(chat_id, query):
+    text, markup = search_results(query)
+    bot.send_message(chat_id, text, reply_markup=markup)
 
+STOCK_HELP = (
+    "➖ Пополнение склада: {name} ➖\n\n"
+    "Отправьте ключи/аккаунты текстом или .txt файлом — по одному на строку, "
+    "либо любой другой документ — он станет одной единицей товара."
+)
+
+@fsm.step
+def stock_units(message, product_id):
+    if message.content_type == 'text':
+        contents = [{'text': line.strip()} for line in message.text.splitlines() if line.strip()]
+    elif message.content_type == 'document' and (message.document.file_name or '').lower().endswith('.txt'):
+        data = bot.download_file(bot.get_file(message.document.file_id).file_path).decode('utf-8-sig')
+        contents = [{'text': line.strip()} for line in data.splitlines() if line.strip()]
+    elif message.content_type == 'document':
+        file_msg = bot.send_document(DB_CHANNEL_ID, message.document.file_id)
+        contents = [{'file_id': file_msg.document.file_id}]
+    else:
+        bot.send_message(message.chat.id, "Пожалуйста, отправьте текст или документ!")
+        return
+    if not contents:
+        bot.send_message(message.chat.id, "Не найдено ни одной единицы товара")
+        return
+    add_units(product_id, contents)
+    bot.send_message(message.chat.id, f"Добавлено: {len(contents)}, в наличии: {stock.available(product_id)}")
+
+IMPORT_HELP = (
+    "➖ Массовый импорт ➖\n\n"
+    "Отправьте zip-архив (до 20 МБ) с файлами товаров и <code>manifest.csv</code> "
+    "или <code>manifest.json</code>.\n"
+    "Колонки: <code>name, description, price, category, file</code> — "
+    "раздел по id или названию, file — путь внутри архива."
+)
+
+@fsm.step
+def import_archive(message):
+    if message.content_type != 'document' or not (message.document.file_name or '').lower().endswith('.zip'):
+        bot.send_message(message.chat.id, "Пожалуйста, отправьте zip-архив!")
+        return
+    if message.document.file_size and message.document.file_size > 20 * 1024 * 1024:
+        bot.send_message(message.chat.id, "Архив больше 20 МБ, разбейте его на части")
+        return
+    data = bot.download_file(bot.get_file(message.document.file_id).file_path)
+    status = bot.send_message(message.chat.id, "⏳ Импорт начат")
+    # загрузка тысяч файлов идёт минуты — не держим поток обработки апдейтов
+    threading.Thread(target=run_import, args=(message.chat.id, status.message_id, data), daemon=True).start()
+
+@fsm.step
+def broadcast_message(message):
+    broadcast = broadcaster.create(message.chat.id, message.message_id)
+    bot.send_message(message.chat.id, f"Сообщение выше будет разослано. Пользователей в базе: <code>{users.count()}</code>",
+                     reply_markup=broadcast_confirm_markup(broadcast['id']), parse_mode='HTML')
+
+@fsm.step
+@metrics.handler('process_amount')
 def process_amount(message):
     try:
         amount = float(message.text)
         if not (1 <= amount <= 1500):
             raise ValueError("Сумма должна быть от 1$ до 1500$")
-        markup = types.InlineKeyboardMarkup()
+        if deposit_limited(message.from_user.id, 'cryptobot'):
+            raise ValueError(DEPOSIT_LIMIT_TEXT)
         invoice = create_cryptobot_invoice(amount, message.from_user.id)
-        markup.add(types.InlineKeyboardButton("🌍 Перейти к оплате", url=invoice['pay_url']))
-        markup.add(types.InlineKeyboardButton("🔄 Проверить оплату", callback_data=f"check_{invoice['invoice_id']}"))
-        bot.send_message(message.chat.id, f"➖ Пополнение ➖\n\n💰 Сумма: <code>{amount}$</code>", reply_markup=markup, parse_mode='HTML')
+        sent = bot.send_message(message.chat.id, f"➖ Пополнение ➖\n\n💰 Сумма: <code>{amount}$</code>", reply_markup=invoice_markup(invoice), parse_mode='HTML')
+        attach_invoice_message(invoice['invoice_id'], message.chat.id, sent.message_id)
     except ValueError as e:
         bot.send_message(message.chat.id, str(e))
 
 @bot.callback_query_handler(func=lambda call: True)
 def callback_handler(call):
-    chat_id = call.message.chat.id
-    message_id = call.message.message_id
-    if call.data == "pay_ton":
-        bot.delete_message(chat_id, message_id)
-        msg = bot.send_message(chat_id, "➖ Пополнение TON ➖\n\nВведите сумму (мин. 0.1 TON):")
-        bot.register_next_step_handler(msg, ton_get_amount)
-        return
-    if call.data == "pay_usdt":
-        bot.delete_message(chat_id, message_id)
-        msg = bot.send_message(chat_id, "➖ Пополнение баланса ➖\n\nВведите сумму пополнения, от 1$ до 1500$:")
-        bot.register_next_step_handler(msg, process_amount)
-        return
-    if call.data.startswith("check_"):
-        invoice_id = call.data.split("_")[1]
-        status = check_payment(invoice_id)
-        if status:
-            amount = float(status['amount'])
-            user = users.get(Query().user_id == call.from_user.id)
-            users.update({
-                'balance': user['balance'] + amount,
-                'total_deposited': user['total_deposited'] + amount
-            }, Query().user_id == call.from_user.id)
-            stats.insert({'type': 'payment', 'amount': amount, 'timestamp': datetime.now().strftime('%Y-%m-%d')})
-            bot.edit_message_text("✅ Оплата успешно завершена!", chat_id, message_id)
-        else:
-            bot.answer_callback_query(call.id, "Платеж еще не завершен")
-        return
-    # ---------- остальные callbackи без изменений ----------
-    if call.data.startswith("category_"):
-        category_id = int(call.data.split("_")[1])
-        category = categories.get(Query().id == category_id)
-        if category:
-            bot.delete_message(chat_id, message_id)
-            markup = types.InlineKeyboardMarkup()
-            items = products.search(Query().category_id == category_id)
-            for i in range(0, len(items), 2):
-                row = []
-                row.append(types.InlineKeyboardButton(items[i]['name'], callback_data=f"item_{items[i]['id']}"))
-                if i + 1 < len(items):
-                    row.append(types.InlineKeyboardButton(items[i+1]['name'], callback_data=f"item_{items[i+1]['id']}"))
-                markup.add(*row)
-            markup.add(types.InlineKeyboardButton("Назад", callback_data="back_to_catalog"))
-            bot.send_message(chat_id, f"Каталог: {category['name']}", reply_markup=markup)
-        return
-    if call.data.startswith("item_"):
-        item_id = int(call.data.split("_")[1])
-        item = products.get(Query().id == item_id)
-        if item:
-            bot.delete_message(chat_id, message_id)
-            text = (
-                "➖ Покупка ➖\n\n"
-                f"📦 Товар: {item['name']}\n"
-                f"💰 Цена: {item['price']}$\n\n"
-                "Описание:\n"
-                f"{item['description']}"
-            )
-            markup = types.InlineKeyboardMarkup()
-            markup.add(
-                types.InlineKeyboardButton("🛍 Купить", callback_data=f"buy_{item_id}"),
-                types.InlineKeyboardButton("Назад", callback_data=f"category_{item['category_id']}"))
-            bot.send_message(chat_id, text, reply_markup=markup, parse_mode='HTML')
-        return
-    if call.data == "back_to_catalog":
-        bot.delete_message(chat_id, message_id)
-        markup = types.InlineKeyboardMarkup()
-        all_categories = categories.all()
-        for i in range(0, len(all_categories), 2):
-            row = []
-            row.append(types.InlineKeyboardButton(all_categories[i]['name'], callback_data=f"category_{all_categories[i]['id']}"))
-            if i + 1 < len(all_categories):
-                row.append(types.InlineKeyboardButton(all_categories[i+1]['name'], callback_data=f"category_{all_categories[i+1]['id']}"))
-            markup.add(*row)
-        bot.send_message(chat_id, "Каталог", reply_markup=markup)
+    router.dispatch(call)
+
+@router.route("pay_ton")
+def on_pay_ton(call):
+    if deposit_limited(call.from_user.id, 'ton'):
+        bot.answer_callback_query(call.id, DEPOSIT_LIMIT_TEXT, show_alert=True)
         return
-    if call.data.startswith("buy_"):
-        item_id = int(call.data.split("_")[1])
-        item = products.get(Query().id == item_id)
-        if item:
-            bot.delete_message(chat_id, message_id)
-            markup = types.InlineKeyboardMarkup()
-            markup.add(
-                types.InlineKeyboardButton("Да", callback_data=f"confirm_{item_id}"),
-                types.InlineKeyboardButton("Отмена", callback_data=f"item_{item_id}")
-            )
-            bot.send_message(chat_id, "<b>Вы точно хотите купить этот товар?</b>", reply_markup=markup, parse_mode='HTML')
+    bot.delete_message(call.message.chat.id, call.message.message_id)
+    bot.send_message(call.message.chat.id, "➖ Пополнение TON ➖\n\nВведите сумму (мин. 0.1 TON):")
+    fsm.set(call.message.chat.id, ton_get_amount)
+
+@router.route("pay_usdt")
+def on_pay_usdt(call):
+    if deposit_limited(call.from_user.id, 'cryptobot'):
+        bot.answer_callback_query(call.id, DEPOSIT_LIMIT_TEXT, show_alert=True)
         return
-    if call.data.startswith("confirm_"):
-        item_id = int(call.data.split("_")[1])
-        item = products.get(Query().id == item_id)
-        user_id = call.from_user.id
-        user = users.get(Query().user_id == user_id)
-        if item and user:
-            if user['balance'] >= item['price']:
-                bot.delete_message(chat_id, message_id)
-                users.update({
-                    'balance': user['balance'] - item['price'],
-                    'purchases': user['purchases'] + 1,
-                    'total_spent': user['total_spent'] + item['price']
-                }, Query().user_id == user_id)
-                bot.send_message(chat_id, "⚡️")
-                if 'file_id' in item:
-                    bot.send_document(chat_id, item['file_id'], caption=f"Ваш товар: {item['name']}")
+    bot.delete_message(call.message.chat.id, call.message.message_id)
+    bot.send_message(call.message.chat.id, "➖ Пополнение баланса ➖\n\nВведите сумму пополнения, от 1$ до 1500$:")
+    fsm.set(call.message.chat.id, process_amount)
+
+@router.route("check")
+def on_check(call, invoice_id):
+    chat_id, message_id = call.message.chat.id, call.message.message_id
+    status = check_invoice(invoice_id, call.from_user.id)
+    if status == 'paid':
+        bot.edit_message_text("✅ Оплата успешно завершена!", chat_id, message_id)
+    elif status == 'expired':
+        bot.edit_message_text("❌ Счёт просрочен. Создайте новый.", chat_id, message_id)
+    else:
+        bot.answer_callback_query(call.id, "Платеж еще не завершен")
+
+@router.route("category")
+def on_category(call, category_id):
+    category = catalog.category(category_id)
+    if category:
+        bot.delete_message(call.message.chat.id, call.message.message_id)
+        bot.send_message(call.message.chat.id, f"Каталог: {category['name']}", reply_markup=category_view(category_id))
+
+@router.route("item")
+def on_item(call, item_id):
+    item = catalog.product(item_id)
+    if item:
+        bot.delete_message(call.message.chat.id, call.message.message_id)
+        text, markup = item_view(item)
+        bot.send_message(call.message.chat.id, text, reply_markup=markup, parse_mode='HTML')
+
+@router.route("back_to_catalog")
+def on_back_to_catalog(call):
+    bot.delete_message(call.message.chat.id, call.message.message_id)
+    bot.send_message(call.message.chat.id, "Каталог", reply_markup=catalog_view())
+
+@router.route("buy")
+def on_buy(call, item_id):
+    if catalog.product(item_id):
+        bot.delete_message(call.message.chat.id, call.message.message_id)
+        bot.send_message(call.message.chat.id, "<b>Вы точно хотите купить этот товар?</b>", reply_markup=buy_markup(item_id), parse_mode='HTML')
+
+@router.route("confirm")
+def on_confirm(call, item_id):
+    chat_id, message_id = call.message.chat.id, call.message.message_id
+    item = catalog.product(item_id)
+    user_id = call.from_user.id
+    user = users.get(user_id=user_id)
+    if item and user:
+        key = f"purchase:{chat_id}:{message_id}"
+        try:
+            # повторное нажатие той же кнопки не спишет деньги второй раз
+            if item.get('stocked'):
+                purchase = stock.purchase(user_id, item, key)
             else:
-                bot.edit_message_text("❌ Недостаточно средств на балансе!", chat_id, message_id)
-        return
-    if call.data == "admin_stats":
-        stats_text = get_stats()
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("Назад", callback_data="admin_back"))
-        bot.edit_message_text(stats_text, chat_id, message_id, reply_markup=markup, parse_mode='HTML')
-        return
-    if call.data == "admin_back":
-        markup = types.InlineKeyboardMarkup()
-        markup.add(
-            types.InlineKeyboardButton("Добавить товар", callback_data="admin_add"),
-            types.InlineKeyboardButton("Удалить товар", callback_data="admin_delete")
-        )
-        markup.add(
-            types.InlineKeyboardButton("Создать раздел", callback_data="admin_create_category"),
-            types.InlineKeyboardButton("Удалить раздел", callback_data="admin_delete_category")
-        )
-        markup.add(types.InlineKeyboardButton("Статистика", callback_data="admin_stats"))
-        bot.edit_message_text("Админ меню", chat_id, message_id, reply_markup=markup)
+                purchase = ledger.debit(user_id, item['price'], key, product_id=item_id)
+        except InsufficientFunds:
+            bot.edit_message_text("❌ Недостаточно средств на балансе!", chat_id, message_id)
+            return
+        except OutOfStock:
+            bot.edit_message_text("❌ Товар закончился", chat_id, message_id)
+            return
+        if purchase:
+            bot.delete_message(chat_id, message_id)
+            bot.send_message(chat_id, "⚡️")
+            deliver(chat_id, item, purchase if item.get('stocked') else item)
+
+def deliver(chat_id, item, unit):
+    # unit — проданная единица склада или сам товар с общим file_id
+    if unit.get('file_id'):
+        bot.send_document(chat_id, unit['file_id'], caption=f"Ваш товар: {item['name']}")
+    elif unit.get('text'):
+        bot.send_message(chat_id, f"Ваш товар: {html.escape(item['name'])}\n\n<code>{html.escape(unit['text'])}</code>", parse_mode='HTML')
+
+@router.route("purchases")
+def on_purchases(call, before):
+    text, markup = purchases_view(call.from_user.id, before=before)
+    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+
+@router.route("purchases_newer")
+def on_purchases_newer(call, after):
+    text, markup = purchases_view(call.from_user.id, after=after)
+    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+
+@router.route("redeliver")
+def on_redeliver(call, purchase_id):
+    purchase = purchases.get(purchase_id)
+    if not purchase or purchase['user_id'] != call.from_user.id:
+        bot.answer_callback_query(call.id, "Покупка не найдена")
         return
-    if call.data == "admin_add":
-        markup = types.InlineKeyboardMarkup()
-        all_categories = categories.all()
-        for i in range(0, len(all_categories), 2):
-            row = []
-            row.append(types.InlineKeyboardButton(all_categories[i]['name'], callback_data=f"admin_select_category_{all_categories[i]['id']}"))
-            if i + 1 < len(all_categories):
-                row.append(types.InlineKeyboardButton(all_categories[i+1]['name'], callback_data=f"admin_select_category_{all_categories[i+1]['id']}"))
-            markup.add(*row)
-        bot.send_message(chat_id, "Выберите раздел для создания товара", reply_markup=markup)
+    if not (purchase.get('file_id') or purchase.get('text')):
+        bot.answer_callback_query(call.id, "Товар больше недоступен")
         return
-    if call.data == "admin_create_category":
-        bot.delete_message(chat_id, message_id)
-        msg = bot.send_message(chat_id, "Введите название раздела")
-        bot.register_next_step_handler(msg, create_category)
+    bot.answer_callback_query(call.id)
+    deliver(call.message.chat.id, purchase, purchase)
+
+@router.route("admin_stats")
+def on_admin_stats(call):
+    bot.edit_message_text(get_stats(), call.message.chat.id, call.message.message_id, reply_markup=back_markup("admin_back"), parse_mode='HTML')
+
+@router.route("admin_back")
+def on_admin_back(call):
+    bot.edit_message_text("Админ меню", call.message.chat.id, call.message.message_id, reply_markup=admin_markup())
+
+@router.route("admin_add")
+def on_admin_add(call):
+    bot.send_message(call.message.chat.id, "Выберите раздел для создания товара", reply_markup=catalog_view('admin_select_category'))
+
+@router.route("admin_create_category")
+def on_admin_create_category(call):
+    bot.delete_message(call.message.chat.id, call.message.message_id)
+    bot.send_message(call.message.chat.id, "Введите название раздела")
+    fsm.set(call.message.chat.id, create_category)
+
+@router.route("admin_delete_category")
+def on_admin_delete_category(call):
+    show_categories_to_delete(call.message.chat.id)
+
+@router.route("admin_delete")
+def on_admin_delete(call):
+    show_products_to_delete(call.message.chat.id)
+
+@router.route("admin_broadcast")
+def on_admin_broadcast(call):
+    if call.from_user.id != ADMIN_ID:
         return
-    if call.data == "admin_delete_category":
-        show_categories_to_delete(chat_id)
+    bot.send_message(call.message.chat.id, "Отправьте сообщение для рассылки (текст, фото или файл)")
+    fsm.set(call.message.chat.id, broadcast_message)
+
+@router.route("broadcast_start")
+def on_broadcast_start(call, broadcast_id):
+    if call.from_user.id != ADMIN_ID:
         return
-    if call.data == "admin_delete":
-        show_products_to_delete(chat_id)
+    if broadcaster.start(broadcast_id, chat_id=call.message.chat.id, status_message_id=call.message.message_id):
+        broadcast_progress(broadcasts.get(id=broadcast_id))
+    else:
+        bot.answer_callback_query(call.id, "Рассылка уже запущена или отменена")
+
+@router.route("broadcast_stop")
+def on_broadcast_stop(call, broadcast_id):
+    if call.from_user.id != ADMIN_ID:
         return
-    if call.data.startswith("admin_select_category_"):
-        category_id = int(call.data.split("_")[3])
-        bot.delete_message(chat_id, message_id)
-        msg = bot.send_message(chat_id, "Введите название товара")
-        bot.register_next_step_handler(msg, lambda m: add_product_name(m, category_id))
+    if not broadcaster.stop(broadcast_id):
         return
-    if call.data.startswith("products_page_"):
-        page = int(call.data.split("_")[2])
-        bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=update_products_list(chat_id, page), reply_markup=update_pagination(page), parse_mode='HTML')
+    broadcast = broadcasts.get(id=broadcast_id)
+    if broadcast.get('status_message_id'):
+        bot.answer_callback_query(call.id, "Рассылка остановится после текущей пачки")
+    else:
+        bot.edit_message_text("Рассылка отменена", call.message.chat.id, call.message.message_id)
+
+@router.route("admin_select_category")
+def on_admin_select_category(call, category_id):
+    bot.delete_message(call.message.chat.id, call.message.message_id)
+    bot.send_message(call.message.chat.id, "Введите название товара")
+    fsm.set(call.message.chat.id, add_product_name, category_id=category_id)
+
+@router.route("products_page", legacy=lambda rest: parse_page_data(rest))
+def on_products_page(call, page, after=None, before=None):
+    text, markup = products_page(page, after, before)
+    bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id, text=text, reply_markup=markup, parse_mode='HTML')
 
 # ---------- остальные функции без изменений ----------
+@fsm.step
 def create_category(message):
     if not message.text:
         bot.send_message(message.chat.id, "Название раздела не может быть пустым!")
         return
-    name = message.text
-    category_id = len(categories) + 1
-    categories.insert({'id': category_id, 'name': name})
+    insert_category(message.text)
     bot.send_message(message.chat.id, "Раздел создан")
 
 def show_categories_to_delete(chat_id):
@@ -348,178 +1036,149 @@ def show_categories_to_delete(chat_id):
     if not all_categories:
         bot.send_message(chat_id, "Разделов пока нет")
         return
-    text = "<b>Список разделов</b>\n\n"
-    for i, category in enumerate(all_categories, 1):
-        text += f"{i}. <b>{category['name']}</b>\n"
-    text += "\n<b>Введите номер раздела, который хотите удалить</b>"
-    msg = bot.send_message(chat_id, text, parse_mode='HTML')
-    bot.register_next_step_handler(msg, delete_category)
+    bot.send_message(chat_id, categories_delete_text(all_categories), parse_mode='HTML')
+    fsm.set(chat_id, delete_category)
 
+@fsm.step
 def delete_category(message):
     try:
         num = int(message.text) - 1
         all_categories = categories.all()
         if 0 <= num < len(all_categories):
-            category_id = all_categories[num]['id']
-            products.remove(Query().category_id == category_id)
-            categories.remove(doc_ids=[all_categories[num].doc_id])
+            remove_category(all_categories[num])
             bot.send_message(message.chat.id, "Раздел удален!")
         else:
             bot.send_message(message.chat.id, "Неверный номер раздела!")
     except ValueError:
         bot.send_message(message.chat.id, "Введите корректный номер!")
 
-def create_cryptobot_invoice(amount, user_id):
-    headers = {
-        'Crypto-Pay-API-Token': CRYPTOBOT_TOKEN,
-        'Content-Type': 'application/json'
-    }
-    payload = {
-        'amount': str(amount),
-        'asset': 'USDT',
-        'description': f'Пополнение баланса пользователя {user_id}'
-    }
-    try:
-        response = requests.post(f'{CRYPTOBOT_API_URL}createInvoice', headers=headers, json=payload)
-        response.raise_for_status()
-        data = response.json()
-        if 'ok' in data and data['ok'] and 'result' in data:
-            return data['result']
-        else:
-            error_msg = data.get('error', 'Неизвестная ошибка')
-            raise Exception(f"Ошибка API Crypto Bot: {error_msg}")
-    except requests.exceptions.RequestException as e:
-        raise Exception(f"Ошибка соединения с Crypto Bot: {str(e)}")
-    except ValueError as e:
-        raise Exception(f"Ошибка обработки ответа от Crypto Bot: {str(e)}")
-
-def check_payment(invoice_id):
-    headers = {
-        'Crypto-Pay-API-Token': CRYPTOBOT_TOKEN,
-        'Content-Type': 'application/json'
-    }
-    try:
-        response = requests.get(f'{CRYPTOBOT_API_URL}getInvoices?invoice_ids={invoice_id}', headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        if data['ok'] and 'result' in data and data['result']['items']:
-            return data['result']['items'][0] if data['result']['items'][0]['status'] == 'paid' else False
-        return False
-    except Exception as e:
-        return False
-
 def get_stats():
-    Stat = Query()
-    today = datetime.now().strftime('%Y-%m-%d')
-    week_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
-    users_day = len(stats.search((Stat.type == 'new_user') & (Stat.timestamp >= today)))
-    users_week = len(stats.search((Stat.type == 'new_user') & (Stat.timestamp >= week_ago)))
-    users_total = len(stats.search(Stat.type == 'new_user'))
-    payments_day = len(stats.search((Stat.type == 'payment') & (Stat.timestamp >= today)))
-    payments_week = len(stats.search((Stat.type == 'payment') & (Stat.timestamp >= week_ago)))
-    payments_total = len(stats.search(Stat.type == 'payment'))
+    s = daily_stats.summary()
     return (
         "<b>📊 Статистика:</b>\n\n"
         "<b>👤 Юзеры:</b>\n"
-        f"За день: <code>{users_day}</code>\n"
-        f"За неделю: <code>{users_week}</code>\n"
-        f"За Всё время: <code>{users_total}</code>\n\n"
+        f"За день: <code>{s['users_day']}</code>\n"
+        f"За неделю: <code>{s['users_week']}</code>\n"
+        f"За Всё время: <code>{s['users_total']}</code>\n\n"
         "<b>💰Пополнения:</b>\n"
-        f"Пополнений за День: <code>{payments_day}</code>\n"
-        f"Пополнений за Неделю: <code>{payments_week}</code>\n"
-        f"Пополнений за Все время: <code>{payments_total}</code>"
+        f"Пополнений за День: <code>{s['payments_day']}</code>\n"
+        f"Пополнений за Неделю: <code>{s['payments_week']}</code>\n"
+        f"Пополнений за Все время: <code>{s['payments_total']}</code>\n\n"
+        + revenue_text(purchases.summary())
+    )
+
+def revenue_text(r):
+    name = lambda source, ref: html.escape((source(ref) or {}).get('name', f"#{ref}"))
+    text = (
+        "<b>💵 Выручка:</b>\n"
+        f"За день: <code>{r['day'][1]}$</code> ({r['day'][0]} шт.)\n"
+        f"За неделю: <code>{r['week'][1]}$</code> ({r['week'][0]} шт.)\n"
+        f"За Всё время: <code>{r['total'][1]}$</code> ({r['total'][0]} шт.)"
     )
+    if r['products']:
+        text += "\n\n<b>Топ товаров:</b>\n" + "\n".join(
+            f"{name(catalog.product, ref)} — <code>{total}$</code> ({count} шт.)" for ref, count, total in r['products'])
+    if r['categories']:
+        text += "\n\n<b>Топ разделов:</b>\n" + "\n".join(
+            f"{name(catalog.category, ref)} — <code>{total}$</code> ({count} шт.)" for ref, count, total in r['categories'])
+    return text
 
+@fsm.step
 def add_product_name(message, category_id):
     if not message.text:
         bot.send_message(message.chat.id, "Название не может быть пустым!")
         return
     name = message.text
     bot.delete_message(message.chat.id, message.message_id - 1)
-    msg = bot.send_message(message.chat.id, "Введите описание товара")
-    bot.register_next_step_handler(msg, lambda m: add_product_desc(m, name, category_id))
+    bot.send_message(message.chat.id, "Введите описание товара")
+    fsm.set(message.chat.id, add_product_desc, name=name, category_id=category_id)
 
+@fsm.step
 def add_product_desc(message, name, category_id):
     if not message.text:
         bot.send_message(message.chat.id, "Описание не может быть пустым!")
         return
     desc = message.text
     bot.delete_message(message.chat.id, message.message_id - 1)
-    msg = bot.send_message(message.chat.id, "Введите цену товара")
-    bot.register_next_step_handler(msg, lambda m: add_product_price(m, name, desc, category_id))
+    bot.send_message(message.chat.id, "Введите цену товара")
+    fsm.set(message.chat.id, add_product_price, name=name, desc=desc, category_id=category_id)
 
+@fsm.step
 def add_product_price(message, name, desc, category_id):
     try:
         price = float(message.text)
         if price <= 0:
             raise ValueError("Цена должна быть положительной")
         bot.delete_message(message.chat.id, message.message_id - 1)
-        msg = bot.send_message(message.chat.id, "Отправьте файл который будет отправляться после покупки")
-        bot.register_next_step_handler(msg, lambda m: add_product_file(m, name, desc, price, category_id))
+        bot.send_message(message.chat.id, "Отправьте файл который будет отправляться после покупки")
+        fsm.set(message.chat.id, add_product_file, name=name, desc=desc, price=price, category_id=category_id)
     except ValueError:
         bot.send_message(message.chat.id, "Введите корректную положительную цену!")
 
+@fsm.step
 def add_product_file(message, name, desc, price, category_id):
     if message.content_type == 'document':
         file_msg = bot.send_document(DB_CHANNEL_ID, message.document.file_id)
         file_id = file_msg.document.file_id
         bot.delete_message(message.chat.id, message.message_id - 1)
-        product_id = len(products) + 1
-        products.insert({
-            'id': product_id,
-            'name': name,
-            'description': desc,
-            'price': price,
-            'file_id': file_id,
-            'category_id': category_id
-        })
+        insert_product(name, desc, price, file_id, category_id)
         bot.send_message(message.chat.id, "Товар создан")
     else:
         bot.send_message(message.chat.id, "Пожалуйста, отправьте документ!")
 
-def update_products_list(chat_id, page):
-    items = products.all()
-    total_items = len(items)
-    items_per_page = 32
-    total_pages = (total_items + items_per_page - 1) // items_per_page
-    if total_pages == 0:
+PRODUCTS_PER_PAGE = 32
+
+def update_products_list(items):
+    if not items:
         return "Товаров пока нет"
-    if page < 1:
-        page = 1
-    if page > total_pages:
-        page = total_pages
-    start_idx = (page - 1) * items_per_page
-    end_idx = min(start_idx + items_per_page, total_items)
     text = ""
-    for item in items[start_idx:end_idx]:
+    for item in items:
         text += f"<b>{item['name']}</b> | <code>{item['price']}$</code>\n"
     return text
 
-def update_pagination(page):
-    items = products.all()
-    total_items = len(items)
-    items_per_page = 32
-    total_pages = (total_items + items_per_page - 1) // items_per_page
+def update_pagination(page, total_pages, items):
     if total_pages <= 1:
         return None
+    # курсор в callback_data (страница, after, before): начинаем после/заканчиваем перед этим id
+    prev_data = callbacks.encode('products_page', page - 1, None, items[0]['id'])
+    next_data = callbacks.encode('products_page', page + 1, items[-1]['id'], None)
     markup = types.InlineKeyboardMarkup()
     row = []
     if page == 1 and total_pages > 1:
         row.append(types.InlineKeyboardButton(f"{page}/{total_pages}", callback_data="noop"))
-        row.append(types.InlineKeyboardButton("Вперед ▶️", callback_data=f"products_page_{page+1}"))
+        row.append(types.InlineKeyboardButton("Вперед ▶️", callback_data=next_data))
     elif page == total_pages and total_pages > 1:
-        row.append(types.InlineKeyboardButton("Назад ◀️", callback_data=f"products_page_{page-1}"))
+        row.append(types.InlineKeyboardButton("Назад ◀️", callback_data=prev_data))
         row.append(types.InlineKeyboardButton(f"{page}/{total_pages}", callback_data="noop"))
     else:
-        row.append(types.InlineKeyboardButton("Назад ◀️", callback_data=f"products_page_{page-1}"))
+        row.append(types.InlineKeyboardButton("Назад ◀️", callback_data=prev_data))
         row.append(types.InlineKeyboardButton(f"{page}/{total_pages}", callback_data="noop"))
-        row.append(types.InlineKeyboardButton("Вперед ▶️", callback_data=f"products_page_{page+1}"))
+        row.append(types.InlineKeyboardButton("Вперед ▶️", callback_data=next_data))
     markup.add(*row)
     return markup
 
+def products_page(page=1, after=None, before=None):
+    start = catalog.page_start(PRODUCTS_PER_PAGE, page, after, before)
+
+    def build():
+        items = catalog.product_page(start, PRODUCTS_PER_PAGE)
+        total_pages = (catalog.product_count() + PRODUCTS_PER_PAGE - 1) // PRODUCTS_PER_PAGE
+        current = min(start // PRODUCTS_PER_PAGE + 1, total_pages)
+        return update_products_list(items), update_pagination(current, total_pages, items)
+    return catalog.memo(('page', start), build)
+
+def parse_page_data(rest):
+    # старые кнопки products_page_<номер>[_a<id>|_b<id>], в том числе без курсора
+    parts = rest.split("_")
+    page, after, before = int(parts[0]), None, None
+    if len(parts) > 1 and parts[1][:1] == 'a':
+        after = int(parts[1][1:])
+    elif len(parts) > 1 and parts[1][:1] == 'b':
+        before = int(parts[1][1:])
+    return page, after, before
+
 def show_products_list(chat_id, page):
-    text = update_products_list(chat_id, page)
-    markup = update_pagination(page)
+    text, markup = products_page(page)
     bot.send_message(chat_id, text, reply_markup=markup, parse_mode='HTML')
 
 def show_products_to_delete(chat_id):
@@ -527,27 +1186,85 @@ def show_products_to_delete(chat_id):
     if not items:
         bot.send_message(chat_id, "Товаров пока нет")
         return
-    text = "<b>Список товаров</b>\n\n"
-    for i, item in enumerate(items, 1):
-        text += f"{i}. <b>{item['name']}</b> | <code>{item['price']}$</code>\n"
-    text += "\n<b>Введите номер товара который хотите удалить</b>"
-    msg = bot.send_message(chat_id, text, parse_mode='HTML')
-    bot.register_next_step_handler(msg, delete_product)
+    bot.send_message(chat_id, products_delete_text(items), parse_mode='HTML')
+    fsm.set(chat_id, delete_product)
 
+@fsm.step
 def delete_product(message):
     try:
         num = int(message.text) - 1
         items = products.all()
         if 0 <= num < len(items):
-            products.remove(doc_ids=[items[num].doc_id])
+            remove_product(items[num])
             bot.send_message(message.chat.id, "Товар удален!")
         else:
             bot.send_message(message.chat.id, "Неверный номер товара!")
     except ValueError:
         bot.send_message(message.chat.id, "Введите корректный номер!")
 
+# ---------- несколько процессов ----------
+def watch_payments():
+    # новые платежи из любого процесса ждут поллеры там, где они запущены
+    bus.on('ton_payment', ton_poller.add)
+    bus.on('ton_payment_message', ton_poller.update)
+    bus.on('invoice', reconciler.add)
+    bus.on('invoice_message', reconciler.update)
+
+def start_services():
+    watch_payments()
+    ton_rates.start()
+    ton_poller.load(ton_payments.search(status='pending'))
+    ton_poller.start()
+    reconciler.load(invoices.search(status='active'))
+    reconciler.start()
+    states.purge()
+    stock.recover()
+    broadcaster.resume()
+
+def worker_init(index):
+    # процесс-обработчик: только апдейты, поллеры и рассылки остаются в родителе
+    bot.threaded = False
+    bus.start()
+    if METRICS_PORT:
+        metrics.MetricsServer(METRICS_HOST, METRICS_PORT + 1 + index).start()
+
+def handle_update(data):
+    bot.process_new_updates([types.Update.de_json(data)])
+
+def run_workers():
+    if DB_BACKEND != 'sqlite':
+        raise ValueError("WORKERS > 1 работает только с DB_BACKEND = 'sqlite'")
+    from cluster import WorkerPool
+    bus.start()
+    pool = WorkerPool(handle_update, WORKERS, WORKER_THREADS, WORKER_QUEUE_SIZE, init=worker_init)
+    pool.start()
+    metrics.REGISTRY.gauge('shopa_worker_queue_depth', "Апдейты в очереди процесса", pool.depth, label='worker')
+    metrics.REGISTRY.gauge('shopa_workers_alive', "Живые процессы-обработчики", pool.alive)
+    if WEBHOOK_URL:
+        from webhook import WebhookServer
+        server = WebhookServer(bot, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, dispatch=pool.submit)
+        server.serve_forever(WEBHOOK_URL)
+    else:
+        pool.poll(TOKEN)
+
 if __name__ == "__main__":
     try:
-        bot.polling(none_stop=True)
+        if METRICS_PORT:
+            metrics_server = metrics.MetricsServer(METRICS_HOST, METRICS_PORT)
+            metrics_server.start()
+            if PROFILER_ENABLED:
+                metrics_server.profiler.start()
+        start_services()
+        if WORKERS > 1:
+            run_workers()
+        elif WEBHOOK_URL:
+            from webhook import WebhookServer
+            server = WebhookServer(bot, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET,
+                                   WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+            metrics.REGISTRY.gauge('shopa_webhook_queue_depth', "Апдейты в очереди воркера",
+                                   lambda: dict(enumerate(q.qsize() for q in server.queues)), label='worker')
+            server.serve_forever(WEBHOOK_URL)
+        else:
+            bot.polling(none_stop=True)
     except Exception as e:
         print(f"Ошибка при запуске бота: {str(e)}")
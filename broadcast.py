@@ -0,0 +1,192 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+
+from telebot.apihelper import ApiTelegramException
+
+from ratelimit import RateLimiter, retry_after
+
+
+def is_blocked(error):
+    # бот заблокирован, аккаунт удалён или чат больше недоступен
+    if not isinstance(error, ApiTelegramException):
+        return False
+    return error.error_code == 403 or (error.error_code == 400 and 'chat not found' in error.description.lower())
+
+
+# Очередь исходящих сообщений: общий темп на весь бот (global_rate в секунду)
+# и не чаще одного сообщения в chat_interval на чат. На 429 все воркеры
+# ждут retry_after и повторяют тот же вызов.
+class SendQueue:
+    def __init__(self, global_rate=25, chat_interval=1.0, workers=8, queue_size=1000, retries=5):
+        self.limiter = RateLimiter(global_rate, burst=workers)
+        self.chat_interval = chat_interval
+        self.workers = workers
+        self.retries = retries
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.chat_next = {}
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.work, name=f'send-{i}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, chat_id, func, *args):
+        self.start()
+        future = Future()
+        self.queue.put((chat_id, func, args, future))
+        return future
+
+    def work(self):
+        while True:
+            chat_id, func, args, future = self.queue.get()
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(self.call(chat_id, func, args))
+                    except Exception as e:
+                        future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    def call(self, chat_id, func, args):
+        for _ in range(self.retries):
+            self.wait_chat(chat_id)
+            self.limiter.acquire()
+            try:
+                return func(*args)
+            except Exception as e:
+                wait = retry_after(e)
+                if wait is None:
+                    raise
+                self.limiter.pause(wait)
+        raise RuntimeError("превышено число повторов после 429")
+
+    def wait_chat(self, chat_id):
+        with self.lock:
+            now = time.monotonic()
+            ready = self.chat_next.get(chat_id, 0)
+            self.chat_next[chat_id] = max(now, ready) + self.chat_interval
+            if len(self.chat_next) > 10000:
+                self.chat_next = {c: t for c, t in self.chat_next.items() if t > now}
+        if ready > now:
+            time.sleep(ready - now)
+
+    def depth(self):
+        return self.queue.qsize()
+
+
+# Рассылка по таблице users: пользователи читаются страницами по doc_id,
+# после каждой страницы курсор и счётчики пишутся в broadcasts, так что
+# после перезапуска resume() продолжает с последней сохранённой страницы.
+# Заблокировавшие бота помечаются blocked и дальше пропускаются.
+class Broadcaster:
+    def __init__(self, storage, send_queue, send, on_progress=None, page_size=200, progress_interval=5):
+        self.storage = storage
+        self.users = storage.table('users')
+        self.broadcasts = storage.table('broadcasts')
+        self.queue = send_queue
+        self.send = send
+        self.on_progress = on_progress
+        self.page_size = page_size
+        self.progress_interval = progress_interval
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def create(self, from_chat_id, message_id):
+        with self.storage.transaction():
+            broadcast = {
+                'id': (self.broadcasts.max('id') or 0) + 1,
+                'from_chat_id': from_chat_id,
+                'message_id': message_id,
+                'status': 'draft',
+                'cursor': 0,
+                'sent': 0,
+                'failed': 0,
+                'blocked': 0,
+                'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            }
+            self.broadcasts.insert(broadcast)
+        return broadcast
+
+    def start(self, broadcast_id, **fields):
+        fields.update(status='running', total=self.users.count())
+        if not self.broadcasts.update(fields, id=broadcast_id, status='draft'):
+            return False
+        self.spawn(self.broadcasts.get(id=broadcast_id))
+        return True
+
+    def stop(self, broadcast_id):
+        # черновик отменяется сразу, запущенная рассылка — после текущей страницы
+        with self.storage.transaction():
+            return bool(self.broadcasts.update({'status': 'cancelled'}, id=broadcast_id, status='running')
+                        or self.broadcasts.update({'status': 'cancelled'}, id=broadcast_id, status='draft'))
+
+    def resume(self):
+        for broadcast in self.broadcasts.search(status='running'):
+            self.spawn(broadcast)
+
+    def spawn(self, broadcast):
+        with self.lock:
+            thread = self.threads.get(broadcast['id'])
+            if thread and thread.is_alive():
+                return
+            thread = threading.Thread(target=self.run, args=(broadcast,), name=f"broadcast-{broadcast['id']}", daemon=True)
+            self.threads[broadcast['id']] = thread
+        thread.start()
+
+    def run(self, broadcast):
+        try:
+            self.deliver(broadcast)
+        except Exception as e:
+            print("Ошибка рассылки:", e)
+
+    def deliver(self, broadcast):
+        broadcast_id = broadcast['id']
+        cursor = broadcast['cursor']
+        counters = {name: broadcast[name] for name in ('sent', 'failed', 'blocked')}
+        reported = time.monotonic()
+        while True:
+            current = self.broadcasts.get(id=broadcast_id)
+            if not current or current['status'] != 'running':
+                self.progress(current)
+                return
+            page = self.users.page(cursor, self.page_size)
+            if not page:
+                break
+            futures = [(user, self.queue.submit(user['user_id'], self.send, user['user_id'], broadcast))
+                       for user in page if not user.get('blocked')]
+            for user, future in futures:
+                try:
+                    future.result()
+                    counters['sent'] += 1
+                except Exception as e:
+                    if is_blocked(e):
+                        counters['blocked'] += 1
+                        self.users.update({'blocked': True}, user_id=user['user_id'])
+                    else:
+                        counters['failed'] += 1
+                        print("Ошибка рассылки:", user['user_id'], e)
+            cursor = page[-1].doc_id
+            self.broadcasts.update({'cursor': cursor, **counters}, id=broadcast_id)
+            if time.monotonic() - reported >= self.progress_interval:
+                reported = time.monotonic()
+                self.progress({**current, 'cursor': cursor, **counters})
+        self.broadcasts.update({'status': 'done', 'finished': datetime.now().strftime('%Y-%m-%d %H:%M:%S')},
+                               id=broadcast_id, status='running')
+        self.progress(self.broadcasts.get(id=broadcast_id))
+
+    def progress(self, broadcast):
+        if broadcast and self.on_progress:
+            try:
+                self.on_progress(broadcast)
+            except Exception as e:
+                print("Ошибка прогресса рассылки:", e)
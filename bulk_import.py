@@ -0,0 +1,140 @@
+import csv
+import io
+import json
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from ratelimit import RateLimiter, retry_after
+
+MANIFESTS = ('manifest.csv', 'manifest.json')
+
+
+def parse_manifest(name, data):
+    # CSV с заголовком или JSON-список; колонки: name, description, price, category, file
+    text = data.decode('utf-8-sig')
+    if name.endswith('.json'):
+        rows = json.loads(text)
+        if isinstance(rows, dict):
+            rows = rows.get('products', [])
+        if not isinstance(rows, list):
+            raise ValueError("manifest.json должен быть списком товаров")
+        return rows
+    return list(csv.DictReader(io.StringIO(text)))
+
+def check_row(row, files):
+    if not isinstance(row, dict):
+        return None, "строка не является объектом"
+    name = str(row.get('name') or '').strip()
+    description = str(row.get('description') or '').strip()
+    path = str(row.get('file') or '').strip()
+    category = str(row.get('category') or '').strip()
+    if not name:
+        return None, "пустое название"
+    if not description:
+        return None, "пустое описание"
+    if not category:
+        return None, "не указан раздел"
+    try:
+        price = float(row.get('price'))
+    except (TypeError, ValueError):
+        return None, f"неверная цена: {row.get('price')}"
+    if price <= 0:
+        return None, f"неверная цена: {row.get('price')}"
+    if path not in files:
+        return None, f"нет файла в архиве: {path or '—'}"
+    return {'name': name, 'description': description, 'price': price, 'category': category, 'file': path}, None
+
+
+# Массовый импорт товаров из zip: манифест + файлы. Файлы грузятся в канал
+# хранения несколькими потоками через общий RateLimiter (на 429 все ждут
+# retry_after), товары записываются одной пачкой в конце.
+class BulkImport:
+    def __init__(self, upload, save, resolve_category, rate=1.0, workers=4, retries=5, progress_interval=3):
+        self.upload = upload
+        self.save = save
+        self.resolve_category = resolve_category
+        self.limiter = RateLimiter(rate, burst=workers)
+        self.workers = workers
+        self.retries = retries
+        self.progress_interval = progress_interval
+
+    def read_archive(self, archive):
+        files = {info.filename: info for info in archive.infolist() if not info.is_dir()}
+        for name in MANIFESTS:
+            if name in files:
+                files.pop(name)
+                return parse_manifest(name, archive.read(name)), files
+        raise ValueError("в архиве нет manifest.csv или manifest.json")
+
+    def upload_file(self, archive, path):
+        data = archive.read(path)
+        filename = path.rsplit('/', 1)[-1]
+        for attempt in range(self.retries):
+            self.limiter.acquire()
+            try:
+                return self.upload(filename, data)
+            except Exception as e:
+                wait = retry_after(e)
+                if wait is not None:
+                    self.limiter.pause(wait)
+                elif isinstance(e, requests.exceptions.RequestException) and attempt + 1 < self.retries:
+                    time.sleep(2 ** attempt)
+                else:
+                    raise
+        raise RuntimeError("превышено число попыток загрузки")
+
+    def run(self, data, on_progress=None):
+        report = {'total': 0, 'imported': 0, 'failed': []}
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            rows, files = self.read_archive(archive)
+            report['total'] = len(rows)
+            items = []
+            for number, row in enumerate(rows, 1):
+                item, error = check_row(row, files)
+                if item:
+                    try:
+                        item['category_id'] = self.resolve_category(item.pop('category'))
+                    except ValueError as e:
+                        item, error = None, str(e)
+                if item:
+                    items.append((number, item))
+                else:
+                    report['failed'].append((number, error))
+
+            lock = threading.Lock()
+            state = {'done': len(report['failed']), 'reported': 0.0}
+
+            def work(entry):
+                number, item = entry
+                try:
+                    item['file_id'] = self.upload_file(archive, item.pop('file'))
+                    error = None
+                except Exception as e:
+                    error = f"загрузка не удалась: {e}"
+                with lock:
+                    state['done'] += 1
+                    if error:
+                        report['failed'].append((number, error))
+                    now = time.monotonic()
+                    due = now - state['reported'] >= self.progress_interval
+                    if due:
+                        state['reported'] = now
+                    done, failed = state['done'], len(report['failed'])
+                if due and on_progress:
+                    try:
+                        on_progress(done, report['total'], failed)
+                    except Exception as e:
+                        print("Ошибка прогресса импорта:", e)
+                return None if error else item
+
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='import') as pool:
+                uploaded = [item for item in pool.map(work, items) if item]
+        if uploaded:
+            self.save(uploaded)
+        report['imported'] = len(uploaded)
+        report['failed'].sort()
+        return report
@@ -0,0 +1,76 @@
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+
+# Шина событий между процессами поверх общей базы (таблица events).
+# publish() сразу вызывает обработчики своего процесса и, если шина запущена,
+# пишет событие в таблицу; поток start() читает новые строки по doc_id и
+# вызывает обработчики для событий других процессов. Старше keep — удаляются.
+class EventBus:
+    def __init__(self, storage, interval=0.5, keep=600, prune_interval=60):
+        self.events = storage.table('events')
+        self.interval = interval
+        self.keep = keep
+        self.prune_interval = prune_interval
+        self.origin = uuid.uuid4().hex
+        self.handlers = defaultdict(list)
+        self.cursor = 0
+        # события до этого момента уже учтены при загрузке каталога из базы
+        self.since = time.time()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def on(self, kind, handler, local=True):
+        # local=False — только события других процессов (своё состояние уже обновлено)
+        self.handlers[kind].append((handler, local))
+        return handler
+
+    def publish(self, kind, **data):
+        if self.thread is not None:
+            self.events.insert({'kind': kind, 'origin': self.origin, 'data': data, 'time': time.time()})
+        self.deliver(kind, data, local=True)
+
+    def deliver(self, kind, data, local):
+        for handler, for_local in self.handlers.get(kind, ()):
+            if local and not for_local:
+                continue
+            try:
+                handler(**data)
+            except Exception as e:
+                print("Ошибка обработчика события:", kind, e)
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='event-bus', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        pruned = time.monotonic()
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.poll()
+                if time.monotonic() - pruned >= self.prune_interval:
+                    pruned = time.monotonic()
+                    self.prune()
+            except Exception as e:
+                print("Ошибка шины событий:", e)
+
+    def poll(self):
+        while True:
+            page = self.events.page(self.cursor, 200)
+            if not page:
+                return
+            self.cursor = page[-1].doc_id
+            for event in page:
+                if event['origin'] != self.origin and event['time'] >= self.since:
+                    self.deliver(event['kind'], event['data'], local=False)
+
+    def prune(self):
+        return self.events.remove(time__lt=time.time() - self.keep)
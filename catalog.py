@@ -0,0 +1,84 @@
+import threading
+from bisect import bisect_left, bisect_right
+
+
+# Снимок каталога в памяти: разделы, товары по id и по разделам, плюс
+# собранные клавиатуры и карточки. Хранилище читается только при сбросе
+# (создание/удаление раздела или товара), просмотр каталога идёт из памяти.
+class CatalogCache:
+    def __init__(self, categories, products):
+        self.categories_table = categories
+        self.products_table = products
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.version = 0
+        self.load()
+
+    def load(self):
+        with self.load_lock:
+            all_categories = self.categories_table.all()
+            all_products = self.products_table.all()
+            by_category = {}
+            for item in all_products:
+                by_category.setdefault(item['category_id'], []).append(item)
+            with self.lock:
+                self.version += 1
+                self.category_list = all_categories
+                self.category_by_id = {c['id']: c for c in all_categories}
+                self.product_list = all_products
+                self.product_by_id = {p['id']: p for p in all_products}
+                self.product_ids = sorted(self.product_by_id)
+                self.products_by_category = by_category
+                self.built = {}
+
+    def invalidate(self):
+        self.load()
+
+    def categories(self):
+        return self.category_list
+
+    def category(self, category_id):
+        return self.category_by_id.get(category_id)
+
+    def products(self):
+        return self.product_list
+
+    def product(self, product_id):
+        return self.product_by_id.get(product_id)
+
+    def category_products(self, category_id):
+        return self.products_by_category.get(category_id, [])
+
+    def product_count(self):
+        return len(self.product_ids)
+
+    def page_start(self, page_size, page=1, after=None, before=None):
+        # курсор after/before — id соседнего товара, номер страницы — запасной вариант
+        ids = self.product_ids
+        if after is not None:
+            start = bisect_right(ids, after)
+        elif before is not None:
+            start = max(bisect_left(ids, before) - page_size, 0)
+        else:
+            start = (max(page, 1) - 1) * page_size
+        last_start = max(len(ids) - 1, 0) // page_size * page_size
+        return min(start, last_start)
+
+    def product_page(self, start, page_size):
+        return [self.product_by_id[i] for i in self.product_ids[start:start + page_size]]
+
+    def forget(self, key):
+        with self.lock:
+            self.built.pop(key, None)
+
+    def memo(self, key, build):
+        with self.lock:
+            if key in self.built:
+                return self.built[key]
+            version = self.version
+        value = build()
+        with self.lock:
+            # за время сборки каталог могли сбросить — старое не кладём
+            if version == self.version:
+                self.built[key] = value
+        return value
@@ -0,0 +1,88 @@
+import multiprocessing
+import queue
+import threading
+import time
+
+from telebot import apihelper
+
+
+def update_key(data):
+    # то же, что webhook.update_chat_id, но по сырому JSON — родитель апдейт не разбирает
+    for kind in ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+                 'pre_checkout_query', 'shipping_query', 'my_chat_member', 'chat_member'):
+        event = data.get(kind)
+        if not event:
+            continue
+        chat = event.get('chat') or (event.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        if event.get('from'):
+            return event['from']['id']
+    return data.get('update_id', 0)
+
+def serve(source, handle, init, index, workers, threads):
+    # процесс-обработчик: свои потоки, апдейты одного чата — в одном потоке по порядку
+    if init:
+        init(index)
+    lanes = [queue.Queue(maxsize=100) for _ in range(threads)]
+
+    def drain(lane):
+        while True:
+            data = lane.get()
+            try:
+                handle(data)
+            except Exception as e:
+                print("Ошибка обработки апдейта:", e)
+
+    for i, lane in enumerate(lanes):
+        threading.Thread(target=drain, args=(lane,), name=f'update-{i}', daemon=True).start()
+    while True:
+        data = source.get()
+        # остаток по workers у всех ключей процесса одинаковый — делим на него
+        lanes[update_key(data) // workers % threads].put(data)
+
+
+# Несколько процессов-обработчиков: родитель принимает апдейты (long polling
+# или вебхук) и раскладывает сырой JSON по очередям процессов по chat_id,
+# поэтому апдейты одного пользователя идут в один процесс и по порядку.
+# Процессы запускаются через spawn и заново импортируют модуль бота.
+class WorkerPool:
+    def __init__(self, handle, workers=4, threads=4, queue_size=1000, init=None, put_timeout=1):
+        context = multiprocessing.get_context('spawn')
+        self.put_timeout = put_timeout
+        self.queues = [context.Queue(queue_size) for _ in range(workers)]
+        self.processes = [context.Process(target=serve, args=(q, handle, init, i, workers, threads),
+                                          name=f'shopa-worker-{i}', daemon=True)
+                          for i, q in enumerate(self.queues)]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def submit(self, data, block=False):
+        # block=False — для вебхука: полная очередь -> 503, Telegram повторит позже
+        worker_queue = self.queues[update_key(data) % len(self.queues)]
+        try:
+            worker_queue.put(data, timeout=None if block else self.put_timeout)
+        except queue.Full:
+            return False
+        return True
+
+    def depth(self):
+        return {i: q.qsize() for i, q in enumerate(self.queues)}
+
+    def alive(self):
+        return sum(process.is_alive() for process in self.processes)
+
+    def poll(self, token, timeout=20):
+        offset = None
+        while True:
+            try:
+                updates = apihelper.get_updates(token, offset, 100, timeout, None, timeout)
+            except Exception as e:
+                print("Ошибка получения апдейтов:", e)
+                time.sleep(3)
+                continue
+            for data in updates:
+                offset = data['update_id'] + 1
+                self.submit(data, block=True)
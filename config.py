@@ -16,3 +16,47 @@ TON_API_URL = "https://tonapi.io/v2/blockchain/accounts/{}/transactions"
 # ссылки 1 - testnet ; 2 - crypto bot
 # 1 - https://testnet-pay.crypt.bot/api/
 # 2 - https://pay.crypt.bot/api/
+
+DB_BACKEND = "sqlite"   # sqlite или tinydb
+DB_PATH = "database.sqlite3"
+TINYDB_PATH = "database.json"   # старая база, при первом запуске sqlite переносится автоматически
+
+WEBHOOK_URL = ""   # https://домен — включает вебхук вместо long polling
+WEBHOOK_HOST = "127.0.0.1"
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = ""   # секрет для заголовка X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_WORKERS = 8
+WEBHOOK_QUEUE_SIZE = 1000   # на одного воркера
+
+CRYPTOBOT_INVOICE_TTL = 60 * 60   # срок жизни счёта Crypto Pay, сек
+CRYPTOBOT_POLL_INTERVAL = 15   # как часто сверять активные счета, сек
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100   # /metrics для Prometheus, 0 — выключить
+PROFILER_ENABLED = False   # сэмплирующий профайлер с запуска; иначе GET /profile/start
+
+IMPORT_UPLOAD_RATE = 1   # файлов в секунду в DB_CHANNEL_ID при массовом импорте
+IMPORT_WORKERS = 4
+
+BROADCAST_RATE = 25   # сообщений в секунду на весь бот (лимит Telegram ~30)
+BROADCAST_WORKERS = 8
+
+STATE_TTL = 6 * 60 * 60   # сколько живёт незавершённый шаг диалога, сек
+STATE_CACHE_SIZE = 10000   # чатов в LRU-кэше шагов
+
+WORKERS = 1   # процессов-обработчиков апдейтов; больше 1 — только с DB_BACKEND = "sqlite"
+WORKER_THREADS = 4   # потоков в каждом процессе
+WORKER_QUEUE_SIZE = 1000   # апдейтов в очереди одного процесса
+BUS_INTERVAL = 0.5   # как часто процессы читают события друг друга, сек
+
+TON_RATE_URL = "https://tonapi.io/v2/rates"   # курс TON/USD для зачисления TON-пополнений в долларах
+TON_RATE_TTL = 60   # как часто обновлять курс, сек
+TON_RATE_MAX_AGE = 6 * 60 * 60   # старше — курс не используется, зачисление ждёт
+
+THROTTLE_RATE = 1   # сообщений и нажатий в секунду на пользователя
+THROTTLE_BURST = 5   # сколько можно отправить подряд
+THROTTLE_USERS = 10000   # пользователей в памяти ограничителя (LRU)
+MAX_PENDING_DEPOSITS = 3   # неоплаченных заявок на пополнение у одного пользователя
+TINYDB_FLUSH_INTERVAL = 30   # раз в сколько секунд писать снимок database.json (DB_BACKEND = "tinydb")
+TINYDB_JOURNAL_SIZE = 4 * 1024 * 1024   # снимок раньше, если журнал вырос до стольких байт
@@ -0,0 +1,80 @@
+from collections import Counter
+from datetime import datetime, timedelta
+
+from storage import DuplicateKeyError
+
+TOTAL = 'total'
+
+
+# Счётчики по дням: каждая запись в stats сразу увеличивает строку своего
+# дня и итоговую строку в stats_daily, так что «за день / неделю / всё
+# время» читается из нескольких строк, а не сканом всей stats.
+class DailyStats:
+    def __init__(self, storage):
+        self.storage = storage
+        self.stats = storage.table('stats')
+        self.daily = storage.table('stats_daily')
+        self.meta = storage.table('meta')
+        self.backfill()
+
+    def bump(self, day, deltas):
+        if self.daily.increment(deltas, day=day):
+            return
+        try:
+            self.daily.insert({'day': day, **deltas})
+        except DuplicateKeyError:
+            self.daily.increment(deltas, day=day)
+
+    def record(self, kind, amount=None):
+        day = datetime.now().strftime('%Y-%m-%d')
+        if kind == 'payment':
+            row = {'type': kind, 'amount': amount, 'timestamp': day}
+            deltas = {'payments': 1, 'payments_sum': amount}
+        else:
+            row = {'type': kind, 'timestamp': day}
+            deltas = {'new_users': 1}
+        with self.storage.transaction():
+            self.stats.insert(row)
+            self.bump(day, deltas)
+            self.bump(TOTAL, deltas)
+
+    def backfill(self):
+        # один раз пересчитываем корзины из уже накопленных строк stats
+        if self.meta.get(key='stats_backfilled'):
+            return
+        with self.storage.transaction():
+            if self.meta.get(key='stats_backfilled'):
+                return
+            buckets = {}
+            for row in self.stats.all():
+                deltas = buckets.setdefault(row['timestamp'][:10], Counter())
+                if row['type'] == 'payment':
+                    deltas['payments'] += 1
+                    deltas['payments_sum'] += row.get('amount') or 0
+                elif row['type'] == 'new_user':
+                    deltas['new_users'] += 1
+            total = Counter()
+            for deltas in buckets.values():
+                total.update(deltas)
+            buckets[TOTAL] = total
+            self.daily.remove()
+            self.daily.insert_multiple([{'day': day, **deltas} for day, deltas in buckets.items()])
+            self.meta.insert({'key': 'stats_backfilled', 'value': True})
+
+    def summary(self):
+        now = datetime.now()
+        today = now.strftime('%Y-%m-%d')
+        week_ago = (now - timedelta(days=7)).strftime('%Y-%m-%d')
+        day = self.daily.get(day=today) or {}
+        week = Counter()
+        for row in self.daily.search(day__gte=week_ago, day__lte=today):
+            week.update({k: v for k, v in row.items() if k != 'day'})
+        total = self.daily.get(day=TOTAL) or {}
+        return {
+            'users_day': day.get('new_users', 0),
+            'users_week': week['new_users'],
+            'users_total': total.get('new_users', 0),
+            'payments_day': day.get('payments', 0),
+            'payments_week': week['payments'],
+            'payments_total': total.get('payments', 0),
+        }
@@ -0,0 +1,140 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+
+# Состояния диалогов в таблице states: одна строка на чат — имя шага и его
+# данные (только JSON-значения, без замыканий). Строки старше ttl считаются
+# истёкшими и чистятся purge(). Перед базой стоит LRU-кэш на capacity чатов;
+# запись кэша (в том числе «шага нет») верна recheck секунд, потом читается
+# заново — так виден шаг, записанный или снятый другим процессом.
+class StateStore:
+    def __init__(self, storage, ttl=6 * 3600, capacity=10000, recheck=5, purge_every=1000):
+        self.table = storage.table('states')
+        self.ttl = ttl
+        self.capacity = capacity
+        self.recheck = recheck
+        self.purge_every = purge_every
+        self.cache = OrderedDict()
+        self.writes = 0
+        self.lock = threading.Lock()
+
+    def remember(self, chat_id, state):
+        with self.lock:
+            self.cache[chat_id] = (state, time.time())
+            self.cache.move_to_end(chat_id)
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+
+    def cached(self, chat_id):
+        with self.lock:
+            entry = self.cache.get(chat_id)
+            if entry is not None:
+                self.cache.move_to_end(chat_id)
+            return entry
+
+    def peek(self, chat_id):
+        # (найдено, состояние) только по кэшу, без базы
+        entry = self.cached(chat_id)
+        if entry is None:
+            return False, None
+        state, cached_at = entry
+        now = time.time()
+        if now - cached_at < self.recheck and (state is None or now - state['updated'] < self.ttl):
+            return True, state
+        return False, None
+
+    def get(self, chat_id):
+        found, state = self.peek(chat_id)
+        if found:
+            return state
+        now = time.time()
+        state = self.table.get(chat_id=chat_id)
+        if state is not None and now - state['updated'] >= self.ttl:
+            self.table.remove(chat_id=chat_id, updated=state['updated'])
+            state = None
+        self.remember(chat_id, state)
+        return state
+
+    def set(self, chat_id, name, data):
+        state = {'chat_id': chat_id, 'state': name, 'data': data, 'updated': time.time()}
+        self.table.upsert(state, chat_id=chat_id)
+        self.remember(chat_id, state)
+        self.writes += 1
+        if self.writes % self.purge_every == 0:
+            self.purge()
+
+    def pop(self, chat_id):
+        # шаг одноразовый: забирает тот, чьё удаление прошло
+        state = self.get(chat_id)
+        if state is None:
+            return None
+        removed = self.table.remove(chat_id=chat_id, updated=state['updated'])
+        self.remember(chat_id, None)
+        return state if removed else None
+
+    def clear(self, chat_id):
+        self.table.remove(chat_id=chat_id)
+        self.remember(chat_id, None)
+
+    def purge(self):
+        return self.table.remove(updated__lt=time.time() - self.ttl)
+
+    def __len__(self):
+        return len(self.cache)
+
+
+# Шаги диалога регистрируются по имени функции (@fsm.step), в базе хранится
+# только имя и именованные аргументы. Sync- и async-бот держат свои
+# StateMachine над общим StateStore, имена шагов у них совпадают.
+class StateMachine:
+    def __init__(self, store):
+        self.store = store
+        self.steps = {}
+
+    def step(self, func):
+        self.steps[func.__name__] = func
+        return func
+
+    def set(self, chat_id, step, **data):
+        name = step if isinstance(step, str) else step.__name__
+        if name not in self.steps:
+            raise KeyError(f"неизвестный шаг: {name}")
+        self.store.set(chat_id, name, data)
+
+    def active(self, chat_id):
+        state = self.store.get(chat_id)
+        return state is not None and state['state'] in self.steps
+
+    async def aactive(self, chat_id):
+        # фильтр для AsyncTeleBot: при промахе кэша база читается в пуле потоков, не в loop
+        found, state = self.store.peek(chat_id)
+        if not found:
+            loop = asyncio.get_running_loop()
+            state = await loop.run_in_executor(None, self.store.get, chat_id)
+        return state is not None and state['state'] in self.steps
+
+    def clear(self, chat_id):
+        self.store.clear(chat_id)
+
+    def take(self, chat_id):
+        state = self.store.pop(chat_id)
+        if state is None or state['state'] not in self.steps:
+            return None, None
+        return self.steps[state['state']], state['data']
+
+    def dispatch(self, message):
+        step, data = self.take(message.chat.id)
+        if step is None:
+            return False
+        step(message, **data)
+        return True
+
+    async def adispatch(self, message):
+        loop = asyncio.get_running_loop()
+        step, data = await loop.run_in_executor(None, self.take, message.chat.id)
+        if step is None:
+            return False
+        await step(message, **data)
+        return True
@@ -0,0 +1,157 @@
+import threading
+import time
+
+import requests
+
+import metrics
+from ton import parse_timestamp
+
+
+# Сверка счетов Crypto Pay: все активные счета опрашиваются пачками
+# (много invoice_ids в одном getInvoices) по расписанию, оплаченные
+# зачисляются один раз, просроченные закрываются. Счёт снимается со сверки
+# только после успешного колбэка. Кнопка «Проверить оплату» смотрит только
+# на локальный статус.
+class InvoiceReconciler:
+    def __init__(self, api_url, headers, on_paid, on_expired, ttl, interval=15, batch_size=100, grace=300):
+        self.url = f'{api_url}getInvoices'
+        self.headers = headers
+        self.on_paid = on_paid
+        self.on_expired = on_expired
+        self.ttl = ttl
+        self.interval = interval
+        self.batch_size = batch_size
+        self.grace = grace
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def add(self, invoice):
+        with self.lock:
+            self.pending[str(invoice['invoice_id'])] = invoice
+
+    def update(self, invoice_id, **fields):
+        with self.lock:
+            invoice = self.pending.get(str(invoice_id))
+            if invoice is not None:
+                invoice.update(fields)
+
+    def load(self, invoices):
+        for invoice in invoices:
+            self.add(invoice)
+
+    def batches(self):
+        with self.lock:
+            ids = list(self.pending)
+        return [ids[i:i + self.batch_size] for i in range(0, len(ids), self.batch_size)]
+
+    def batch_params(self, ids):
+        return {'invoice_ids': ','.join(ids), 'count': len(ids)}
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='invoice-reconciler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                print("Crypto Pay reconcile err:", e)
+            self.stop_event.wait(self.interval)
+
+    def poll(self):
+        for ids in self.batches():
+            self.handle(self.fetch(ids))
+        self.expire()
+
+    def fetch(self, ids):
+        try:
+            with metrics.http_timer('cryptopay', 'getInvoices'):
+                r = requests.get(self.url, headers=self.headers, params=self.batch_params(ids), timeout=10)
+                data = r.json()
+            if data.get('ok'):
+                return data['result']['items']
+            print("Crypto Pay API err:", data.get('error'))
+        except Exception as e:
+            print("Crypto Pay API err:", e)
+        return []
+
+    async def afetch(self, session, ids):
+        try:
+            with metrics.http_timer('cryptopay', 'getInvoices'):
+                async with session.get(self.url, params=self.batch_params(ids)) as r:
+                    data = await r.json()
+            if data.get('ok'):
+                return data['result']['items']
+            print("Crypto Pay API err:", data.get('error'))
+        except Exception as e:
+            print("Crypto Pay API err:", e)
+        return []
+
+    def handle(self, items):
+        for invoice, item, callback in self.settled(items):
+            try:
+                callback(invoice, item)
+            except Exception as e:
+                print("Crypto Pay invoice err:", e)
+                continue
+            self.done(invoice)
+
+    async def ahandle(self, items):
+        # то же для asyncio: колбэки — корутины, ждём их здесь
+        for invoice, item, callback in self.settled(items):
+            try:
+                await callback(invoice, item)
+            except Exception as e:
+                print("Crypto Pay invoice err:", e)
+                continue
+            self.done(invoice)
+
+    def settled(self, items):
+        # счёт остаётся в pending, пока колбэк не прошёл — при ошибке сверим его снова
+        found = []
+        for item in items:
+            if item.get('status') not in ('paid', 'expired'):
+                continue
+            with self.lock:
+                invoice = self.pending.get(str(item['invoice_id']))
+            if invoice is not None:
+                found.append((invoice, item, self.on_paid if item['status'] == 'paid' else self.on_expired))
+        return found
+
+    def done(self, invoice):
+        with self.lock:
+            self.pending.pop(str(invoice['invoice_id']), None)
+
+    def overdue(self):
+        # счёт создаётся с expires_in=ttl; если API так и не ответило — закрываем сами
+        now = time.time()
+        with self.lock:
+            return [inv for inv in self.pending.values()
+                    if now - parse_timestamp(inv['timestamp']) >= self.ttl + self.grace]
+
+    def expire(self):
+        for invoice in self.overdue():
+            try:
+                self.on_expired(invoice, None)
+            except Exception as e:
+                print("Crypto Pay invoice err:", e)
+                continue
+            self.done(invoice)
+
+    async def aexpire(self):
+        for invoice in self.overdue():
+            try:
+                await self.on_expired(invoice, None)
+            except Exception as e:
+                print("Crypto Pay invoice err:", e)
+                continue
+            self.done(invoice)
@@ -0,0 +1,73 @@
+import threading
+from datetime import datetime
+
+
+class InsufficientFunds(Exception):
+    pass
+
+
+# Все изменения баланса идут через журнал transactions: запись с ключом
+# идемпотентности (invoice_id, TON-комментарий, id покупки) и CAS-обновление
+# баланса в одной транзакции хранилища; если запись в transactions или хук
+# падает, транзакция откатывается целиком на обоих бэкендах. Потоки одного
+# пользователя сериализуются своим локом, разные пользователи друг другу
+# не мешают — это важно только для SQLite: в TinyStorage все записи и так
+# идут под одним замком хранилища, и полосатые локи там ничего не дают.
+class Ledger:
+    def __init__(self, storage, stripes=256):
+        self.storage = storage
+        self.users = storage.table('users')
+        self.transactions = storage.table('transactions')
+        self.locks = [threading.Lock() for _ in range(stripes)]
+        self.hooks = []
+
+    def on_apply(self, hook):
+        # hook(tx) вызывается внутри той же транзакции, что и списание/зачисление
+        self.hooks.append(hook)
+
+    def lock(self, user_id):
+        return self.locks[hash(user_id) % len(self.locks)]
+
+    def credit(self, user_id, amount, key, kind='deposit', **extra):
+        return self.apply(user_id, amount, key, kind, {'total_deposited': amount}, extra)
+
+    def debit(self, user_id, amount, key, kind='purchase', **extra):
+        return self.apply(user_id, -amount, key, kind, {'purchases': 1, 'total_spent': amount}, extra)
+
+    def apply(self, user_id, delta, key, kind, counters, extra):
+        with self.lock(user_id):
+            if self.transactions.get(key=key):
+                return None
+            while True:
+                user = self.users.get(user_id=user_id)
+                if user is None:
+                    raise LookupError(f"Пользователь {user_id} не найден")
+                balance = user['balance']
+                if balance + delta < 0:
+                    raise InsufficientFunds()
+                fields = {'balance': round(balance + delta, 8)}
+                for field, value in counters.items():
+                    fields[field] = round(user.get(field, 0) + value, 8)
+                with self.storage.transaction():
+                    if self.transactions.get(key=key):
+                        return None
+                    # баланс мог измениться в другом процессе — перечитываем
+                    if not self.users.update(fields, user_id=user_id, balance=balance):
+                        continue
+                    tx = {
+                        'key': key,
+                        'user_id': user_id,
+                        'kind': kind,
+                        'amount': delta,
+                        'balance_before': balance,
+                        'balance_after': fields['balance'],
+                        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                        **extra
+                    }
+                    self.transactions.insert(tx)
+                    for hook in self.hooks:
+                        hook(tx)
+                    return tx
+
+    def history(self, user_id):
+        return self.transactions.search(user_id=user_id)
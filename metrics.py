@@ -0,0 +1,324 @@
+import functools
+import inspect
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def label_text(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"')) for n, v in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, '') for n in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, label_text(self.labels, key), value) for key, value in self.values.items()]
+
+
+class Gauge:
+    kind = 'gauge'
+
+    # значение снимается в момент выдачи /metrics: func() -> число или {метка: число}
+    def __init__(self, name, help, func, label=None):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.label = label
+
+    def samples(self):
+        try:
+            value = self.func()
+        except Exception:
+            return []
+        if isinstance(value, dict):
+            return [(self.name, label_text((self.label,), (k,)), v) for k, v in value.items()]
+        return [(self.name, '', value)]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, '') for n in self.labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+            counts[1] += 1
+            counts[2] += value
+
+    def samples(self):
+        out = []
+        with self.lock:
+            for key, (buckets, count, total) in self.values.items():
+                for bound, n in zip(self.buckets, buckets):
+                    out.append((self.name + '_bucket', label_text(self.labels + ('le',), key + (bound,)), n))
+                out.append((self.name + '_bucket', label_text(self.labels + ('le',), key + ('+Inf',)), count))
+                out.append((self.name + '_count', label_text(self.labels, key), count))
+                out.append((self.name + '_sum', label_text(self.labels, key), total))
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, func, label=None):
+        return self.register(Gauge(name, help, func, label))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+handler_seconds = REGISTRY.histogram('shopa_handler_seconds', "Время обработки апдейта", ('handler',))
+handler_errors = REGISTRY.counter('shopa_handler_errors_total', "Исключения в обработчиках", ('handler',))
+storage_seconds = REGISTRY.histogram('shopa_storage_seconds', "Время операций хранилища", ('table', 'op'))
+storage_errors = REGISTRY.counter('shopa_storage_errors_total', "Ошибки операций хранилища", ('table', 'op'))
+http_seconds = REGISTRY.histogram('shopa_http_seconds', "Время исходящих HTTP-запросов", ('service', 'method'))
+http_errors = REGISTRY.counter('shopa_http_errors_total', "Ошибки исходящих HTTP-запросов", ('service', 'method'))
+throttled = REGISTRY.counter('shopa_throttled_total', "Отброшенные и схлопнутые апдейты", ('kind', 'action'))
+deposits_refused = REGISTRY.counter('shopa_deposits_refused_total', "Отказы в новой заявке на пополнение", ('method',))
+
+
+@contextmanager
+def timer(histogram, errors, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        errors.inc(**labels)
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - started, **labels)
+
+
+def http_timer(service, method):
+    return timer(http_seconds, http_errors, service=service, method=method)
+
+
+def handler(name):
+    # декоратор ставится под @bot.message_handler, чтобы зарегистрировалась обёртка
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with timer(handler_seconds, handler_errors, handler=name):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with timer(handler_seconds, handler_errors, handler=name):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def route_hook(name, elapsed, error):
+    # хук для CallbackRouter.on_timing
+    handler_seconds.observe(elapsed, handler='callback:' + name)
+    if error is not None:
+        handler_errors.inc(handler='callback:' + name)
+
+
+# Таблица с замером каждой операции; остальные атрибуты прозрачно
+# пробрасываются к настоящей таблице.
+class TimedTable:
+    OPS = ('get', 'search', 'all', 'page', 'page_before', 'top', 'count', 'max', 'insert', 'insert_multiple',
+           'update', 'upsert', 'increment', 'remove')
+
+    def __init__(self, table, name):
+        self.table = table
+        self.name = name
+        for op in self.OPS:
+            if hasattr(table, op):
+                setattr(self, op, self.wrap(op, getattr(table, op)))
+
+    def wrap(self, op, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            with timer(storage_seconds, storage_errors, table=self.name, op=op):
+                return method(*args, **kwargs)
+        return wrapper
+
+    def __len__(self):
+        with timer(storage_seconds, storage_errors, table=self.name, op='count'):
+            return len(self.table)
+
+    def __getattr__(self, name):
+        return getattr(self.table, name)
+
+
+def instrument_storage(storage):
+    table = storage.table
+    tables = {}
+
+    def timed_table(name):
+        if name not in tables:
+            tables[name] = TimedTable(table(name), name)
+        return tables[name]
+    storage.table = timed_table
+    return storage
+
+
+def instrument_telegram(helper, async_helper=False):
+    # все методы Bot API идут через apihelper._make_request / asyncio_helper._process_request
+    if async_helper:
+        process = helper._process_request
+
+        async def timed_process(token, url, *args, **kwargs):
+            with http_timer('telegram', url):
+                return await process(token, url, *args, **kwargs)
+        helper._process_request = timed_process
+    else:
+        make = helper._make_request
+
+        def timed_make(token, method_name, *args, **kwargs):
+            with http_timer('telegram', method_name):
+                return make(token, method_name, *args, **kwargs)
+        helper._make_request = timed_make
+
+
+# Сэмплирующий профайлер: раз в interval снимает стеки всех потоков и копит
+# их в формате collapsed stacks (flamegraph.pl / speedscope).
+class Profiler:
+    def __init__(self, interval=0.01, max_depth=40):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = StackCounter()
+        self.samples = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def running(self):
+        return bool(self.thread and self.thread.is_alive())
+
+    def start(self):
+        if self.running():
+            return
+        with self.lock:
+            self.stacks.clear()
+            self.samples = 0
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            with self.lock:
+                self.samples += 1
+                for ident, frame in frames.items():
+                    if ident == own:
+                        continue
+                    stack = traceback.extract_stack(frame, limit=self.max_depth)
+                    self.stacks[';'.join(f'{f.name} ({f.filename.rsplit("/", 1)[-1]}:{f.lineno})' for f in stack)] += 1
+
+    def collapsed(self):
+        with self.lock:
+            return '\n'.join(f'{stack} {n}' for stack, n in self.stacks.most_common()) + '\n'
+
+
+# Локальный HTTP: /metrics в текстовом формате Prometheus,
+# /profile/start, /profile/stop и /profile — стеки профайлера.
+class MetricsServer:
+    def __init__(self, host, port, registry=REGISTRY, profiler=None):
+        self.registry = registry
+        self.profiler = profiler or Profiler()
+        self.server = ThreadingHTTPServer((host, port), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def handler_class(self):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                profiler = metrics.profiler
+                if self.path == '/metrics':
+                    return self.reply(200, metrics.registry.render(), 'text/plain; version=0.0.4')
+                if self.path == '/profile/start':
+                    profiler.start()
+                    return self.reply(200, "profiler started\n")
+                if self.path == '/profile/stop':
+                    profiler.stop()
+                    return self.reply(200, "profiler stopped\n")
+                if self.path == '/profile':
+                    return self.reply(200, profiler.collapsed())
+                self.reply(404, '')
+
+            def reply(self, code, text, content_type='text/plain'):
+                body = text.encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+        self.thread.start()
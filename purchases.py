@@ -0,0 +1,102 @@
+from collections import Counter
+from datetime import datetime, timedelta
+
+from storage import DuplicateKeyError
+
+
+# История покупок: строка в purchases на каждое списание kind='purchase' —
+# пишется хуком Ledger в той же транзакции, что и списание. В строке снимок
+# товара на момент покупки (название, file_id или текст единицы склада),
+# чтобы выдать его повторно, даже если товар уже удалён. Там же
+# увеличиваются сводки выручки в revenue: по дню, товару, разделу и итог.
+class Purchases:
+    def __init__(self, storage, product):
+        self.storage = storage
+        self.product = product
+        self.purchases = storage.table('purchases')
+        self.revenue = storage.table('revenue')
+        self.units = storage.table('units')
+        self.meta = storage.table('meta')
+
+    def record(self, tx):
+        if tx['kind'] != 'purchase' or tx.get('product_id') is None:
+            return None
+        product = self.product(tx['product_id']) or {}
+        unit = self.units.get(id=tx['unit_id']) if tx.get('unit_id') else None
+        source = unit or product
+        purchase = {
+            'id': (self.purchases.max('id') or 0) + 1,
+            'key': tx['key'],
+            'user_id': tx['user_id'],
+            'product_id': tx['product_id'],
+            'category_id': product.get('category_id'),
+            'name': product.get('name', f"Товар #{tx['product_id']}"),
+            'price': round(-tx['amount'], 8),
+            'unit_id': tx.get('unit_id'),
+            'file_id': source.get('file_id'),
+            'text': source.get('text'),
+            'day': tx['timestamp'][:10],
+            'timestamp': tx['timestamp'],
+        }
+        with self.storage.transaction():
+            self.purchases.insert(purchase)
+            self.bump(purchase)
+        return purchase
+
+    def bump(self, purchase):
+        deltas = {'count': 1, 'sum': purchase['price']}
+        for kind, ref in (('total', ''), ('day', purchase['day']), ('product', purchase['product_id']),
+                          ('category', purchase['category_id'])):
+            if ref is None:
+                continue
+            key = f'{kind}:{ref}'
+            if self.revenue.increment(deltas, key=key):
+                continue
+            try:
+                self.revenue.insert({'key': key, 'kind': kind, 'ref': ref, **deltas})
+            except DuplicateKeyError:
+                self.revenue.increment(deltas, key=key)
+
+    def backfill(self, transactions):
+        # один раз переносим покупки, списанные до появления таблицы
+        if self.meta.get(key='purchases_backfilled'):
+            return 0
+        with self.storage.transaction():
+            if self.meta.get(key='purchases_backfilled'):
+                return 0
+            count = 0
+            for tx in transactions.search(kind='purchase'):
+                if not self.purchases.get(key=tx['key']) and self.record(tx):
+                    count += 1
+            self.meta.insert({'key': 'purchases_backfilled', 'value': True})
+        return count
+
+    def page(self, user_id, before=None, limit=5):
+        return self.purchases.page_before(before, limit, user_id=user_id)
+
+    def newer(self, user_id, after, limit=5):
+        return list(reversed(self.purchases.page(after, limit, user_id=user_id)))
+
+    def get(self, purchase_id):
+        return self.purchases.get(id=purchase_id)
+
+    def count(self, user_id):
+        return self.purchases.count(user_id=user_id)
+
+    def summary(self, top=5):
+        now = datetime.now()
+        today = now.strftime('%Y-%m-%d')
+        week_ago = (now - timedelta(days=7)).strftime('%Y-%m-%d')
+        week = Counter()
+        for row in self.revenue.search(kind='day', ref__gte=week_ago, ref__lte=today):
+            week.update({'count': row['count'], 'sum': row['sum']})
+        day = self.revenue.get(key=f'day:{today}') or {}
+        total = self.revenue.get(key='total:') or {}
+        by_sum = lambda kind: self.revenue.top('sum', top, kind=kind)
+        return {
+            'day': (day.get('count', 0), round(day.get('sum', 0), 2)),
+            'week': (week['count'], round(week['sum'], 2)),
+            'total': (total.get('count', 0), round(total.get('sum', 0), 2)),
+            'products': [(r['ref'], r['count'], round(r['sum'], 2)) for r in by_sum('product')],
+            'categories': [(r['ref'], r['count'], round(r['sum'], 2)) for r in by_sum('category')],
+        }
@@ -0,0 +1,50 @@
+import threading
+import time
+
+from telebot.apihelper import ApiTelegramException
+
+
+def retry_after(error):
+    # сколько секунд просит подождать Telegram в ответе 429, иначе None
+    if isinstance(error, ApiTelegramException) and error.error_code == 429:
+        return (error.result_json.get('parameters') or {}).get('retry_after', 1)
+    return None
+
+
+# Token bucket на несколько потоков: acquire() ждёт, пока не накопится
+# токен. pause() останавливает всех на время retry_after после 429.
+class RateLimiter:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        # 0 — токен взят, иначе сколько ещё ждать
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self.refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
@@ -0,0 +1,78 @@
+import threading
+import time
+
+import requests
+
+import metrics
+
+
+# Курс TON/USD из памяти: фоновый поток обновляет его раз в ttl секунд,
+# get() никогда не ходит в сеть. Если провайдер недоступен, отдаётся последний
+# известный курс (в том числе сохранённый до перезапуска через on_rate),
+# но не старше max_age — дальше get() возвращает None и зачисление ждёт.
+class RateService:
+    def __init__(self, api_url, ttl=60, max_age=6 * 3600, retry=10, rate=None, updated=None, on_rate=None):
+        self.api_url = api_url
+        self.ttl = ttl
+        self.max_age = max_age
+        self.retry = retry
+        self.rate = rate
+        self.updated = updated or 0.0
+        self.on_rate = on_rate
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def get(self):
+        with self.lock:
+            if self.rate is None or time.time() - self.updated > self.max_age:
+                return None
+            return self.rate
+
+    def age(self):
+        with self.lock:
+            return time.time() - self.updated if self.rate is not None else None
+
+    def update(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.updated = time.time()
+        if self.on_rate:
+            self.on_rate(rate, self.updated)
+
+    def fetch(self):
+        # tonapi: {"rates": {"TON": {"prices": {"USD": 5.4}}}}
+        with metrics.http_timer('tonapi', 'rates'):
+            r = requests.get(self.api_url, params={'tokens': 'ton', 'currencies': 'usd'}, timeout=10)
+        r.raise_for_status()
+        rate = float(r.json()['rates']['TON']['prices']['USD'])
+        if rate <= 0:
+            raise ValueError(f"неверный курс: {rate}")
+        return rate
+
+    def refresh(self):
+        try:
+            self.update(self.fetch())
+            return True
+        except Exception as e:
+            print("TON rate err:", e)
+            return False
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='ton-rate', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            age = self.age()
+            if age is None or age >= self.ttl:
+                wait = self.ttl if self.refresh() else min(self.retry, self.ttl)
+            else:
+                wait = self.ttl - age
+            self.stop_event.wait(wait)
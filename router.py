@@ -0,0 +1,194 @@
+import base64
+import threading
+import time
+
+MARKER = '~'
+MAX_CALLBACK_DATA = 64
+
+
+def write_varint(buf, n):
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if n:
+            buf.append(byte | 0x80)
+        else:
+            buf.append(byte)
+            return
+
+def read_varint(data, pos):
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return n, pos
+        shift += 7
+
+def pack(buf, value):
+    # младшие два бита — тип: 0 None, 1 int (zigzag), 2 str
+    if value is None:
+        write_varint(buf, 0)
+    elif isinstance(value, int):
+        zigzag = value << 1 if value >= 0 else (-value << 1) - 1
+        write_varint(buf, zigzag << 2 | 1)
+    else:
+        raw = str(value).encode('utf-8')
+        write_varint(buf, len(raw) << 2 | 2)
+        buf.extend(raw)
+
+def unpack(data, pos):
+    head, pos = read_varint(data, pos)
+    kind, n = head & 3, head >> 2
+    if kind == 0:
+        return None, pos
+    if kind == 1:
+        return (n >> 1) ^ -(n & 1), pos
+    if kind == 2:
+        return data[pos:pos + n].decode('utf-8'), pos + n
+    raise ValueError(f"неизвестный тип аргумента: {kind}")
+
+
+# Компактный callback_data: «~» + base64url(код маршрута, аргументы в varint).
+# Коды фиксированы, потому что кнопки живут в чатах дольше одного запуска;
+# маршруты без кода и без аргументов остаются обычными строками.
+class CallbackCodec:
+    def __init__(self, routes):
+        self.codes = dict(routes)
+        self.names = {code: name for name, code in self.codes.items()}
+
+    def encode(self, name, *args):
+        code = self.codes.get(name)
+        if code is None:
+            return '_'.join([name, *map(str, args)])
+        if not args:
+            return name
+        buf = bytearray()
+        write_varint(buf, code)
+        for arg in args:
+            pack(buf, arg)
+        data = MARKER + base64.urlsafe_b64encode(bytes(buf)).rstrip(b'=').decode('ascii')
+        if len(data) > MAX_CALLBACK_DATA:
+            raise ValueError(f"callback_data длиннее {MAX_CALLBACK_DATA} байт: {name}{args}")
+        return data
+
+    def decode(self, data):
+        raw = data[len(MARKER):]
+        try:
+            raw = base64.urlsafe_b64decode(raw + '=' * (-len(raw) % 4))
+            code, pos = read_varint(raw, 0)
+            args = []
+            while pos < len(raw):
+                value, pos = unpack(raw, pos)
+                args.append(value)
+        except (ValueError, IndexError, UnicodeDecodeError):
+            return None
+        name = self.names.get(code)
+        return (name, tuple(args)) if name else None
+
+
+def legacy_args(rest):
+    # старые кнопки: <маршрут>_<id>[_<id>...]
+    return tuple(int(part) for part in rest.split('_'))
+
+
+# Маршрутизация callback-кнопок: точное имя ищется в словаре, старый формат
+# «префикс_аргументы» — по самому длинному префиксу в дереве, компактный —
+# по коду. Время каждого маршрута копится в timings и отдаётся хукам.
+class CallbackRouter:
+    def __init__(self, codec):
+        self.codec = codec
+        self.handlers = {}
+        self.trie = {}
+        self.hooks = []
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def route(self, name, legacy=legacy_args):
+        def decorator(handler):
+            self.handlers[name] = handler
+            node = self.trie
+            for char in name + '_':
+                node = node.setdefault(char, {})
+            node[None] = (name, legacy)
+            return handler
+        return decorator
+
+    def on_timing(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def resolve(self, data):
+        if not data:
+            return None
+        if data.startswith(MARKER):
+            decoded = self.codec.decode(data)
+            return decoded if decoded and decoded[0] in self.handlers else None
+        if data in self.handlers:
+            return data, ()
+        node, match = self.trie, None
+        for i, char in enumerate(data):
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                match = node[None], i + 1
+        if match is None:
+            return None
+        (name, legacy), end = match
+        try:
+            return name, legacy(data[end:])
+        except (ValueError, IndexError):
+            return None
+
+    def dispatch(self, call):
+        resolved = self.resolve(call.data)
+        if resolved is None:
+            return False
+        name, args = resolved
+        started = time.perf_counter()
+        error = None
+        try:
+            self.handlers[name](call, *args)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.record(name, time.perf_counter() - started, error)
+        return True
+
+    async def adispatch(self, call):
+        resolved = self.resolve(call.data)
+        if resolved is None:
+            return False
+        name, args = resolved
+        started = time.perf_counter()
+        error = None
+        try:
+            await self.handlers[name](call, *args)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.record(name, time.perf_counter() - started, error)
+        return True
+
+    def record(self, name, elapsed, error):
+        with self.lock:
+            timing = self.timings.setdefault(name, {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0})
+            timing['count'] += 1
+            timing['errors'] += error is not None
+            timing['total'] += elapsed
+            timing['max'] = max(timing['max'], elapsed)
+        for hook in self.hooks:
+            try:
+                hook(name, elapsed, error)
+            except Exception as e:
+                print("Ошибка хука маршрута:", e)
+
+    def stats(self):
+        with self.lock:
+            return {name: {'count': t['count'], 'errors': t['errors'],
+                           'avg': round(t['total'] / t['count'], 6), 'max': round(t['max'], 6)}
+                    for name, t in self.timings.items()}
@@ -0,0 +1,129 @@
+import re
+import threading
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+NAME_WEIGHT = 3
+DESCRIPTION_WEIGHT = 1
+# вклад совпадения: точное слово, префикс, опечатка
+EXACT, PREFIX, FUZZY = 1.0, 0.6, 0.4
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(str(text or '').lower().replace('ё', 'е'))
+
+def trigrams(token):
+    padded = f' {token} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def within_distance(a, b, limit):
+    # Левенштейн с отсечкой: False, как только вся строка матрицы больше limit
+    if abs(len(a) - len(b)) > limit:
+        return False
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return False
+        previous = current
+    return previous[-1] <= limit
+
+
+# Инвертированный индекс по названию и описанию товаров: слово -> {id: вес}.
+# Отсортированный словарь даёт поиск по префиксу, триграммы словаря —
+# кандидатов для нечёткого совпадения. Обновляется по одному товару.
+class SearchIndex:
+    def __init__(self, items=()):
+        self.postings = defaultdict(dict)
+        self.vocabulary = []
+        self.grams = defaultdict(set)
+        self.tokens_by_product = {}
+        self.lock = threading.Lock()
+        for item in items:
+            self.add(item)
+
+    def product_weights(self, item):
+        weights = defaultdict(int)
+        for token in tokenize(item.get('name')):
+            weights[token] += NAME_WEIGHT
+        for token in tokenize(item.get('description')):
+            weights[token] += DESCRIPTION_WEIGHT
+        return weights
+
+    def add(self, item):
+        weights = self.product_weights(item)
+        with self.lock:
+            self.drop(item['id'])
+            for token, weight in weights.items():
+                if token not in self.postings:
+                    insort(self.vocabulary, token)
+                    for gram in trigrams(token):
+                        self.grams[gram].add(token)
+                self.postings[token][item['id']] = weight
+            self.tokens_by_product[item['id']] = list(weights)
+
+    def remove(self, product_id):
+        with self.lock:
+            self.drop(product_id)
+
+    def drop(self, product_id):
+        for token in self.tokens_by_product.pop(product_id, ()):
+            posting = self.postings.get(token)
+            if posting is None:
+                continue
+            posting.pop(product_id, None)
+            if not posting:
+                del self.postings[token]
+                del self.vocabulary[bisect_left(self.vocabulary, token)]
+                for gram in trigrams(token):
+                    self.grams[gram].discard(token)
+                    if not self.grams[gram]:
+                        del self.grams[gram]
+
+    def prefixed(self, prefix, limit=200):
+        start = bisect_left(self.vocabulary, prefix)
+        out = []
+        for token in self.vocabulary[start:start + limit]:
+            if not token.startswith(prefix):
+                break
+            out.append(token)
+        return out
+
+    def fuzzy(self, token):
+        if len(token) < 4:
+            return []
+        limit = 1 if len(token) < 7 else 2
+        grams = trigrams(token)
+        shared = defaultdict(int)
+        for gram in grams:
+            for candidate in self.grams.get(gram, ()):
+                shared[candidate] += 1
+        # хотя бы треть общих триграмм, потом точная проверка расстояния
+        need = max(1, len(grams) // 3)
+        return [c for c, n in shared.items() if n >= need and c != token and within_distance(token, c, limit)]
+
+    def search(self, query, limit=20):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        scores = defaultdict(float)
+        matched = defaultdict(int)
+        with self.lock:
+            for token in tokens:
+                hits = {}
+                for candidate, factor in ([(token, EXACT)] + [(t, PREFIX) for t in self.prefixed(token)]
+                                          + [(t, FUZZY) for t in self.fuzzy(token)]):
+                    for product_id, weight in self.postings.get(candidate, {}).items():
+                        hits[product_id] = max(hits.get(product_id, 0), weight * factor)
+                for product_id, score in hits.items():
+                    scores[product_id] += score
+                    matched[product_id] += 1
+        # сначала товары, где нашлись все слова запроса, затем по весу
+        ranked = sorted(scores, key=lambda i: (-matched[i], -scores[i], i))
+        return ranked[:limit]
+
+    def __len__(self):
+        return len(self.tokens_by_product)
@@ -0,0 +1,135 @@
+import threading
+from collections import deque
+
+
+class OutOfStock(Exception):
+    pass
+
+
+# Склад уникальных единиц товара (ключи, аккаунты, файлы): каждая единица —
+# строка в units со статусом available -> reserved -> sold. Покупка берёт
+# единицу из заранее подгруженной очереди, резервирует её CAS-обновлением
+# статуса, списывает деньги через Ledger и только потом помечает проданной;
+# при отказе списания резерв снимается. Счётчики остатков кэшируются.
+class Stock:
+    def __init__(self, storage, ledger, prefetch=20, stripes=64, on_change=None):
+        self.storage = storage
+        self.ledger = ledger
+        self.units = storage.table('units')
+        self.transactions = storage.table('transactions')
+        self.prefetch = prefetch
+        self.on_change = on_change
+        self.queues = {}
+        self.cursors = {}
+        self.counts = {}
+        self.locks = [threading.Lock() for _ in range(stripes)]
+        self.counts_lock = threading.Lock()
+
+    def lock(self, product_id):
+        return self.locks[hash(product_id) % len(self.locks)]
+
+    def available(self, product_id):
+        with self.counts_lock:
+            count = self.counts.get(product_id)
+        if count is None:
+            count = self.units.count(product_id=product_id, status='available')
+            with self.counts_lock:
+                self.counts.setdefault(product_id, count)
+        return count
+
+    def adjust(self, product_id, delta):
+        with self.counts_lock:
+            if product_id in self.counts:
+                self.counts[product_id] = max(self.counts[product_id] + delta, 0)
+        if self.on_change:
+            self.on_change(product_id)
+
+    def add(self, product_id, contents):
+        # contents: список {'text': ...} или {'file_id': ...}
+        with self.storage.transaction():
+            first_id = (self.units.max('id') or 0) + 1
+            self.units.insert_multiple([{
+                'id': first_id + i,
+                'product_id': product_id,
+                'status': 'available',
+                **content
+            } for i, content in enumerate(contents)])
+        self.adjust(product_id, len(contents))
+        return len(contents)
+
+    def discard(self, product_id):
+        # товар удалён: непроданные единицы убираем, проданные остаются в истории
+        with self.lock(product_id):
+            self.units.remove(product_id=product_id, status='available')
+            self.queues.pop(product_id, None)
+            self.cursors.pop(product_id, None)
+        self.forget(product_id)
+
+    def forget(self, product_id):
+        # остаток поменял другой процесс — пересчитаем при следующем запросе
+        with self.counts_lock:
+            self.counts.pop(product_id, None)
+
+    def refill(self, product_id):
+        queue = self.queues.setdefault(product_id, deque())
+        page = self.units.page(self.cursors.get(product_id, 0), self.prefetch, product_id=product_id, status='available')
+        if not page and self.cursors.get(product_id):
+            # снятые резервы и единицы других процессов лежат до курсора
+            page = self.units.page(0, self.prefetch, product_id=product_id, status='available')
+        if page:
+            self.cursors[product_id] = page[-1].doc_id
+        queue.extend(page)
+        return queue
+
+    def reserve(self, product_id, user_id, key):
+        while True:
+            with self.lock(product_id):
+                queue = self.queues.get(product_id)
+                if not queue:
+                    queue = self.refill(product_id)
+                if not queue:
+                    return None
+                unit = queue.popleft()
+            # CAS по статусу: единицу из очереди мог забрать другой процесс
+            if self.units.update({'status': 'reserved', 'buyer_id': user_id, 'purchase_key': key},
+                                 doc_ids=[unit.doc_id], status='available'):
+                self.adjust(product_id, -1)
+                return unit
+
+    def release(self, unit):
+        if self.units.update({'status': 'available', 'buyer_id': None, 'purchase_key': None},
+                             doc_ids=[unit.doc_id], status='reserved'):
+            with self.lock(unit['product_id']):
+                self.queues.setdefault(unit['product_id'], deque()).appendleft(unit)
+            self.adjust(unit['product_id'], 1)
+
+    def purchase(self, user_id, product, key):
+        # None — повторное нажатие той же кнопки (ключ уже списан)
+        if self.transactions.get(key=key):
+            return None
+        unit = self.reserve(product['id'], user_id, key)
+        if unit is None:
+            raise OutOfStock()
+        try:
+            tx = self.ledger.debit(user_id, product['price'], key, product_id=product['id'], unit_id=unit['id'])
+        except BaseException:
+            self.release(unit)
+            raise
+        if tx is None:
+            self.release(unit)
+            return None
+        self.units.update({'status': 'sold', 'sold_at': tx['timestamp']}, doc_ids=[unit.doc_id])
+        return {**unit, 'status': 'sold', 'buyer_id': user_id, 'purchase_key': key}
+
+    def recover(self):
+        # после падения между резервом и продажей: есть списание — продано, нет — возвращаем
+        for unit in self.units.search(status='reserved'):
+            tx = self.transactions.get(key=unit.get('purchase_key'))
+            if tx:
+                self.units.update({'status': 'sold', 'sold_at': tx['timestamp']}, doc_ids=[unit.doc_id])
+            else:
+                self.units.update({'status': 'available', 'buyer_id': None, 'purchase_key': None}, doc_ids=[unit.doc_id])
+        with self.counts_lock:
+            self.counts.clear()
+        self.queues.clear()
+        self.cursors.clear()
@@ -0,0 +1,842 @@
+import asyncio
+import bisect
+import gc
+import heapq
+import json
+import operator
+import os
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from functools import partial
+from itertools import islice
+
+
+class DuplicateKeyError(Exception):
+    pass
+
+
+class Document(dict):
+    def __init__(self, value, doc_id):
+        super().__init__(value)
+        self.doc_id = doc_id
+
+
+# уникальные и обычные индексы таблиц; кортеж — составной индекс
+SCHEMA = {
+    'users': {'unique': ['user_id'], 'index': []},
+    'products': {'unique': ['id'], 'index': ['category_id']},
+    'categories': {'unique': ['id'], 'index': []},
+    'stats': {'unique': [], 'index': [('type', 'timestamp')]},
+    'ton_payments': {'unique': ['comment'], 'index': ['status', 'user_id']},
+    'meta': {'unique': ['key'], 'index': []},
+    'transactions': {'unique': ['key'], 'index': ['user_id']},
+    'stats_daily': {'unique': ['day'], 'index': []},
+    'invoices': {'unique': ['invoice_id'], 'index': ['status', 'user_id']},
+    'broadcasts': {'unique': ['id'], 'index': ['status']},
+    'units': {'unique': ['id'], 'index': [('product_id', 'status'), 'status']},
+    'states': {'unique': ['chat_id'], 'index': ['updated']},
+    # autoincrement: doc_id не переиспользуется после удаления (курсор шины событий)
+    'events': {'unique': [], 'index': ['time'], 'autoincrement': True},
+    'purchases': {'unique': ['id', 'key'], 'index': ['user_id', 'product_id', 'day']},
+    'revenue': {'unique': ['key'], 'index': [('kind', 'ref'), ('kind', 'sum')]},
+}
+
+# условия поиска: field=value или field__op=value
+OPERATORS = {
+    'eq': ('=', operator.eq),
+    'ne': ('!=', operator.ne),
+    'gt': ('>', operator.gt),
+    'gte': ('>=', operator.ge),
+    'lt': ('<', operator.lt),
+    'lte': ('<=', operator.le),
+}
+
+
+def split_condition(key):
+    name, _, op = key.partition('__')
+    if op and op not in OPERATORS:
+        raise ValueError(f"Неизвестный оператор: {op}")
+    return name, op or 'eq'
+
+
+def index_fields(index):
+    return (index,) if isinstance(index, str) else tuple(index)
+
+
+# ---------- SQLite ----------
+def json_field(name):
+    return f"json_extract(data, '$.{name}')"
+
+
+class SQLiteTable:
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+        schema = SCHEMA.get(name, {})
+        key = 'INTEGER PRIMARY KEY AUTOINCREMENT' if schema.get('autoincrement') else 'INTEGER PRIMARY KEY'
+        with storage.lock:
+            row = storage.conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                       (name,)).fetchone()
+            if row and key not in row[0]:
+                # таблица создана до autoincrement — пересоздаём с теми же строками
+                with storage.transaction():
+                    storage.conn.execute(f'ALTER TABLE "{name}" RENAME TO "{name}_old"')
+                    storage.conn.execute(f'CREATE TABLE "{name}" (doc_id {key}, data TEXT NOT NULL)')
+                    storage.conn.execute(f'INSERT INTO "{name}" SELECT doc_id, data FROM "{name}_old"')
+                    storage.conn.execute(f'DROP TABLE "{name}_old"')
+            storage.conn.execute(f'CREATE TABLE IF NOT EXISTS "{name}" (doc_id {key}, data TEXT NOT NULL)')
+            for kind in ('unique', 'index'):
+                for index in schema.get(kind, []):
+                    fields = index_fields(index)
+                    storage.conn.execute(
+                        f'CREATE {"UNIQUE " if kind == "unique" else ""}INDEX IF NOT EXISTS '
+                        f'"{name}_{"_".join(fields)}" ON "{name}" ({", ".join(json_field(f) for f in fields)})')
+
+    def where(self, conditions, doc_ids=None):
+        clauses = []
+        params = []
+        for key, value in conditions.items():
+            name, op = split_condition(key)
+            if name == 'doc_id':
+                clauses.append(f"doc_id {OPERATORS[op][0]} ?")
+                params.append(value)
+            elif value is None and op in ('eq', 'ne'):
+                clauses.append(f"{json_field(name)} IS {'NOT ' if op == 'ne' else ''}NULL")
+            else:
+                clauses.append(f"{json_field(name)} {OPERATORS[op][0]} ?")
+                params.append(value)
+        if doc_ids is not None:
+            doc_ids = list(doc_ids)
+            clauses.append(f"doc_id IN ({', '.join('?' * len(doc_ids))})")
+            params.extend(doc_ids)
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    def query(self, sql, params=()):
+        with self.storage.lock:
+            return self.storage.conn.execute(sql, params).fetchall()
+
+    def execute(self, sql, params=()):
+        with self.storage.lock:
+            return self.storage.conn.execute(sql, params)
+
+    def get(self, **conditions):
+        where, params = self.where(conditions)
+        rows = self.query(f'SELECT doc_id, data FROM "{self.name}"{where} ORDER BY doc_id LIMIT 1', params)
+        return Document(json.loads(rows[0][1]), rows[0][0]) if rows else None
+
+    def search(self, **conditions):
+        where, params = self.where(conditions)
+        rows = self.query(f'SELECT doc_id, data FROM "{self.name}"{where} ORDER BY doc_id', params)
+        return [Document(json.loads(data), doc_id) for doc_id, data in rows]
+
+    def all(self):
+        return self.search()
+
+    def page(self, after=0, limit=100, **conditions):
+        # keyset-пагинация по doc_id: следующая страница — page(after=последний doc_id)
+        where, params = self.where({**conditions, 'doc_id__gt': after})
+        rows = self.query(f'SELECT doc_id, data FROM "{self.name}"{where} ORDER BY doc_id LIMIT ?', params + [limit])
+        return [Document(json.loads(data), doc_id) for doc_id, data in rows]
+
+    def page_before(self, before=None, limit=100, **conditions):
+        # то же в обратную сторону: новые сначала, следующая — page_before(before=последний doc_id)
+        if before is not None:
+            conditions['doc_id__lt'] = before
+        where, params = self.where(conditions)
+        rows = self.query(f'SELECT doc_id, data FROM "{self.name}"{where} ORDER BY doc_id DESC LIMIT ?', params + [limit])
+        return [Document(json.loads(data), doc_id) for doc_id, data in rows]
+
+    def top(self, field, limit=10, **conditions):
+        # наибольшие по field; с индексом (условие, field) — без сортировки всей таблицы
+        where, params = self.where(conditions)
+        rows = self.query(f'SELECT doc_id, data FROM "{self.name}"{where} ORDER BY {json_field(field)} DESC LIMIT ?',
+                          params + [limit])
+        return [Document(json.loads(data), doc_id) for doc_id, data in rows]
+
+    def count(self, **conditions):
+        where, params = self.where(conditions)
+        return self.query(f'SELECT COUNT(*) FROM "{self.name}"{where}', params)[0][0]
+
+    def __len__(self):
+        return self.count()
+
+    def max(self, field):
+        return self.query(f'SELECT MAX({json_field(field)}) FROM "{self.name}"')[0][0]
+
+    def insert(self, doc, doc_id=None):
+        try:
+            cursor = self.execute(f'INSERT INTO "{self.name}" (doc_id, data) VALUES (?, ?)',
+                                  (doc_id, json.dumps(doc, ensure_ascii=False)))
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(f"{self.name}: {e}")
+        return cursor.lastrowid
+
+    def insert_multiple(self, docs):
+        with self.storage.transaction():
+            return [self.insert(doc) for doc in docs]
+
+    def update(self, fields, doc_ids=None, **conditions):
+        if not fields:
+            return 0
+        where, params = self.where(conditions, doc_ids)
+        paths = ', '.join(f"'$.{name}', json(?)" for name in fields)
+        values = [json.dumps(value, ensure_ascii=False) for value in fields.values()]
+        try:
+            cursor = self.execute(f'UPDATE "{self.name}" SET data = json_set(data, {paths}){where}',
+                                  values + params)
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(f"{self.name}: {e}")
+        return cursor.rowcount
+
+    def upsert(self, doc, **conditions):
+        with self.storage.transaction():
+            if self.update(doc, **conditions):
+                return
+            self.insert(doc)
+
+    def increment(self, deltas, **conditions):
+        where, params = self.where(conditions)
+        paths = ', '.join(f"'$.{name}', COALESCE({json_field(name)}, 0) + ?" for name in deltas)
+        cursor = self.execute(f'UPDATE "{self.name}" SET data = json_set(data, {paths}){where}',
+                              list(deltas.values()) + params)
+        return cursor.rowcount
+
+    def remove(self, doc_ids=None, **conditions):
+        where, params = self.where(conditions, doc_ids)
+        return self.execute(f'DELETE FROM "{self.name}"{where}', params).rowcount
+
+
+class SQLiteStorage:
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.tables = {}
+
+    def table(self, name):
+        with self.lock:
+            if name not in self.tables:
+                self.tables[name] = SQLiteTable(self, name)
+            return self.tables[name]
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            if self.depth:
+                self.depth += 1
+                try:
+                    yield
+                finally:
+                    self.depth -= 1
+                return
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.depth = 1
+            try:
+                yield
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            else:
+                self.conn.execute('COMMIT')
+            finally:
+                self.depth = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# ---------- TinyDB ----------
+def plain(value):
+    # как после записи в JSON: кортежи -> списки, ключи -> строки, без общих ссылок
+    return json.loads(json.dumps(value))
+
+
+def fsync_dir(path):
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Журнал изменений для TinyStorage: одна строка JSON на транзакцию со списком
+# операций над документами (set / del / truncate), запись с fsync до выхода
+# из транзакции. Снимок — обычный database.json TinyDB: пишется во временный
+# файл и атомарно подменяется. Перед снимком журнал переименовывается в
+# .old и удаляется только после подмены; операции идемпотентны, поэтому
+# повторное применение .old к новому снимку ничего не ломает.
+class TinyJournal:
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.old_path = path + '.journal.old'
+        self.pending = []
+        self.file = None
+        self.size = 0
+
+    def load(self):
+        data = {}
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        replayed = 0
+        for path in (self.old_path, self.journal_path):
+            replayed += self.replay(path, data)
+        if any(os.path.exists(p) and os.path.getsize(p) for p in (self.old_path, self.journal_path)):
+            # сразу свежий снимок: в журнал не дописываем после оборванной строки
+            self.snapshot(data)
+            # после падения между rotate() и open() есть только .old
+            with suppress(FileNotFoundError):
+                os.remove(self.journal_path)
+        self.open()
+        return data, replayed
+
+    def replay(self, path, data):
+        if not os.path.exists(path):
+            return 0
+        count = 0
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # недописанная строка при падении — транзакция не завершилась
+                    print(f"Журнал {path}: оборванная запись пропущена")
+                    break
+                for op in record['ops']:
+                    self.apply(data, op)
+                count += 1
+        return count
+
+    @staticmethod
+    def apply(data, op):
+        table = data.setdefault(op['t'], {})
+        if op.get('truncate'):
+            table.clear()
+        for doc_id in op.get('del', ()):
+            table.pop(str(doc_id), None)
+        for doc_id, doc in op.get('set', {}).items():
+            table[str(doc_id)] = doc
+
+    def open(self):
+        self.file = open(self.journal_path, 'a', encoding='utf-8')
+        self.size = self.file.tell()
+
+    def log(self, table, docs=None, removed=None, truncate=False):
+        op = {'t': table}
+        if truncate:
+            op['truncate'] = True
+        if removed:
+            op['del'] = [int(doc_id) for doc_id in removed]
+        if docs:
+            op['set'] = {str(doc_id): doc for doc_id, doc in docs.items()}
+        self.pending.append(json.dumps(op))
+
+    def discard(self):
+        # откат транзакции: ничего из неё не попадает в журнал
+        self.pending = []
+
+    def commit(self):
+        if not self.pending:
+            return
+        line = '{"ops": [' + ', '.join(self.pending) + ']}\n'
+        self.pending = []
+        self.file.write(line)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.size += len(line)
+
+    def rotate(self):
+        # под замком хранилища: дальше пишем в новый журнал
+        self.file.close()
+        if os.path.exists(self.old_path):
+            # прошлый снимок не записался — старый журнал ещё нужен
+            with open(self.journal_path, encoding='utf-8') as src, open(self.old_path, 'a', encoding='utf-8') as dst:
+                dst.write(src.read())
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, self.old_path)
+        self.open()
+
+    def snapshot(self, data, chunk=1000):
+        # пишем кусками: json.dumps держит GIL, один большой вызов стопорит все потоки
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write('{')
+            for i, (name, docs) in enumerate(data.items()):
+                f.write(f'{", " if i else ""}{json.dumps(name)}: {{')
+                items = iter(docs.items())
+                first = True
+                while True:
+                    part = {str(doc_id): doc for doc_id, doc in islice(items, chunk)}
+                    if not part:
+                        break
+                    f.write(("" if first else ", ") + json.dumps(part)[1:-1])
+                    first = False
+                f.write('}')
+            f.write('}')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        fsync_dir(self.path)
+        if os.path.exists(self.old_path):
+            os.remove(self.old_path)
+
+    def close(self):
+        self.commit()
+        self.file.close()
+
+
+class TinyTable:
+    # документы — обычные dict в памяти {doc_id: doc}; изменённый документ
+    # заменяется новым dict, старый не трогается (снимок сериализуется без замка)
+    def __init__(self, storage, name, docs):
+        self.storage = storage
+        self.name = name
+        self.docs = docs
+        schema = SCHEMA.get(name, {})
+        self.unique = list(schema.get('unique', []))
+        # хеш-индексы по индексам схемы и по первому полю составных: значения -> {doc_id}
+        self.indexes = {}
+        for index in self.unique + list(schema.get('index', [])):
+            fields = index_fields(index)
+            self.indexes.setdefault(fields, {})
+            self.indexes.setdefault(fields[:1], {})
+        # doc_id по возрастанию — для page/page_before без сортировки всей таблицы
+        self.ids = sorted(docs)
+        self.next_id = (self.ids[-1] if self.ids else 0) + 1
+        # max(field) считается один раз и дальше поддерживается при записи
+        self.maxes = {}
+        for doc_id, doc in docs.items():
+            self.index(doc_id, doc)
+
+    def save(self, doc_id):
+        # образ документа до изменения — для отката транзакции
+        self.storage.undo.append((self, doc_id, self.docs.get(doc_id)))
+
+    def restore(self, doc_id, doc):
+        current = self.docs.pop(doc_id, None)
+        if current is not None:
+            self.unindex(doc_id, current)
+            del self.ids[bisect.bisect_left(self.ids, doc_id)]
+        if doc is not None:
+            self.docs[doc_id] = doc
+            bisect.insort(self.ids, doc_id)
+            self.index(doc_id, doc)
+
+    def index(self, doc_id, doc):
+        for fields, index in self.indexes.items():
+            try:
+                index.setdefault(tuple(doc.get(f) for f in fields), set()).add(doc_id)
+            except TypeError:
+                pass
+        for field, value in self.maxes.items():
+            try:
+                if doc.get(field) is not None and (value is None or doc[field] > value):
+                    self.maxes[field] = doc[field]
+            except TypeError:
+                pass
+
+    def unindex(self, doc_id, doc):
+        for fields, index in self.indexes.items():
+            key = tuple(doc.get(f) for f in fields)
+            try:
+                ids = index.get(key)
+            except TypeError:
+                continue
+            if ids is not None:
+                ids.discard(doc_id)
+                if not ids:
+                    del index[key]
+        for field in [f for f, value in self.maxes.items() if value is not None and doc.get(f) == value]:
+            del self.maxes[field]
+
+    def candidates(self, tests):
+        # самый узкий индекс, все поля которого заданы условием на равенство
+        eq = {name: value for name, op, value in tests if op is operator.eq and name != 'doc_id'}
+        best = None
+        for fields, index in self.indexes.items():
+            if not all(f in eq for f in fields):
+                continue
+            try:
+                ids = index.get(tuple(eq[f] for f in fields), ())
+            except TypeError:
+                continue
+            if best is None or len(ids) < len(best):
+                best = ids
+        return best
+
+    def find(self, conditions, doc_ids=None, limit=None, after=None, before=None, reverse=False):
+        tests = []
+        for key, value in conditions.items():
+            name, op = split_condition(key)
+            tests.append((name, OPERATORS[op][1], value))
+        candidates = set(doc_ids) if doc_ids is not None else self.candidates(tests)
+        ids = self.ids if candidates is None else sorted(candidates)
+        start = 0 if after is None else bisect.bisect_right(ids, after)
+        end = len(ids) if before is None else bisect.bisect_left(ids, before)
+        order = range(end - 1, start - 1, -1) if reverse else range(start, end)
+        result = []
+        for i in order:
+            doc_id = ids[i]
+            doc = self.docs.get(doc_id)
+            if doc is not None and all(self.test(doc_id, doc, *t) for t in tests):
+                result.append((doc_id, doc))
+                if len(result) == limit:
+                    break
+        return result
+
+    @staticmethod
+    def test(doc_id, doc, name, op, value):
+        if name == 'doc_id':
+            return op(doc_id, value)
+        if name not in doc:
+            return False
+        try:
+            return op(doc[name], value)
+        except TypeError:
+            return False
+
+    def get(self, **conditions):
+        with self.storage.lock:
+            found = self.find(conditions, limit=1)
+            return Document(found[0][1], found[0][0]) if found else None
+
+    def search(self, **conditions):
+        with self.storage.lock:
+            return [Document(doc, doc_id) for doc_id, doc in self.find(conditions)]
+
+    def all(self):
+        return self.search()
+
+    def page(self, after=0, limit=100, **conditions):
+        with self.storage.lock:
+            return [Document(doc, doc_id) for doc_id, doc in self.find(conditions, limit=limit, after=after)]
+
+    def page_before(self, before=None, limit=100, **conditions):
+        with self.storage.lock:
+            found = self.find(conditions, limit=limit, before=before, reverse=True)
+            return [Document(doc, doc_id) for doc_id, doc in found]
+
+    def top(self, field, limit=10, **conditions):
+        with self.storage.lock:
+            found = heapq.nlargest(limit, self.find(conditions), key=lambda item: item[1].get(field, 0))
+        return [Document(doc, doc_id) for doc_id, doc in found]
+
+    def count(self, **conditions):
+        with self.storage.lock:
+            if not conditions:
+                return len(self.docs)
+            for fields, index in self.indexes.items():
+                # условие ровно по индексу — размер множества, без обхода
+                if set(fields) != set(conditions) or any(conditions[f] is None for f in fields):
+                    continue
+                try:
+                    return len(index.get(tuple(conditions[f] for f in fields), ()))
+                except TypeError:
+                    break
+            return len(self.find(conditions))
+
+    def __len__(self):
+        return self.count()
+
+    def max(self, field):
+        with self.storage.lock:
+            if field not in self.maxes:
+                values = [doc[field] for doc in self.docs.values() if doc.get(field) is not None]
+                self.maxes[field] = max(values) if values else None
+            return self.maxes[field]
+
+    def taken(self, field, value):
+        try:
+            return bool(self.indexes[(field,)].get((value,)))
+        except TypeError:
+            return any(doc.get(field) == value for doc in self.docs.values())
+
+    def insert(self, doc, doc_id=None):
+        with self.storage.transaction():
+            for field in self.unique:
+                if doc.get(field) is not None and self.taken(field, doc[field]):
+                    raise DuplicateKeyError(f"{self.name}: {field}={doc[field]}")
+            doc_id = doc_id or self.next_id
+            if doc_id in self.docs:
+                raise ValueError(f"{self.name}: doc_id {doc_id} уже есть")
+            doc = plain(doc)
+            self.next_id = max(self.next_id, doc_id + 1)
+            self.save(doc_id)
+            self.docs[doc_id] = doc
+            if not self.ids or doc_id > self.ids[-1]:
+                self.ids.append(doc_id)
+            else:
+                bisect.insort(self.ids, doc_id)
+            self.index(doc_id, doc)
+            self.storage.journal.log(self.name, docs={doc_id: doc})
+            return doc_id
+
+    def insert_multiple(self, docs):
+        with self.storage.transaction():
+            for doc in docs:
+                for field in self.unique:
+                    if doc.get(field) is not None and self.taken(field, doc[field]):
+                        raise DuplicateKeyError(f"{self.name}: {field}={doc[field]}")
+            return [self.insert(doc) for doc in docs]
+
+    def replace(self, changes):
+        # changes: {doc_id: новый doc}
+        for doc_id, doc in changes.items():
+            self.save(doc_id)
+            self.unindex(doc_id, self.docs[doc_id])
+            self.docs[doc_id] = doc
+            self.index(doc_id, doc)
+        if changes:
+            self.storage.journal.log(self.name, docs=changes)
+        return len(changes)
+
+    def update(self, fields, doc_ids=None, **conditions):
+        with self.storage.transaction():
+            fields = plain(fields)
+            return self.replace({doc_id: {**doc, **fields} for doc_id, doc in self.find(conditions, doc_ids)})
+
+    def upsert(self, doc, **conditions):
+        with self.storage.transaction():
+            if self.update(doc, **conditions):
+                return
+            self.insert(doc)
+
+    def increment(self, deltas, **conditions):
+        def apply(doc):
+            doc = dict(doc)
+            for name, delta in deltas.items():
+                doc[name] = doc.get(name, 0) + delta
+            return doc
+        with self.storage.transaction():
+            return self.replace({doc_id: apply(doc) for doc_id, doc in self.find(conditions)})
+
+    def remove(self, doc_ids=None, **conditions):
+        with self.storage.transaction():
+            if doc_ids is None and not conditions:
+                count = len(self.docs)
+                for doc_id in self.ids:
+                    self.save(doc_id)
+                self.docs.clear()
+                self.ids.clear()
+                self.maxes.clear()
+                for index in self.indexes.values():
+                    index.clear()
+                self.storage.journal.log(self.name, truncate=True)
+                return count
+            removed = self.find(conditions, doc_ids)
+            for doc_id, doc in removed:
+                self.save(doc_id)
+                self.unindex(doc_id, doc)
+                del self.docs[doc_id]
+                del self.ids[bisect.bisect_left(self.ids, doc_id)]
+            if removed:
+                self.storage.journal.log(self.name, removed=[doc_id for doc_id, _ in removed])
+            return len(removed)
+
+
+# База TinyDB целиком в памяти: изменения ложатся в TinyJournal с fsync при
+# выходе из внешней транзакции, а фоновый поток раз в flush_interval секунд
+# или когда журнал вырос до journal_size байт пишет сжатый снимок в формате
+# TinyDB и начинает журнал заново. При старте снимок читается и журнал
+# доигрывается. Сама библиотека tinydb для этого больше не нужна.
+class TinyStorage:
+    def __init__(self, path, flush_interval=30, journal_size=4 * 1024 * 1024):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.journal_size = journal_size
+        self.journal = TinyJournal(path)
+        data, replayed = self.journal.load()
+        self.data = {name: {int(doc_id): doc for doc_id, doc in docs.items()} for name, docs in data.items()}
+        # загруженные документы живут до конца процесса — убираем их из обхода сборщика мусора,
+        # иначе полная сборка на большой базе останавливает все потоки на сотни миллисекунд
+        gc.freeze()
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.depth = 0
+        # образы документов до изменений внешней транзакции: (table, doc_id, doc | None)
+        self.undo = []
+        self.tables = {}
+        self.wake = threading.Event()
+        self.closed = False
+        if replayed:
+            print(f"Журнал {self.journal.journal_path}: применено записей: {replayed}")
+        self.thread = threading.Thread(target=self.run, name='tinydb-flush', daemon=True)
+        self.thread.start()
+
+    def table(self, name):
+        with self.lock:
+            if name not in self.tables:
+                self.tables[name] = TinyTable(self, name, self.data.setdefault(name, {}))
+            return self.tables[name]
+
+    @contextmanager
+    def transaction(self):
+        # как в SQLite: исключение во внешней транзакции откатывает всё,
+        # что она успела изменить, в памяти и в журнале
+        with self.lock:
+            self.depth += 1
+            try:
+                yield
+            except BaseException:
+                if self.depth == 1:
+                    self.rollback()
+                raise
+            else:
+                if self.depth == 1:
+                    self.undo = []
+                    self.journal.commit()
+                    if self.journal.size >= self.journal_size:
+                        self.wake.set()
+            finally:
+                self.depth -= 1
+
+    def rollback(self):
+        undo, self.undo = self.undo, []
+        for table, doc_id, doc in reversed(undo):
+            table.restore(doc_id, doc)
+        self.journal.discard()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.journal.size and not os.path.exists(self.journal.old_path):
+                    return False
+                # под замком только копия словарей — документы не меняются на месте
+                data = {name: dict(docs) for name, docs in self.data.items()}
+                self.journal.rotate()
+            self.journal.snapshot(data)
+            return True
+
+    def run(self):
+        while not self.closed:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print("Ошибка записи снимка TinyDB:", e)
+
+    def close(self):
+        self.closed = True
+        self.wake.set()
+        self.thread.join()
+        self.flush()
+        with self.lock:
+            self.journal.close()
+
+
+# ---------- asyncio ----------
+# Те же таблицы для AsyncTeleBot: каждый вызов уходит в пул потоков,
+# event loop не блокируется на диске.
+class AsyncTable:
+    def __init__(self, table, executor):
+        self.table = table
+        self.executor = executor
+
+    def __getattr__(self, name):
+        method = getattr(self.table, name)
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(method, *args, **kwargs))
+        return call
+
+
+class AsyncStorage:
+    def __init__(self, storage, workers=8):
+        self.storage = storage
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='storage')
+        self.tables = {}
+
+    def table(self, name):
+        if name not in self.tables:
+            self.tables[name] = AsyncTable(self.storage.table(name), self.executor)
+        return self.tables[name]
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+
+# ---------- миграция ----------
+def migrate_tinydb(json_path, storage):
+    with open(json_path, encoding='utf-8') as f:
+        data = json.load(f)
+    with storage.transaction():
+        for name, docs in data.items():
+            if name == '_default':
+                continue
+            table = storage.table(name)
+            for doc_id, doc in sorted(docs.items(), key=lambda item: int(item[0])):
+                try:
+                    table.insert(doc, int(doc_id))
+                except DuplicateKeyError:
+                    # старый код выдавал id как len(table) + 1, дубли получают новый id
+                    if 'id' not in doc:
+                        print(f"Пропущен дубликат в {name}: {doc}")
+                        continue
+                    doc['id'] = (table.max('id') or 0) + 1
+                    table.insert(doc, int(doc_id))
+                    print(f"Дубликат id в {name}, назначен id {doc['id']}")
+
+
+def migrate_to_sqlite(json_path, path):
+    # переносим во временный файл и подменяем: недоделанный перенос не оставит пустую базу по пути path
+    tmp = path + '.migrating'
+    for suffix in ('', '-wal', '-shm'):
+        with suppress(FileNotFoundError):
+            os.remove(tmp + suffix)
+    storage = SQLiteStorage(tmp)
+    migrate_tinydb(json_path, storage)
+    storage.table('meta').insert({'key': 'migrated_from', 'value': json_path})
+    storage.close()
+    os.replace(tmp, path)
+
+
+def check_migrated(storage, tinydb_path):
+    # база от прошлых версий могла остаться пустой после упавшего переноса
+    if storage.table('meta').get(key='migrated_from') or storage.table('users').count():
+        return
+    with open(tinydb_path, encoding='utf-8') as f:
+        users = json.load(f).get('users')
+    if users:
+        raise RuntimeError(f"{storage.path} пуста, а в {tinydb_path} есть пользователи: перенос не завершён. "
+                           f"Удалите {storage.path}, чтобы перенести базу заново")
+
+
+def open_storage(backend, path, tinydb_path, **options):
+    if backend == 'tinydb':
+        return TinyStorage(tinydb_path, **options)
+    if backend == 'sqlite':
+        if not os.path.exists(path) and os.path.exists(tinydb_path):
+            migrate_to_sqlite(tinydb_path, path)
+            print(f"База {tinydb_path} перенесена в {path}")
+        storage = SQLiteStorage(path)
+        if os.path.exists(tinydb_path):
+            check_migrated(storage, tinydb_path)
+        return storage
+    raise ValueError(f"Неизвестное хранилище: {backend}")
+
+
+if __name__ == "__main__":
+    # python storage.py database.json database.sqlite3
+    if len(sys.argv) != 3:
+        print("Использование: python storage.py <database.json> <database.sqlite3>")
+        sys.exit(1)
+    if os.path.exists(sys.argv[2]):
+        print(f"{sys.argv[2]} уже существует")
+        sys.exit(1)
+    migrate_to_sqlite(sys.argv[1], sys.argv[2])
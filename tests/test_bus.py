@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+
+from bus import EventBus
+from storage import SQLiteStorage
+
+
+class EventBusTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'db.sqlite3')
+        self.storage = SQLiteStorage(self.path)
+        self.sender = EventBus(self.storage)
+        self.receiver = EventBus(SQLiteStorage(self.path))
+        # publish() пишет в таблицу только у запущенной шины
+        self.sender.thread = self.receiver.thread = object()
+        self.received = []
+        self.receiver.on('ping', lambda n: self.received.append(n))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_event_after_full_prune_is_delivered(self):
+        self.sender.publish('ping', n=1)
+        self.receiver.poll()
+        self.assertEqual(self.received, [1])
+
+        self.sender.keep = -1
+        self.assertEqual(self.sender.prune(), 1)
+        self.sender.publish('ping', n=2)
+        self.receiver.poll()
+        self.assertEqual(self.received, [1, 2])
+
+    def test_old_events_table_is_upgraded(self):
+        path = os.path.join(self.dir.name, 'old.sqlite3')
+        storage = SQLiteStorage(path)
+        storage.conn.execute('CREATE TABLE events (doc_id INTEGER PRIMARY KEY, data TEXT NOT NULL)')
+        storage.conn.execute('INSERT INTO events VALUES (5, \'{"kind": "ping"}\')')
+        events = storage.table('events')
+        self.assertEqual(events.get(kind='ping').doc_id, 5)
+        events.remove()
+        self.assertGreater(events.insert({'kind': 'ping'}), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import json
+import os
+import tempfile
+import unittest
+
+from storage import TinyStorage
+
+
+class TinyJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'database.json')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def open(self):
+        return TinyStorage(self.path, flush_interval=3600)
+
+    def test_journal_is_replayed_after_crash(self):
+        storage = self.open()
+        users = storage.table('users')
+        users.insert({'user_id': 1, 'balance': 0})
+        with storage.transaction():
+            users.increment({'balance': 5}, user_id=1)
+            storage.table('meta').insert({'key': 'a'})
+        # падение посреди записи: последняя строка оборвана
+        with open(self.path + '.journal', 'a', encoding='utf-8') as f:
+            f.write('{"ops": [{"t": "users", "se')
+
+        storage = self.open()
+        self.assertEqual(storage.table('users').get(user_id=1)['balance'], 5)
+        self.assertEqual(storage.table('meta').count(), 1)
+        self.assertEqual(os.path.getsize(self.path + '.journal'), 0)
+        storage.close()
+
+    def test_only_old_journal_exists(self):
+        storage = self.open()
+        storage.table('users').insert({'user_id': 1, 'balance': 3})
+        storage.journal.commit()
+        storage.closed = True
+        # падение после rotate(): журнал уже .old, снимок и новый журнал не записаны
+        storage.journal.file.close()
+        os.replace(self.path + '.journal', self.path + '.journal.old')
+
+        storage = self.open()
+        self.assertEqual(storage.table('users').get(user_id=1)['balance'], 3)
+        self.assertFalse(os.path.exists(self.path + '.journal.old'))
+        with open(self.path, encoding='utf-8') as f:
+            self.assertEqual(json.load(f)['users']['1']['balance'], 3)
+        storage.close()
+
+    def test_snapshot_is_plain_tinydb_json(self):
+        storage = self.open()
+        storage.table('users').insert_multiple([{'user_id': i} for i in range(1, 2502)])
+        storage.table('users').remove(user_id=7)
+        self.assertTrue(storage.flush())
+        with open(self.path, encoding='utf-8') as f:
+            data = json.load(f)
+        self.assertEqual(len(data['users']), 2500)
+        self.assertNotIn('7', data['users'])
+        storage.close()
+
+    def test_failed_transaction_is_rolled_back(self):
+        storage = self.open()
+        users = storage.table('users')
+        users.insert({'user_id': 1, 'balance': 10})
+        with self.assertRaises(RuntimeError):
+            with storage.transaction():
+                users.update({'balance': 15}, user_id=1)
+                storage.table('transactions').insert({'key': 'k', 'user_id': 1})
+                users.remove(user_id=1)
+                raise RuntimeError()
+        self.assertEqual(users.get(user_id=1)['balance'], 10)
+        self.assertEqual(storage.table('transactions').count(key='k'), 0)
+        storage.close()
+
+        storage = self.open()
+        self.assertEqual(storage.table('users').get(user_id=1)['balance'], 10)
+        self.assertEqual(storage.table('transactions').count(), 0)
+        storage.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
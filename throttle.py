@@ -0,0 +1,54 @@
+import threading
+from collections import OrderedDict
+
+from ratelimit import RateLimiter
+
+
+# Ограничение частоты на пользователя: свой token bucket (RateLimiter) на
+# каждого user_id, ведра лежат в LRU на capacity пользователей — вытесненный
+# при следующем событии просто получает полное ведро. Повторное нажатие той
+# же кнопки, пока первое ещё обрабатывается, схлопывается (begin/done).
+class Throttle:
+    def __init__(self, rate=1.0, burst=5, capacity=10000):
+        self.rate = rate
+        self.burst = burst
+        self.capacity = capacity
+        self.buckets = OrderedDict()
+        self.inflight = set()
+        self.lock = threading.Lock()
+
+    def bucket(self, user_id):
+        with self.lock:
+            entry = self.buckets.get(user_id)
+            if entry is None:
+                # [ведро, уже предупреждали о лимите]
+                entry = self.buckets[user_id] = [RateLimiter(self.rate, self.burst), False]
+                while len(self.buckets) > self.capacity:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(user_id)
+            return entry
+
+    def allow(self, user_id):
+        # (пропустить, предупредить): предупреждаем один раз на серию отказов
+        entry = self.bucket(user_id)
+        if not entry[0].try_acquire():
+            entry[1] = False
+            return True, False
+        notify = not entry[1]
+        entry[1] = True
+        return False, notify
+
+    def begin(self, key):
+        with self.lock:
+            if key in self.inflight:
+                return False
+            self.inflight.add(key)
+            return True
+
+    def done(self, key):
+        with self.lock:
+            self.inflight.discard(key)
+
+    def __len__(self):
+        return len(self.buckets)
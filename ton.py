@@ -0,0 +1,252 @@
+import threading
+import time
+from datetime import datetime
+
+import requests
+
+import metrics
+
+
+def parse_timestamp(value):
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S').timestamp()
+
+
+# Один фоновый поток на все ожидающие TON-платежи: раз в цикл забирает
+# только новые транзакции кошелька (курсор по lt) и сверяет их с заявками
+# через словарь comment -> заявка. Курс (rate() -> USD за TON) берётся один
+# раз на цикл и передаётся в on_paid вместе с каждым найденным платежом.
+# Заявка снимается, а курсор проходит транзакцию только после успешного on_paid.
+class TonPoller:
+    def __init__(self, api_url, wallet, timeout, on_paid, on_expired,
+                 interval=30, page_size=100, max_pages=10, cursor=None, on_cursor=None, rate=None):
+        self.url = api_url.format(wallet)
+        self.timeout = timeout
+        self.on_paid = on_paid
+        self.on_expired = on_expired
+        self.interval = interval
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.after_lt = cursor
+        self.on_cursor = on_cursor
+        self.rate = rate
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def add(self, payment):
+        with self.lock:
+            self.pending[payment['comment']] = payment
+
+    def update(self, comment, **fields):
+        with self.lock:
+            payment = self.pending.get(comment)
+            if payment is not None:
+                payment.update(fields)
+
+    def load(self, payments):
+        for payment in payments:
+            self.add(payment)
+        # старые версии не меняли статус TON-заявок: 'pending' старше timeout
+        # (в том числе давно зачисленные) закрываем до первого сопоставления
+        self.expire()
+
+    async def aload(self, payments):
+        for payment in payments:
+            self.add(payment)
+        await self.aexpire()
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='ton-poller', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                print("TON poller err:", e)
+            self.stop_event.wait(self.interval)
+
+    def page_params(self, after_lt):
+        # без курсора берём только последнюю страницу, дальше — всё после неё
+        if after_lt is None:
+            return {'limit': self.page_size}
+        return {'limit': self.page_size, 'after_lt': after_lt, 'sort_order': 'asc'}
+
+    def next_cursor(self, page, after_lt):
+        if after_lt is None or len(page) < self.page_size:
+            return None
+        return max(int(tx.get('lt', 0)) for tx in page)
+
+    def fetch(self):
+        txs = []
+        after_lt = self.after_lt
+        for _ in range(self.max_pages):
+            page = self.fetch_page(self.page_params(after_lt))
+            if page is None:
+                break
+            txs.extend(page)
+            after_lt = self.next_cursor(page, after_lt)
+            if after_lt is None:
+                break
+        return txs
+
+    async def afetch(self, session):
+        txs = []
+        after_lt = self.after_lt
+        for _ in range(self.max_pages):
+            try:
+                with metrics.http_timer('tonapi', 'transactions'):
+                    async with session.get(self.url, params=self.page_params(after_lt)) as r:
+                        if r.status != 200:
+                            break
+                        page = (await r.json()).get("transactions", [])
+            except Exception as e:
+                print("TON API err:", e)
+                break
+            txs.extend(page)
+            after_lt = self.next_cursor(page, after_lt)
+            if after_lt is None:
+                break
+        return txs
+
+    def fetch_page(self, params):
+        try:
+            with metrics.http_timer('tonapi', 'transactions'):
+                r = requests.get(self.url, params=params, timeout=10)
+            if r.status_code == 200:
+                return r.json().get("transactions", [])
+        except Exception as e:
+            print("TON API err:", e)
+        return None
+
+    def poll(self):
+        self.handle(self.fetch())
+
+    def handle(self, txs):
+        # просроченные — до сопоставления, иначе старая транзакция зачтётся им ещё раз
+        self.expire()
+        found = self.prepare(txs)
+        if found is None:
+            return
+        matches, rate = found
+        failed = [lt for lt, payment, value in matches if not self.credit(payment, value, rate)]
+        self.finish(txs, failed)
+
+    async def ahandle(self, txs):
+        # то же для asyncio: все колбэки — корутины, ждём их здесь
+        await self.aexpire()
+        found = self.prepare(txs)
+        if found is None:
+            return
+        matches, rate = found
+        failed = []
+        for lt, payment, value in matches:
+            try:
+                await self.on_paid(payment, value, rate)
+            except Exception as e:
+                print("TON credit err:", e)
+                failed.append(lt)
+                continue
+            self.credited(payment)
+        cursor = self.advance(txs, failed)
+        if cursor is not None and self.on_cursor:
+            await self.on_cursor(cursor)
+        await self.aexpire()
+
+    def prepare(self, txs):
+        # None — цикл пропускаем целиком: нет курса, транзакции придут снова
+        with self.lock:
+            has_pending = bool(self.pending)
+        if not txs or not has_pending:
+            return [], None
+        rate = self.rate() if self.rate else None
+        if self.rate and rate is None:
+            print("TON poller: нет курса TON/USD, зачисление отложено")
+            return None
+        return self.match(txs), rate
+
+    def credit(self, payment, value, rate):
+        try:
+            self.on_paid(payment, value, rate)
+        except Exception as e:
+            print("TON credit err:", e)
+            return False
+        self.credited(payment)
+        return True
+
+    def credited(self, payment):
+        # из ожидающих убираем только после успешного зачисления
+        with self.lock:
+            self.pending.pop(payment['comment'], None)
+
+    def finish(self, txs, failed=()):
+        cursor = self.advance(txs, failed)
+        if cursor is not None and self.on_cursor:
+            self.on_cursor(cursor)
+        self.expire()
+
+    def advance(self, txs, failed=()):
+        # курсор двигаем и без заявок, чтобы не тянуть историю потом,
+        # но не дальше транзакции, которую не удалось зачислить — она придёт снова
+        lts = [int(tx.get('lt', 0)) for tx in txs]
+        if failed:
+            lts = [lt for lt in lts if lt < min(failed)]
+        if lts:
+            last_lt = max(lts)
+            if self.after_lt is None or last_lt > self.after_lt:
+                self.after_lt = last_lt
+                return last_lt
+        return None
+
+    def match(self, txs):
+        # [(lt, заявка, сумма)] по возрастанию lt, одна транзакция на заявку
+        matches = []
+        seen = set()
+        for tx in sorted(txs, key=lambda tx: int(tx.get('lt', 0))):
+            try:
+                msg = tx.get("in_msg") or {}
+                comment = msg.get("message")
+                if not comment or comment in seen:
+                    continue
+                with self.lock:
+                    payment = self.pending.get(comment)
+                if payment is None:
+                    continue
+                value = int(msg.get("value", 0)) / 1e9   # nanoton → ton
+                if value < payment['amount'] * 0.999:
+                    continue
+            except Exception:
+                continue
+            seen.add(comment)
+            matches.append((int(tx.get('lt', 0)), payment, value))
+        return matches
+
+    def overdue(self):
+        # просроченные снимаем сразу: лучше не закрыть заявку в базе, чем зачесть её
+        now = time.time()
+        with self.lock:
+            expired = [c for c, p in self.pending.items()
+                       if now - parse_timestamp(p['timestamp']) >= self.timeout]
+            return [self.pending.pop(c) for c in expired]
+
+    def expire(self):
+        for payment in self.overdue():
+            try:
+                self.on_expired(payment)
+            except Exception as e:
+                print("TON expire err:", e)
+
+    async def aexpire(self):
+        for payment in self.overdue():
+            try:
+                await self.on_expired(payment)
+            except Exception as e:
+                print("TON expire err:", e)
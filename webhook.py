@@ -0,0 +1,139 @@
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import types
+
+
+def update_chat_id(update):
+    # ключ очереди: апдейты одного чата обрабатывает один и тот же воркер
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    if update.inline_query:
+        return update.inline_query.from_user.id
+    return update.update_id
+
+
+# Приём апдейтов по вебхуку: HTTP-поток только кладёт апдейт в ограниченную
+# очередь своего воркера и сразу отвечает. Если очередь полна, Telegram
+# получает 503 и повторит доставку позже — всплеск ждёт у Telegram, а не в памяти.
+# С dispatch сырой JSON апдейта сразу отдаётся наружу (в процессы WorkerPool).
+class WebhookServer:
+    def __init__(self, bot, host, port, path, secret=None, workers=8, queue_size=1000, put_timeout=1, dispatch=None):
+        self.bot = bot
+        self.dispatch = dispatch
+        self.path = path
+        self.secret = secret
+        self.put_timeout = put_timeout
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.lock = threading.Lock()
+        self.counters = {'received': 0, 'processed': 0, 'rejected': 0, 'errors': 0}
+        self.max_lag = 0.0
+        self.busy_time = 0.0
+        self.started = time.time()
+        self.server = ThreadingHTTPServer((host, port), self.handler_class())
+        self.server.daemon_threads = True
+
+    def handler_class(self):
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != webhook.path:
+                    return self.reply(404)
+                if webhook.secret and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != webhook.secret:
+                    return self.reply(403)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if webhook.dispatch:
+                    return self.forward(body)
+                try:
+                    update = types.Update.de_json(body.decode('utf-8'))
+                except Exception:
+                    return self.reply(400)
+                self.reply(200 if webhook.submit(update) else 503)
+
+            def forward(self, body):
+                try:
+                    data = json.loads(body.decode('utf-8'))
+                except Exception:
+                    return self.reply(400)
+                webhook.count('received')
+                if webhook.dispatch(data):
+                    return self.reply(200)
+                webhook.count('rejected')
+                self.reply(503)
+
+            def do_GET(self):
+                if self.path != webhook.path + '/stats':
+                    return self.reply(404)
+                self.reply(200, json.dumps(webhook.stats()).encode('utf-8'), 'application/json')
+
+            def reply(self, code, body=b'', content_type='text/plain'):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def submit(self, update):
+        self.count('received')
+        worker_queue = self.queues[hash(update_chat_id(update)) % len(self.queues)]
+        try:
+            worker_queue.put((time.time(), update), timeout=self.put_timeout)
+        except queue.Full:
+            self.count('rejected')
+            return False
+        return True
+
+    def work(self, worker_queue):
+        while True:
+            enqueued, update = worker_queue.get()
+            started = time.time()
+            try:
+                self.bot.process_new_updates([update])
+            except Exception as e:
+                self.count('errors')
+                print("Ошибка обработки апдейта:", e)
+            finally:
+                with self.lock:
+                    self.counters['processed'] += 1
+                    self.max_lag = max(self.max_lag, started - enqueued)
+                    self.busy_time += time.time() - started
+                worker_queue.task_done()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['max_lag'] = round(self.max_lag, 3)
+            stats['avg_handle_time'] = round(self.busy_time / stats['processed'], 4) if stats['processed'] else 0
+        stats['queue_depth'] = [q.qsize() for q in self.queues]
+        stats['queue_capacity'] = self.queues[0].maxsize
+        stats['uptime'] = int(time.time() - self.started)
+        return stats
+
+    def serve_forever(self, url=None):
+        # апдейты одного чата обрабатываются строго по очереди внутри воркера
+        self.bot.threaded = False
+        if not self.dispatch:
+            for i, worker_queue in enumerate(self.queues):
+                threading.Thread(target=self.work, args=(worker_queue,), name=f'webhook-worker-{i}', daemon=True).start()
+        if url:
+            self.bot.remove_webhook()
+            self.bot.set_webhook(url=url + self.path, secret_token=self.secret or None,
+                                 max_connections=100)
+        self.server.serve_forever()